@@ -13,62 +13,143 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
-
+#
+#  BANK 3      ; what follows goes in extended memory, bank 3
+#  Table:      ; a label in a bank is its address in the window, 0x80 up
+#  DB 42
+#  BANK MAIN   ; back to the program
+#
+# Only DS and DB can go in a bank, at most 64 bytes of them, and a program
+# with banks has to fit below the bank select register at 0x7E (see
+# ../ls8/devices.py). Banks are only kept in .ls8b images.
+#
+# Output files ending in .ls8b are written as binary images (see
+# ../ls8/image.py), anything else as text .ls8. An image's symbol table
+# holds at most 255 labels, each an ASCII name of at most 255 bytes.
+#
+# With --map mapfile a JSON map is also written, giving the address of
+# every label and the source line each address was assembled from, for the
+# emulator's profiler (../ls8/profiler.py):
+#
+#  {"source": "prog.asm", "symbols": {"LABEL1": 3},
+#   "lines": {"3": [5, "DEC R2"]}}
+#
+# With --build, many sources are assembled in one process into an output
+# directory (see build_main):
+#
+#  asm.py --build --out ../ls8/examples [--jobs N] *.asm
+#
+# Outputs are cached by a hash of the source and of the assembler itself,
+# so only sources that changed since the last build are assembled again.
+#
+# --optimize runs a peephole optimizer over the instructions before the
+# labels are resolved (see peephole()), and reports what it saved.
+
+import argparse
+import bisect
+import concurrent.futures
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import shutil
 import sys
-import re
 
-# Opcodes
+
+def load_emulator():
+    """
+    Make the emulator package, ../ls8, importable as ls8: the opcode table
+    and binary image format live there. When the emulator loaded this
+    module it's imported already, otherwise it's loaded from its directory
+    without putting anything on sys.path.
+    """
+
+    if hasattr(sys.modules.get("ls8"), "__path__"):
+        return
+
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                        "ls8")
+    spec = importlib.util.spec_from_file_location(
+        "ls8", os.path.join(here, "__init__.py"),
+        submodule_search_locations=[here])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["ls8"] = package
+    spec.loader.exec_module(package)
+
+
+load_emulator()
+
+from ls8.devices import BANK_SELECT, BANK_SIZE, WINDOW_START  # noqa: E402
+from ls8.image import ImageError, pack_image  # noqa: E402
+from ls8.opcodes import IMMEDIATE, CMP, is_alu, operand_count  # noqa: E402
+from ls8.opcodes import sets_pc  # noqa: E402
+from ls8.opcodes import OPCODES as SHARED_OPCODES  # noqa: E402
+
+# Opcodes, generated from the table shared with the emulator, as name ->
+# (opcode, type). The type is the number of register operands, or 8 for
+# LDI's register and immediate.
 OPCODES = {
-    "ADD":  {"type": 2, "code": "10100000"},
-    "AND":  {"type": 2, "code": "10101000"},
-    "CALL": {"type": 1, "code": "01010000"},
-    "CMP":  {"type": 2, "code": "10100111"},
-    "DEC":  {"type": 1, "code": "01100110"},
-    "DIV":  {"type": 2, "code": "10100011"},
-    "HLT":  {"type": 0, "code": "00000001"},
-    "INC":  {"type": 1, "code": "01100101"},
-    "INT":  {"type": 1, "code": "01010010"},
-    "IRET": {"type": 0, "code": "00010011"},
-    "JEQ":  {"type": 1, "code": "01010101"},
-    "JGE":  {"type": 1, "code": "01011010"},
-    "JGT":  {"type": 1, "code": "01010111"},
-    "JLE":  {"type": 1, "code": "01011001"},
-    "JLT":  {"type": 1, "code": "01011000"},
-    "JMP":  {"type": 1, "code": "01010100"},
-    "JNE":  {"type": 1, "code": "01010110"},
-    "LD":   {"type": 2, "code": "10000011"},
-    "LDI":  {"type": 8, "code": "10000010"},
-    "MOD":  {"type": 2, "code": "10100100"},
-    "MUL":  {"type": 2, "code": "10100010"},
-    "NOP":  {"type": 0, "code": "00000000"},
-    "NOT":  {"type": 1, "code": "01101001"},
-    "OR":   {"type": 2, "code": "10101010"},
-    "POP":  {"type": 1, "code": "01000110"},
-    "PRA":  {"type": 1, "code": "01001000"},
-    "PRN":  {"type": 1, "code": "01000111"},
-    "PUSH": {"type": 1, "code": "01000101"},
-    "RET":  {"type": 0, "code": "00010001"},
-    "SHL":  {"type": 2, "code": "10101100"},
-    "SHR":  {"type": 2, "code": "10101101"},
-    "ST":   {"type": 2, "code": "10000100"},
-    "SUB":  {"type": 2, "code": "10100001"},
-    "XOR":  {"type": 2, "code": "10101011"},
+    name: (code, 8 if code in IMMEDIATE else operand_count(code))
+    for name, code in SHARED_OPCODES.items()
 }
 
-# Regex for matching lines
-# Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+# What the peephole optimizer counts, in the order it reports them
+OPTIMIZATIONS = ("PUSH/POP pairs", "dead LDIs", "repeated LDIs",
+                 "jumps to the next instruction")
+
+# Bytes an instruction of each type takes up
+TYPE_LENGTH = {0: 1, 1: 2, 2: 3, 8: 3}
+
+# Register names. An operand only has to start with one, so R12 is R1, as
+# it always has been.
+REGISTERS = {f"R{i}": i for i in range(8)}
+
+# Instructions that set their first register operand: every ALU operation
+# but CMP, and the loads
+WRITES_REG_A = {
+    name for name, (code, op_type) in OPCODES.items()
+    if is_alu(code) and code != CMP
+} | {'LDI', 'LD', 'POP'}
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+# R5-R7 are IM, IS and SP, which interrupts and the stack change without
+# the program saying so. The optimizer leaves instructions on them alone.
+FIRST_SPECIAL_REGISTER = 5
+
+# Bytes of memory a program has to fit in
+MEMORY_SIZE = 256
+
+# What statements and whole source lines assemble to (see
+# Assembly.parse_line). Generated programs repeat the same lines over and
+# over, so each distinct statement is only tokenized once, and a repeated
+# line isn't even split up again. Both are emptied when the line cache
+# holds CACHE_SIZE lines.
+STATEMENT_CACHE = {}
+LINE_CACHE = {}
+CACHE_SIZE = 65536
+
+# Indexes into a STATEMENT_CACHE entry
+DATA, FIXUP, NOTE, LISTING = range(4)
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [--optimize] [--map mapfile] [inputfile] [outputfile]
     """
 
+    mapfile = None
+    optimize = False
+
+    while len(argv) > 1 and argv[1].startswith("--"):
+        if argv[1] == "--optimize":
+            optimize = True
+            argv = argv[:1] + argv[2:]
+        elif argv[1] == "--map" and len(argv) > 2:
+            mapfile = argv[2]
+            argv = argv[:1] + argv[3:]
+        else:
+            break
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,321 +163,961 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [--optimize] [--map mapfile] [infile.asm] "
+              "[outfile.ls8|outfile.ls8b]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, mapfile, optimize
 
 
-def open_files(inputfile, outputfile):
+def open_input(inputfile):
     """
-    Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    Open the source file for reading, or return stdin if it's named "-".
     """
 
     if inputfile == "-":
-        inputfile = sys.stdin
-    else:
-        inputfile = open(inputfile)
+        return sys.stdin
+
+    return open(inputfile)
+
+
+def open_output(outputfile):
+    """
+    Open the output file for writing, binary for an .ls8b image, or return
+    stdout if it's named "-".
+    """
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        return sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        return open(outputfile, "wb")
     else:
-        outputfile = open(outputfile, "w")
-
-    return inputfile, outputfile
+        return open(outputfile, "w")
 
 
-def normalize_line(groups):
+class AsmError(Exception):
     """
-    Takes match groups and uppercases them if they're not None.
+    Source that didn't assemble. `diagnostics` is the list of every error
+    found, as "line N: message" strings.
     """
 
-    result = []
+    def __init__(self, diagnostics):
+        super().__init__("\n".join(diagnostics))
+        self.diagnostics = diagnostics
 
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
 
-    return result
+def is_word(s):
+    """True if `s` is one or more word characters (letters, digits, _)."""
+    return s.isalnum() or (s != "" and s.replace("_", "a").isalnum())
+
 
+def leading_word(s):
+    """The word characters `s` starts with, possibly none."""
 
-def p8(v):
-    return "{:08b}".format(v)
+    if is_word(s):
+        return s
 
+    i = 0
+    while i < len(s) and is_word(s[i]):
+        i += 1
 
-def pass1(inputfile, sym, code):
+    return s[:i]
+
+
+def split_label(line):
     """
-    Pass 1
+    Split a source line, with its comment and surrounding whitespace already
+    stripped, into (label, statement). The label is the word before the
+    first colon, if it's all one word, otherwise None.
+    """
+
+    colon = line.find(':')
+    if colon > 0 and is_word(line[:colon]):
+        return line[:colon], line[colon + 1:].lstrip()
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+    return None, line
+
+
+def tokenize(statement):
     """
+    Split a statement, a source line after split_label(), into (opcode,
+    operand a, operand b), with None for the parts that aren't there. Parts
+    are as written, not uppercased.
 
-    # Source line number
-    line_num = 0
+    The syntax is
 
-    # Current code address (for labels)
-    addr = 0
+        [opcode [operand a [, operand b]]]
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+    where every part is a run of word characters. Anything after the last
+    part that fits is ignored.
+    """
 
-        nonlocal line_num
+    parts = statement.split(None, 1)
+    if not parts:
+        return None, None, None
 
-        m = re.match(r"R([0-7])", op)
+    opcode = leading_word(parts[0])
+    if opcode == "":
+        return None, None, None
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
+    # Operands have to be separated from the opcode by whitespace
+    if opcode != parts[0] or len(parts) == 1:
+        return opcode, None, None
+
+    a, comma, b = parts[1].partition(',')
+    a = a.rstrip()
 
-        return int(m.group(1))
+    if is_word(a):
+        if comma:
+            return opcode, a, leading_word(b.lstrip()) or None
+        return opcode, a, None
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
+    # something after operand a that isn't a comma
+    return opcode, leading_word(a) or None, None
 
-        nonlocal addr
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+class Assembly:
+    """
+    A program being assembled.
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+    parse() assembles source lines straight into the `image` bytearray,
+    leaving a zero byte wherever LDI loads a label, and keeps a record of
+    every line that emitted bytes. link() then patches the label addresses
+    in from the records. Errors are collected in `diagnostics` rather than
+    stopping at the first one.
 
-        nonlocal addr
+    The comments of a text .ls8 file are only worked out if text() is
+    called.
+    """
+
+    def __init__(self):
+        self.image = bytearray()
+        # label -> address
+        self.symbols = {}
+        # (address, label) in source order, for the text listing
+        self.labels = []
+        # bank number -> its bytes, and the (address, label) of the labels
+        # in banks, their address being in the window
+        self.banks = {}
+        self.bank_labels = []
+        # (address, line number, source text, parse_statement() entry) of
+        # every line that emitted bytes
+        self.records = []
+        self.diagnostics = []
+        # what optimize() removed, and how big the program was before
+        self.saved = None
+        self.size_before_optimize = None
+
+    @property
+    def lines(self):
+        """address -> (line number, source text) of every instruction"""
+        return {addr: (line_num, text)
+                for addr, line_num, text, entry in self.records}
+
+    def error(self, line_num, message):
+        self.diagnostics.append(f"line {line_num}: {message}")
+
+    def register(self, line_num, op):
+        """Register number of operand `op`, e.g. "R2" -> 2."""
+
+        reg = REGISTERS.get(op[:2])
+        if reg is None:
+            self.error(line_num, f"unknown register {op}")
+            return 0
+
+        return reg
+
+    def parse(self, source):
+        """
+        Pass 1: assemble an iterable of source lines into the image.
+        """
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        image = self.image
+        symbols = self.symbols
+        labels = self.labels
+        records = self.records
+        cache = LINE_CACHE
+        # the bank being assembled into, None for the program
+        bank = None
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+        for line_num, line in enumerate(source, 1):
+            parsed = cache.get(line)
 
-        nonlocal addr
+            if parsed is None:
+                parsed = self.parse_line(line_num, line)
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+            label, text, entry = parsed
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+            if bank is not None:
+                bank = self.parse_bank_line(line_num, bank, label, entry)
+                continue
 
-        addr += 3
+            # Track label address
+            if label is not None:
+                symbols[label] = len(image)
+                labels.append((len(image), label))
+
+            if entry is not None and entry[DATA] is not None:
+                records.append((len(image), line_num, text, entry))
+                image += entry[DATA]
+
+            elif entry is not None and entry[NOTE] is not None:
+                # BANK, the only statement with a note and no data
+                bank = self.select_bank(entry[NOTE][1])
+
+        if len(image) > MEMORY_SIZE:
+            self.diagnostics.append(
+                f"program is {len(image)} bytes, more than the "
+                f"{MEMORY_SIZE} bytes of memory")
+
+        elif self.banks and len(image) > BANK_SELECT:
+            self.diagnostics.append(
+                f"program is {len(image)} bytes, more than the "
+                f"{BANK_SELECT} bytes below the bank select register")
+
+    def select_bank(self, bank):
+        """Start assembling into `bank`, or the program if it's None."""
+        if bank is not None:
+            self.banks.setdefault(bank, bytearray())
+        return bank
+
+    def parse_bank_line(self, line_num, bank, label, entry):
+        """
+        parse() for a line after BANK: labels get addresses in the window
+        and DS and DB go into the bank. Returns the bank the next line goes
+        in, None for the program.
+        """
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+        data = self.banks[bank]
 
-        nonlocal addr
+        if label is not None:
+            addr = WINDOW_START + len(data)
+            self.symbols[label] = addr
+            self.bank_labels.append((addr, label))
 
-        reg_a = get_reg(op_a)
+        if entry is None:
+            return bank
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+        if entry[DATA] is None:
+            return self.select_bank(entry[NOTE][1])
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+        if entry[NOTE] is not None and entry[NOTE][0] not in ('DS', 'DB'):
+            self.error(line_num, f"{entry[NOTE][0]} in a bank, only DS and "
+                                 "DB can go there")
+            return bank
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+        data += entry[DATA]
 
-        addr += 3
+        # only said once, on the line that overflowed
+        if len(data) > BANK_SIZE >= len(data) - len(entry[DATA]):
+            self.error(line_num, f"bank {bank} is more than {BANK_SIZE} "
+                                 "bytes")
 
-    def handle_ds(line):
+        return bank
+
+    def parse_line(self, line_num, line):
         """
-        Handle DS pseudo-opcode
+        Split a source line into (label, text, entry): its label,
+        uppercased, the line without its comment, and the
+        parse_statement() entry for the rest, None for a blank line or
+        just a label. Lines that assemble cleanly are cached.
         """
 
-        nonlocal addr
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            stripped = line[:comment_index]
+        else:
+            stripped = line
+
+        # Normalize
+        stripped = stripped.strip()
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        label, statement = split_label(stripped)
+        if label is not None:
+            label = label.upper()
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+        entry = None
+        errors = len(self.diagnostics)
 
-        data = m.group(2)
+        if statement != '':
+            entry = STATEMENT_CACHE.get(statement)
 
-        for i in range(len(data)):
-            print_char = data[i]
+            if entry is None:
+                entry = self.parse_statement(line_num, statement)
 
-            if print_char == ' ':
-                print_char = '[space]'
+        # only lines that assembled cleanly can be reused, the others have
+        # to report their errors at every line number
+        if len(self.diagnostics) == errors:
+            # every line adds at most one statement, so the statement cache
+            # never holds more than the line cache
+            if len(LINE_CACHE) >= CACHE_SIZE:
+                LINE_CACHE.clear()
+                STATEMENT_CACHE.clear()
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+            if entry is not None:
+                STATEMENT_CACHE[statement] = entry
+            LINE_CACHE[line] = (label, stripped, entry)
 
-        addr += len(data)
+        return label, stripped, entry
 
-    def handle_db(line):
+    def parse_statement(self, line_num, statement):
         """
-        Handle the DB pseudo-opcode
+        Assemble a statement, a source line without its label or comment,
+        returning the list [data, fixup, note, listing], indexed by the
+        constants of the same names:
+
+            data      the bytes it assembles to, or None for no opcode
+            fixup     the symbol LDI loads, whose address goes in the third
+                      byte, or None
+            note      what to comment the bytes with in a text listing,
+                      (opcode, operand a, operand b)
+            listing   the lines of text .ls8 for the bytes, filled in by
+                      text()
+
+        The result only depends on the statement's text, so parse() reuses
+        it for repeats of the same statement.
         """
 
-        nonlocal addr
+        opcode, op_a, op_b = tokenize(statement)
+
+        if opcode is None:
+            return [None, None, None, None]
+
+        name = opcode.upper()
+
+        if name == 'BANK':
+            if op_a is None or op_b is not None:
+                self.error(line_num, "BANK takes a bank number or MAIN")
+                return [b'', None, None, None]
+
+            if op_a.upper() == 'MAIN':
+                return [None, None, (name, None, None), None]
+
+            try:
+                bank = int(op_a, 0)
+            except ValueError:
+                bank = -1
+
+            if not 0 <= bank <= 0xffff:
+                self.error(line_num, f"invalid bank number {op_a}")
+                return [b'', None, None, None]
+
+            return [None, None, (name, bank, None), None]
+
+        if name == 'DS' or name == 'DB':
+            # the rest of the statement, as written
+            data = statement[len(opcode):].lstrip()
+
+            if data == '':
+                self.error(line_num, f"missing argument to {name}")
+                return [b'', None, None, None]
+
+            if name == 'DS':
+                encoded = self.encode_string(line_num, data)
+            else:
+                encoded = self.encode_byte(line_num, data)
+
+            return [encoded, None, (name, data, None), None]
+
+        info = OPCODES.get(name)
+        if info is None:
+            self.error(line_num, f"unknown opcode {name}")
+            return [b'', None, None, None]
+
+        code, op_type = info
+
+        if op_a is not None:
+            op_a = op_a.upper()
+        if op_b is not None:
+            op_b = op_b.upper()
+
+        # Check operand count
+        found = (op_a is not None) + (op_b is not None)
+        desired = 2 if op_type == 8 else op_type
+
+        if found != desired:
+            what = "missing" if found < desired else "unexpected"
+            self.error(line_num, f"{what} operand to {name}")
+            # keep the addresses of what follows right
+            return [bytes(TYPE_LENGTH[op_type]), None, None, None]
+
+        note = (name, op_a, op_b)
+
+        if op_type == 0:
+            return [bytes((code,)), None, note, None]
+
+        reg_a = self.register(line_num, op_a)
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        if op_type == 1:
+            return [bytes((code, reg_a)), None, note, None]
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+        if op_type == 2:
+            reg_b = self.register(line_num, op_b)
+            return [bytes((code, reg_a, reg_b)), None, note, None]
 
-        data = m.group(2)
+        # LDI
+        try:
+            value = int(op_b, 0)
+        except ValueError:
+            # If it's not a value, it might be a symbol
+            return [bytes((code, reg_a, 0)), op_b, note, None]
+
+        if value > 0xff:
+            self.error(line_num, f"value {op_b} doesn't fit in a byte")
+            value = 0
+
+        return [bytes((code, reg_a, value)), None, note, None]
+
+    def encode_string(self, line_num, data):
+        """Handle the DS pseudo-opcode"""
+
+        try:
+            return data.encode("latin-1")
+        except UnicodeEncodeError:
+            self.error(line_num, "character in DS doesn't fit in a byte")
+            return bytes(len(data))
+
+    def encode_byte(self, line_num, data):
+        """Handle the DB pseudo-opcode"""
 
         try:
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            self.error(line_num, "invalid integer argument to DB")
+            val = 0
 
         # Force to byte size
-        val &= 0xff
+        return bytes((val & 0xff,))
 
-        code.append(f"{p8(val)} # {data}")
+    def optimize(self):
+        """
+        Run the peephole optimizer (see peephole()) until it finds nothing
+        more to remove, then lay the program out again with the labels
+        moved to match. Returns, and keeps in self.saved, the number of
+        each kind of thing removed.
+        """
 
-        addr += 1
+        saved = self.saved = dict.fromkeys(OPTIMIZATIONS, 0)
+        self.size_before_optimize = len(self.image)
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+        records = self.records
+        starts = [addr for addr, line_num, text, entry in records]
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+        # each label as the index of the record it points at, len(records)
+        # for one after the last
+        positions = [bisect.bisect_left(starts, addr)
+                     for addr, label in self.labels]
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+        while True:
+            label_index = {label: index for (addr, label), index
+                           in zip(self.labels, positions)}
+            keep = peephole(records, set(positions), label_index, saved)
 
-        op_type = OPCODES[opcode]["type"]
+            if all(keep):
+                break
 
-        total_operands = 0
+            # a label on a removed record moves on to the next one kept
+            new_index = list(itertools.accumulate(keep, initial=0))
+            positions = [new_index[index] for index in positions]
+            records = [record for record, kept in zip(records, keep)
+                       if kept]
 
-        if op_a is not None:
-            total_operands += 1
+        # lay the program out again
+        self.image = bytearray()
+        self.records = []
+        addresses = []
 
-        if op_b is not None:
-            total_operands += 1
+        for addr, line_num, text, entry in records:
+            addresses.append(len(self.image))
+            self.records.append((len(self.image), line_num, text, entry))
+            self.image += entry[DATA]
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+        addresses.append(len(self.image))
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
+        self.labels = [(addresses[index], label) for (addr, label), index
+                       in zip(self.labels, positions)]
+        # later definitions of a label win, as in parse()
+        self.symbols = dict((label, addr) for addr, label in self.labels)
+        self.symbols.update((label, addr) for addr, label
+                            in self.bank_labels)
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
+        return saved
 
-    for line in inputfile:
-        line_num += 1
+    def link(self):
+        """
+        Pass 2: patch label addresses into the image. Raises AsmError if
+        there were any errors, in this pass or parse().
+        """
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+        image = self.image
+        symbols = self.symbols
 
-        # Normalize
-        line = line.strip()
+        for addr, line_num, text, entry in self.records:
+            symbol = entry[FIXUP]
+            if symbol is None:
+                continue
+
+            value = symbols.get(symbol)
+
+            if value is None:
+                self.error(line_num, f"unknown symbol: {symbol}")
+            elif value <= 0xff:
+                # LDI's immediate, the third byte
+                image[addr + 2] = value
+
+        if self.diagnostics:
+            raise AsmError(self.diagnostics)
+
+    def segments(self):
+        """The banks as (offset in extended memory, bytes), in order."""
+        return [(bank * BANK_SIZE, bytes(data))
+                for bank, data in sorted(self.banks.items()) if data]
+
+    def text(self):
+        """
+        The program as a text .ls8 file, with a comment on every line.
+        Raises AsmError if there are banks, text can't hold them.
+        """
+
+        if self.banks:
+            raise AsmError(["BANK needs a binary .ls8b output, a text .ls8 "
+                            "file only holds the program"])
+
+        image = self.image
+        out = []
+        labels = iter(self.labels)
+        next_label = next(labels, None)
+
+        for addr, line_num, text, entry in self.records:
+            while next_label is not None and next_label[0] == addr:
+                out.append(f"# {next_label[1]} (address {addr}):\n")
+                next_label = next(labels, None)
 
-        # Ignore blank lines
-        if input == '':
+            if entry[FIXUP] is not None:
+                out.append(listing(entry, image[addr:addr + 3]))
+            else:
+                # the same every time the line appears, so worked out once
+                if entry[LISTING] is None:
+                    entry[LISTING] = listing(entry, entry[DATA])
+                out.append(entry[LISTING])
+
+        # labels after the last instruction
+        while next_label is not None:
+            out.append(f"# {next_label[1]} (address {next_label[0]}):\n")
+            next_label = next(labels, None)
+
+        return "".join(out)
+
+    def binary(self):
+        """
+        The program as a binary .ls8b image, keeping the labels in its
+        symbol table.
+        """
+
+        try:
+            return pack_image(self.image, symbols=self.symbols,
+                              segments=self.segments())
+        except ImageError as e:
+            raise AsmError([str(e)]) from None
+
+
+def listing(entry, data):
+    """
+    The lines of a text .ls8 file for the bytes `data` of a
+    parse_statement() entry, with a comment on each byte that starts an
+    instruction or holds a character or DB value.
+    """
+
+    if entry[NOTE] is None:
+        # a line with errors
+        return "".join(f"{byte:08b}\n" for byte in data)
+
+    name, op_a, op_b = entry[NOTE]
+
+    if name == 'DS':
+        return "".join(
+            f"{byte:08b} # {'[space]' if char == ' ' else char}\n"
+            for byte, char in zip(data, op_a))
+
+    if name == 'DB':
+        comment = op_a
+    elif op_a is None:
+        comment = name
+    elif op_b is None:
+        comment = f"{name} {op_a}"
+    else:
+        comment = f"{name} {op_a},{op_b}"
+
+    out = [f"{data[0]:08b} # {comment}\n"]
+    for byte in data[1:]:
+        out.append(f"{byte:08b}\n")
+
+    return "".join(out)
+
+
+def overwrites(entry, reg):
+    """
+    True if the instruction of a STATEMENT_CACHE entry sets register `reg`
+    without reading it first.
+    """
+
+    name = entry[NOTE][0]
+    data = entry[DATA]
+
+    if name == 'LDI' or name == 'POP':
+        return data[1] == reg
+
+    if name == 'LD':
+        return data[1] == reg and data[2] != reg
+
+    return False
+
+
+def peephole(records, labelled, label_index, saved):
+    """
+    One pass of the peephole optimizer over Assembly.records. `labelled` is
+    the set of indexes of records a label points at, and `label_index`
+    maps each label to the index of its record. Returns a list of which
+    records to keep, and adds what it removed to the `saved` counts.
+
+    It tracks which registers are known to hold which LDI value since the
+    last label (where another path could join), and removes:
+
+    * PUSH Rx followed by POP Rx
+    * LDI Rx when the next instruction overwrites Rx without reading it
+    * LDI Rx of the value Rx is already known to hold
+    * JMP Rx when Rx holds the label of the next instruction
+    """
+
+    keep = [True] * len(records)
+    # register -> (immediate byte, label) of the LDI that set it
+    known = {}
+    i = 0
+
+    while i < len(records):
+        entry = records[i][3]
+
+        if i in labelled:
+            known.clear()
+
+        if entry[NOTE] is None or entry[NOTE][0] in ('DS', 'DB'):
+            # data, never reached by running on from code
+            known.clear()
+            i += 1
             continue
 
-        # print(line)  # debug
+        name = entry[NOTE][0]
+        code, op_type = OPCODES[name]
+        data = entry[DATA]
+        reg = data[1] if op_type else None
+
+        # the next instruction, if nothing can jump to it
+        following = None
+        if i + 1 < len(records) and i + 1 not in labelled:
+            following = records[i + 1][3]
+            if following[NOTE] is None or \
+                    following[NOTE][0] in ('DS', 'DB'):
+                following = None
+
+        if reg is not None and reg >= FIRST_SPECIAL_REGISTER:
+            # IM, IS and SP change under the program's feet
+            pass
+
+        elif name == 'PUSH' and following is not None and \
+                following[NOTE][0] == 'POP' and following[DATA][1] == reg:
+            keep[i] = keep[i + 1] = False
+            saved["PUSH/POP pairs"] += 1
+            i += 2
+            continue
 
-        m = re.match(REGEX, line)
+        elif name == 'LDI':
+            value = (data[2], entry[FIXUP])
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+            if known.get(reg) == value:
+                keep[i] = False
+                saved["repeated LDIs"] += 1
 
-            # print(label, opcode, op_a, op_b)  # debug
+            elif following is not None and overwrites(following, reg):
+                keep[i] = False
+                saved["dead LDIs"] += 1
+
+            else:
+                known[reg] = value
+
+            i += 1
+            continue
+
+        elif name == 'JMP' and reg in known and known[reg][1] is not None \
+                and label_index.get(known[reg][1]) == i + 1:
+            # falls through to the same place
+            keep[i] = False
+            saved["jumps to the next instruction"] += 1
+            i += 1
+            continue
+
+        # what the instruction does to the known registers
+        if name in WRITES_REG_A:
+            known.pop(reg, None)
+
+        if sets_pc(code):
+            # a subroutine can change any register, and nothing runs on
+            # after a jump that isn't a jump target and so labelled
+            known.clear()
+
+        i += 1
+
+    return keep
+
+
+def assemble_lines(source, optimize=False):
+    """
+    Assemble an iterable of source lines, running the peephole optimizer
+    over it if `optimize`. Returns the linked Assembly, or raises AsmError
+    with every error found.
+    """
+
+    assembly = Assembly()
+    assembly.parse(source)
+
+    if optimize and not assembly.diagnostics:
+        assembly.optimize()
+
+    assembly.link()
+
+    return assembly
+
+
+def report_saved(assembly, file=sys.stderr):
+    """Print what the optimizer saved."""
+
+    saved = assembly.saved
+    before = assembly.size_before_optimize
+
+    instructions = sum(saved.values()) + saved["PUSH/POP pairs"]
+    print(f"optimize: {instructions} instructions, "
+          f"{before - len(assembly.image)} bytes saved "
+          f"({before} -> {len(assembly.image)} bytes)", file=file)
+
+    for what in OPTIMIZATIONS:
+        if saved[what]:
+            print(f"  {saved[what]:>4} {what}", file=file)
+
+
+def write_map(mapfile, source, sym, lines):
+    """
+    Write the symbol and line map for the profiler.
+    """
+
+    with open(mapfile, "w") as f:
+        json.dump({
+            "source": source,
+            "symbols": sym,
+            "lines": {str(addr): list(info) for addr, info in lines.items()},
+        }, f, indent=1)
+
+
+def assemble(source, binary=False, optimize=False):
+    """
+    Assemble source text, returning the .ls8 text, or the .ls8b image as
+    bytes if `binary`. Raises AsmError.
+    """
+
+    assembly = assemble_lines(source.splitlines(), optimize)
+
+    if binary:
+        return assembly.binary()
+
+    return assembly.text()
+
+
+def tool_hash():
+    """
+    Hash of the assembler and the emulator modules it uses, part of every
+    cache key so changing the assembler rebuilds everything.
+    """
+
+    from ls8 import devices, image, opcodes
+
+    h = hashlib.sha256()
+    for module in (__file__, opcodes.__file__, image.__file__,
+                   devices.__file__):
+        with open(module, "rb") as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+
+def build_one(job):
+    """
+    Assemble one source for build(). Returns (source, output), with None
+    for the output if the source had errors; they have been printed.
+    """
+
+    source, text, binary, optimize = job
+
+    try:
+        return source, assemble(text, binary, optimize)
+    except AsmError as e:
+        for message in e.diagnostics:
+            print(f"{source}: {message}", file=sys.stderr)
+        return source, None
+
+
+def build(sources, outdir, cachedir, jobs=1, binary=False, optimize=False):
+    """
+    Assemble each of `sources` into `outdir`, as NAME.ls8 (or .ls8b).
+
+    Every output is also kept in `cachedir` under the hash of its source,
+    and cachedir/manifest.json records which hash each output file was
+    last built from. Outputs already built from the same source are left
+    alone, a source seen before is copied from the cache, and only the rest
+    are assembled, across `jobs` worker processes if more than one.
+
+    Returns (built, copied, unchanged, failed) counts.
+    """
+
+    ext = ".ls8b" if binary else ".ls8"
+    # optimized and plain builds of the same source are different outputs
+    tool = tool_hash() + ("+optimize" if optimize else "")
+
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(cachedir, exist_ok=True)
+
+    manifest_name = os.path.join(cachedir, "manifest.json")
+    try:
+        with open(manifest_name) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    copied = unchanged = failed = 0
+
+    # (source, text, binary, optimize) to assemble, and their output name
+    # and key
+    todo = []
+    targets = {}
+
+    for source in sources:
+        with open(source, "rb") as f:
+            data = f.read()
+
+        key = hashlib.sha256(tool.encode() + data).hexdigest()
+        name = os.path.splitext(os.path.basename(source))[0] + ext
+        outputfile = os.path.join(outdir, name)
+        cached = os.path.join(cachedir, key + ext)
+
+        if manifest.get(outputfile) == key and os.path.exists(outputfile):
+            unchanged += 1
+
+        elif os.path.exists(cached):
+            shutil.copyfile(cached, outputfile)
+            manifest[outputfile] = key
+            copied += 1
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
-
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
-
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            todo.append((source, data.decode(), binary, optimize))
+            targets[source] = (outputfile, cached, key)
+
+    if jobs > 1 and len(todo) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            # big chunks, the jobs are tiny next to the cost of sending them
+            chunksize = max(1, len(todo) // (jobs * 4))
+            results = list(pool.map(build_one, todo, chunksize=chunksize))
+    else:
+        results = [build_one(job) for job in todo]
 
+    built = 0
+    mode = "wb" if binary else "w"
 
-def pass2(outputfile, sym, code):
+    for source, output in results:
+        if output is None:
+            failed += 1
+            continue
+
+        outputfile, cached, key = targets[source]
+
+        for name in (cached, outputfile):
+            with open(name, mode) as f:
+                f.write(output)
+
+        manifest[outputfile] = key
+        built += 1
+
+    with open(manifest_name, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return built, copied, unchanged, failed
+
+
+def build_main(argv):
     """
-    Output the code, substituting in any symbols.
+    Usage: asm.py --build [--out dir] [--cache dir] [--jobs N] [--binary]
+                  [--optimize] file.asm...
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    parser = argparse.ArgumentParser(
+        prog="asm.py --build",
+        description="Assemble many sources, skipping unchanged ones.")
+    parser.add_argument("sources", nargs="+", help=".asm files")
+    parser.add_argument("--out", default=".",
+                        help="output directory (default .)")
+    parser.add_argument("--cache", default=None,
+                        help="cache directory (default OUT/.asmcache)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes (default 1, 0 for one per "
+                             "CPU)")
+    parser.add_argument("--binary", action="store_true",
+                        help="write .ls8b images instead of .ls8 text")
+    parser.add_argument("--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    args = parser.parse_args(argv)
 
-            if s in sym:
-                c = p8(sym[s])
+    cachedir = args.cache or os.path.join(args.out, ".asmcache")
+    jobs = args.jobs or os.cpu_count() or 1
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+    built, copied, unchanged, failed = build(
+        args.sources, args.out, cachedir, jobs, args.binary, args.optimize)
 
-        outputfile.write(f"{c}\n")
+    print(f"{built} built, {copied} from cache, {unchanged} unchanged, "
+          f"{failed} failed", file=sys.stderr)
+
+    return 1 if failed else 0
 
 
 def main(argv):
+    if len(argv) > 1 and argv[1] == "--build":
+        return build_main(argv[2:])
+
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, mapfile, optimize = parse_commandline(argv)
+    source = inputfile
+
+    # Assemble, before opening the output so errors don't leave an empty
+    # file behind
+    inputfile = open_input(inputfile)
+
+    try:
+        assembly = assemble_lines(inputfile, optimize)
+        if outputfile.endswith(".ls8b"):
+            output = assembly.binary()
+        else:
+            output = assembly.text()
 
-    # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    except AsmError as e:
+        for message in e.diagnostics:
+            print(message, file=sys.stderr)
+        return 2
 
-    # Set up the symbol table
-    sym = {}
+    if optimize:
+        report_saved(assembly)
 
-    # Set up the machine code output
-    code = []
+    outputfile = open_output(outputfile)
+    outputfile.write(output)
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    if mapfile is not None:
+        write_map(mapfile, source, assembly.symbols, assembly.lines)
 
     return 0
 
@@ -0,0 +1,29 @@
+; Benchmark: tight ALU loop
+;
+; 100 rounds of a 256 pass ADD/XOR/SHL/INC/CMP/JNE loop, about 154,000
+; instructions.
+;
+; Expected output: 168
+
+    LDI R0,1        ; accumulator
+    LDI R1,0        ; inner counter, wraps back to 0 after 256 passes
+    LDI R2,0        ; zero, to compare the counters against
+    LDI R4,100      ; outer counter
+
+Outer:
+    LDI R3,Inner
+Inner:
+    ADD R0,R1
+    XOR R0,R4
+    SHL R0,R4
+    INC R1
+    CMP R1,R2
+    JNE R3
+
+    LDI R3,Outer
+    DEC R4
+    CMP R4,R2
+    JNE R3
+
+    PRN R0
+    HLT
@@ -0,0 +1,61 @@
+; Benchmark: branch heavy CMP/Jcc code
+;
+; 50 times over, sort every value 0-255 into below 64, exactly 128, above
+; 192 or anything else, with a different update to R0 for each. About
+; 210,000 instructions, with the branches taken at different rates.
+;
+; Expected output: 192
+
+    LDI R0,0        ; accumulator
+    LDI R2,0        ; zero
+    LDI R4,50       ; outer counter
+
+Outer:
+    LDI R1,0        ; value, wraps back to 0 after 256
+
+Inner:
+    LDI R3,64
+    CMP R1,R3
+    LDI R3,Low
+    JLT R3
+
+    LDI R3,128
+    CMP R1,R3
+    LDI R3,Middle
+    JEQ R3
+
+    LDI R3,192
+    CMP R1,R3
+    LDI R3,High
+    JGT R3
+
+    INC R0
+    LDI R3,Next
+    JMP R3
+
+Low:
+    DEC R0
+    LDI R3,Next
+    JMP R3
+
+Middle:
+    XOR R0,R1
+    LDI R3,Next
+    JMP R3
+
+High:
+    ADD R0,R1
+
+Next:
+    INC R1
+    CMP R1,R2
+    LDI R3,Inner
+    JNE R3
+
+    DEC R4
+    CMP R4,R2
+    LDI R3,Outer
+    JNE R3
+
+    PRN R0
+    HLT
@@ -0,0 +1,42 @@
+; Benchmark: CALL/RET heavy recursion
+;
+; Sum(40) = 40 + 39 + ... + 1, computed recursively 200 times, about
+; 90,000 instructions.
+;
+; Expected output: 52 (820, wrapped to 8 bits)
+
+    LDI R2,0        ; zero
+    LDI R4,200      ; rounds
+
+Again:
+    LDI R0,40
+    LDI R3,Sum
+    CALL R3
+
+    LDI R3,Again
+    DEC R4
+    CMP R4,R2
+    JNE R3
+
+    PRN R1
+    HLT
+
+; Sum
+;
+; R1 = R0 + (R0 - 1) + ... + 1, recursively. Uses R3.
+
+Sum:
+    LDI R1,0
+    CMP R0,R2
+    LDI R3,SumDone
+    JEQ R3
+
+    PUSH R0
+    DEC R0
+    LDI R3,Sum
+    CALL R3
+    POP R0
+    ADD R1,R0
+
+SumDone:
+    RET
@@ -0,0 +1,32 @@
+; Benchmark: print heavy output
+;
+; Print every value 0-255 with PRN, each followed by a "." with PRA, sixteen
+; times over: 8,192 prints in about 20,000 instructions.
+;
+; Expected output:
+; 0
+; .1
+; .2
+; ...
+
+    LDI R0,46       ; "."
+    LDI R2,0        ; zero
+    LDI R4,16       ; outer counter
+
+Outer:
+    LDI R1,0
+    LDI R3,Inner
+
+Inner:
+    PRN R1
+    PRA R0
+    INC R1
+    CMP R1,R2
+    JNE R3
+
+    DEC R4
+    CMP R4,R2
+    LDI R3,Outer
+    JNE R3
+
+    HLT
@@ -0,0 +1,42 @@
+; Benchmark: stack churn
+;
+; 250 x 100 rounds of pushing three registers and popping them back in a
+; different order, about 300,000 instructions. Each round swaps R0 and
+; R1, so an even number of rounds leaves them as they started.
+;
+; Expected output:
+; 1
+; 2
+
+    LDI R0,1
+    LDI R1,2
+    LDI R3,0        ; zero
+    LDI R4,250      ; outer counter
+
+Outer:
+    PUSH R4
+    LDI R4,100      ; inner counter
+
+Inner:
+    PUSH R0
+    PUSH R1
+    PUSH R4
+    POP R2
+    POP R0          ; R0 <- R1
+    POP R1          ; R1 <- R0
+    PUSH R2
+    POP R4
+    DEC R4
+    CMP R4,R3
+    LDI R2,Inner
+    JNE R2
+
+    POP R4
+    DEC R4
+    CMP R4,R3
+    LDI R2,Outer
+    JNE R2
+
+    PRN R0
+    PRN R1
+    HLT
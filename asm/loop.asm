@@ -0,0 +1,16 @@
+; loop.asm
+;
+; Count R0 up to 200 in a tight ADD/CMP/JNE loop, then print it.
+;
+; Expected output: 200
+
+    LDI R0,0
+    LDI R1,1
+    LDI R2,200
+    LDI R3,Loop
+Loop:
+    ADD R0,R1
+    CMP R0,R2
+    JNE R3
+    PRN R0
+    HLT
@@ -0,0 +1,31 @@
+"""
+The LS-8 emulator as a package, for embedding it in another program:
+
+    import ls8
+
+    cpu = ls8.CPU()
+    cpu.load_bytes([0b10000010, 0, 8, 0b01000111, 0, 0b00000001])
+    cpu.output = ls8.CaptureOutput()
+    result = cpu.run(max_steps=1000)
+    cpu.output.getvalue()       # "Print this: 8\n"
+
+or, for many short programs, take CPUs from a pool (see pool.py):
+
+    pool = ls8.CPUPool(4)
+    pool.run(program).output
+
+The modules in here import each other relative to the package; ls8.py,
+run as a script, loads this directory as the package first. The other
+tools with a command line are run as modules from the directory above,
+e.g. python3 -m ls8.differential.
+"""
+
+from .cpu import CPU, CPUFault, LoadError, RunResult, SnapshotError
+from .output import CaptureOutput, FileOutput, NullOutput, StreamOutput
+from .pool import CPUPool
+
+__all__ = [
+    "CPU", "CPUFault", "LoadError", "RunResult", "SnapshotError",
+    "CaptureOutput", "FileOutput", "NullOutput", "StreamOutput",
+    "CPUPool",
+]
@@ -0,0 +1,347 @@
+"""
+Batch CPU: many LS-8 machines stepped in lockstep with NumPy.
+
+Every lane is a full LS-8 with its own RAM, registers, PC, flags and running
+state, stored as rows of NumPy arrays:
+
+    ram      (N, 256) uint8
+    reg      (N, 8)   uint8
+    pc       (N,)     int64
+    flag     (N,)     uint8
+    running  (N,)     bool
+
+Each step fetches the instruction under every running lane's PC, then runs
+one vectorized handler per distinct opcode over just the lanes that are
+executing it. Lanes that branch differently simply end up at different PCs
+and are grouped by opcode again on the next step.
+
+Registers and RAM are uint8, so arithmetic wraps to 8 bits as LS8-spec.md
+requires. Interrupts aren't modelled: INT and IRET stop a lane like an
+unknown instruction.
+
+A lane faults where CPU.run would raise CPUFault: an unknown instruction,
+a register operand above R7, or a stack overflow or underflow. It stops
+with its PC on the instruction at fault, and faults[lane] holds that
+address and the CPUFault reason.
+"""
+
+import numpy as np
+
+from .cpu import (ADD, AND, CALL, CMP, DEC, DIV, HLT, IMMEDIATE, INC, JEQ, JGE,
+                  JGT, JLE, JLT, JMP, JNE, LD, LDI, MOD, MUL, NAMES, NOP, NOT,
+                  OR, POP, PRA, PRN, PUSH, RET, SHL, SHR, ST, STACK_TOP, SUB,
+                  XOR)
+from .opcodes import instruction_length, operand_count
+
+
+class BatchCPU:
+    """N LS-8 CPUs run in lockstep."""
+
+    def __init__(self, n):
+        """
+        Construct `n` CPUs in their power on state.
+        """
+        self.n = n
+
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+
+        # R7 is reserved as the stack pointer (SP)
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.reg[:, 7] = 0xf4
+        self.sp = 7
+        # the stack may grow down to here and no further, as CPU.stack_limit
+        self.stack_limit = 0
+
+        self.pc = np.zeros(n, dtype=np.int64)
+        self.flag = np.zeros(n, dtype=np.uint8)
+        self.running = np.ones(n, dtype=bool)
+
+        # text printed by PRN and PRA, one list of strings per lane
+        self.output = [[] for _ in range(n)]
+
+        # (address, reason) of the fault that stopped a lane
+        self.faults = {}
+
+        self.branch_table = {
+            LDI: self.ldi_fun,
+            NOP: self.nop_fun,
+            LD: self.ld_fun,
+            ST: self.st_fun,
+            PRN: self.prn_fun,
+            PRA: self.pra_fun,
+            HLT: self.hlt_fun,
+            ADD: self.alu_fun(lambda x, y: x + y),
+            SUB: self.alu_fun(lambda x, y: x - y),
+            MUL: self.alu_fun(lambda x, y: x * y),
+            DIV: self.divide_fun(np.floor_divide),
+            MOD: self.divide_fun(np.remainder),
+            INC: self.alu1_fun(lambda x: x + np.uint8(1)),
+            DEC: self.alu1_fun(lambda x: x - np.uint8(1)),
+            CMP: self.cmp_fun,
+            AND: self.alu_fun(lambda x, y: x & y),
+            NOT: self.alu1_fun(lambda x: ~x),
+            OR: self.alu_fun(lambda x, y: x | y),
+            XOR: self.alu_fun(lambda x, y: x ^ y),
+            SHL: self.alu_fun(self.shl),
+            SHR: self.alu_fun(self.shr),
+            PUSH: self.push_fun,
+            POP: self.pop_fun,
+            CALL: self.call_fun,
+            RET: self.ret_fun,
+            JMP: self.jmp_fun,
+            JEQ: self.jump_if_fun(lambda flag: flag & 0b00000001),
+            JNE: self.jump_if_fun(lambda flag: ~flag & 0b00000001),
+            JGT: self.jump_if_fun(lambda flag: flag & 0b00000010),
+            JGE: self.jump_if_fun(lambda flag: flag & 0b00000011),
+            JLT: self.jump_if_fun(lambda flag: flag & 0b00000100),
+            JLE: self.jump_if_fun(lambda flag: flag & 0b00000101),
+        }
+
+    def load(self, filename):
+        """Load a program into memory of every lane."""
+        program = []
+
+        with open(filename) as f:
+            for line in f:
+                num_str = line.split('#')[0].strip()
+                if num_str == "":
+                    continue
+                program.append(int(num_str, 2))
+
+        self.load_program(program)
+
+    def load_program(self, program):
+        """Copy a list of bytes into memory of every lane, from address 0."""
+        self.ram[:, :len(program)] = program
+        # as CPU.load_bytes, the stack can't grow down into the program
+        self.stack_limit = len(program)
+
+    def fault(self, lanes, reasons):
+        """
+        Stop `lanes`, each with its reason, leaving their PC where it is.
+        """
+        for lane, reason in zip(lanes.tolist(), reasons):
+            self.faults[lane] = (int(self.pc[lane]), reason)
+        self.running[lanes] = False
+
+    def stack_fault(self, lanes, bad, reason, length):
+        """
+        Fault the lanes where `bad` is set with `reason`, and return the
+        rest and `bad`. Their PC has been moved past the `length` byte
+        instruction, it goes back onto it as CPU.run leaves it.
+        """
+        failed = lanes[bad]
+        if len(failed):
+            self.pc[failed] = (self.pc[failed] - length) & 0xff
+            self.fault(failed, [reason] * len(failed))
+        return lanes[~bad], bad
+
+    # Every handler gets the indices of the lanes executing it and the
+    # operand bytes for those lanes. The PC of those lanes has already been
+    # moved past the instruction.
+
+    def ldi_fun(self, lanes, reg_a, reg_b):
+        self.reg[lanes, reg_a] = reg_b
+
+    def nop_fun(self, lanes, reg_a, reg_b):
+        pass
+
+    def ld_fun(self, lanes, reg_a, reg_b):
+        self.reg[lanes, reg_a] = self.ram[lanes, self.reg[lanes, reg_b]]
+
+    def st_fun(self, lanes, reg_a, reg_b):
+        self.ram[lanes, self.reg[lanes, reg_a]] = self.reg[lanes, reg_b]
+
+    def prn_fun(self, lanes, reg_a, reg_b):
+        values = self.reg[lanes, reg_a]
+        for lane, v in zip(lanes.tolist(), values.tolist()):
+            self.output[lane].append(f'Print this: {v}\n')
+
+    def pra_fun(self, lanes, reg_a, reg_b):
+        values = self.reg[lanes, reg_a]
+        for lane, v in zip(lanes.tolist(), values.tolist()):
+            self.output[lane].append(chr(v))
+
+    def hlt_fun(self, lanes, reg_a, reg_b):
+        self.running[lanes] = False
+
+    def alu_fun(self, f):
+        """
+        Return a handler for an ALU operation that stores f(register a,
+        register b) in register a. The uint8 arrays wrap the result.
+        """
+
+        def handler(lanes, reg_a, reg_b):
+            self.reg[lanes, reg_a] = f(self.reg[lanes, reg_a],
+                                       self.reg[lanes, reg_b])
+
+        return handler
+
+    def alu1_fun(self, f):
+        """
+        Return a handler for a one operand ALU operation that stores
+        f(register a) in register a.
+        """
+
+        def handler(lanes, reg_a, reg_b):
+            self.reg[lanes, reg_a] = f(self.reg[lanes, reg_a])
+
+        return handler
+
+    @staticmethod
+    def shl(x, y):
+        # shifting a uint8 by 8 or more isn't defined, widen it first
+        return (x.astype(np.int64) << np.minimum(y, 8)) & 0xff
+
+    @staticmethod
+    def shr(x, y):
+        return x.astype(np.int64) >> np.minimum(y, 8)
+
+    def divide_fun(self, f):
+        """
+        Return a handler for DIV or MOD. Lanes dividing by zero print an
+        error message and halt, like CPU.alu_div.
+        """
+
+        def handler(lanes, reg_a, reg_b):
+            x = self.reg[lanes, reg_a]
+            y = self.reg[lanes, reg_b]
+            zero = y == 0
+
+            for lane in lanes[zero].tolist():
+                self.output[lane].append('Division by zero\n')
+            self.running[lanes[zero]] = False
+
+            ok = ~zero
+            self.reg[lanes[ok], reg_a[ok]] = f(x[ok], y[ok])
+
+        return handler
+
+    def overflow(self, lanes):
+        """Lanes where pushing would go past the stack limit or wrap."""
+        sp = (self.reg[lanes, self.sp].astype(np.int64) - 1) & 0xff
+        return (sp < self.stack_limit) | (sp >= STACK_TOP)
+
+    def underflow(self, lanes):
+        """Lanes where popping would take from an empty stack."""
+        return self.reg[lanes, self.sp] >= STACK_TOP
+
+    def push_fun(self, lanes, reg_a, reg_b):
+        lanes, bad = self.stack_fault(lanes, self.overflow(lanes),
+                                      "stack overflow", 2)
+        reg_a = reg_a[~bad]
+        sp = self.reg[lanes, self.sp] - np.uint8(1)
+        self.reg[lanes, self.sp] = sp
+        self.ram[lanes, sp] = self.reg[lanes, reg_a]
+
+    def pop_fun(self, lanes, reg_a, reg_b):
+        lanes, bad = self.stack_fault(lanes, self.underflow(lanes),
+                                      "stack underflow", 2)
+        reg_a = reg_a[~bad]
+        self.reg[lanes, reg_a] = self.ram[lanes, self.reg[lanes, self.sp]]
+        self.reg[lanes, self.sp] += np.uint8(1)
+
+    def call_fun(self, lanes, reg_a, reg_b):
+        lanes, bad = self.stack_fault(lanes, self.overflow(lanes),
+                                      "stack overflow", 2)
+        reg_a = reg_a[~bad]
+        sp = self.reg[lanes, self.sp] - np.uint8(1)
+        self.reg[lanes, self.sp] = sp
+        # the PC already points at the instruction after CALL
+        self.ram[lanes, sp] = self.pc[lanes]
+        self.pc[lanes] = self.reg[lanes, reg_a]
+
+    def ret_fun(self, lanes, reg_a, reg_b):
+        lanes, bad = self.stack_fault(lanes, self.underflow(lanes),
+                                      "stack underflow", 1)
+        self.pc[lanes] = self.ram[lanes, self.reg[lanes, self.sp]]
+        self.reg[lanes, self.sp] += np.uint8(1)
+
+    def cmp_fun(self, lanes, reg_a, reg_b):
+        a = self.reg[lanes, reg_a]
+        b = self.reg[lanes, reg_b]
+        # E = 1, G = 2, L = 4, as in CPU.alu_cmp
+        self.flag[lanes] = np.where(a == b, 0b00000001,
+                                    np.where(a < b, 0b00000100, 0b00000010))
+
+    def jmp_fun(self, lanes, reg_a, reg_b):
+        self.pc[lanes] = self.reg[lanes, reg_a]
+
+    def jump_if_fun(self, test):
+        """
+        Return a handler for a conditional jump, taken in the lanes where
+        test(flags) is non-zero.
+        """
+
+        def handler(lanes, reg_a, reg_b):
+            taken = test(self.flag[lanes]) != 0
+            self.pc[lanes] = np.where(taken, self.reg[lanes, reg_a],
+                                      self.pc[lanes])
+
+        return handler
+
+    def step(self):
+        """
+        Execute one instruction on every running lane. Returns the number of
+        lanes that executed.
+        """
+        lanes = np.flatnonzero(self.running)
+        if len(lanes) == 0:
+            return 0
+
+        pc = self.pc[lanes]
+        ir = self.ram[lanes, pc]
+        reg_a = self.ram[lanes, (pc + 1) & 0xff]
+        reg_b = self.ram[lanes, (pc + 2) & 0xff]
+
+        for op in np.unique(ir).tolist():
+            sel = ir == op
+            group = lanes[sel]
+            handler = self.branch_table.get(op)
+
+            if handler is None:
+                # stop just these lanes, the rest carry on
+                self.fault(group, [f"unknown instruction {op:08b}"] *
+                           len(group))
+                continue
+
+            a = reg_a[sel]
+            b = reg_b[sel]
+
+            # Every operand names a register, except LDI's immediate value,
+            # as CPU.check_instruction
+            operands = operand_count(op)
+            bad = np.zeros(len(group), dtype=bool)
+            if operands > 0:
+                bad |= a > 7
+            if operands > 1 and op not in IMMEDIATE:
+                bad |= b > 7
+
+            if bad.any():
+                self.fault(group[bad], [
+                    f"invalid register in {NAMES[op]} {x},{y}"
+                    for x, y in zip(a[bad].tolist(), b[bad].tolist())])
+                ok = ~bad
+                group, a, b = group[ok], a[ok], b[ok]
+                if not len(group):
+                    continue
+
+            # advance past the instruction, then execute it
+            length = instruction_length(op)
+            self.pc[group] = (self.pc[group] + length) & 0xff
+            handler(group, a, b)
+
+        return len(lanes)
+
+    def run(self, max_steps=None):
+        """
+        Run until every lane has halted or faulted, or for at most
+        `max_steps` steps. Returns the number of steps taken.
+        """
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+
+        return steps
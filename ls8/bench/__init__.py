@@ -0,0 +1,20 @@
+"""
+Benchmark suite for the LS-8 emulator.
+
+Usage, from the directory above ls8: python3 -m ls8.bench [options]
+
+The workloads are the examples/bench_*.ls8 programs, built from
+../asm/bench_*.asm:
+
+    bench_alu      tight ALU loop
+    bench_call     CALL/RET heavy recursion
+    bench_stack    PUSH/POP churn
+    bench_branch   CMP and conditional jumps, taken at different rates
+    bench_print    PRN/PRA heavy output
+
+Each one is timed with every CPU run loop after some warmup runs, and the
+harness reports instructions per second, nanoseconds per dispatched
+instruction and the memory one CPU holds after running the workload. Results
+can be written out as JSON, and are compared against the stored baseline
+(bench/baseline.json) to flag regressions. See harness.py.
+"""
@@ -0,0 +1,259 @@
+"""
+Instructions-per-second harness.
+
+For every workload and run loop:
+
+* the instruction count comes from one CPU.run(), which returns it; every
+  run loop executes the same instructions
+* the workload is run `warmup` times untimed, then `repeat` times timed,
+  each on a fresh CPU, and the best time is kept
+* memory is what tracemalloc sees still allocated after constructing and
+  running MEMORY_CPUS CPUs, divided by that count, so it includes the decoded
+  instruction cache and translated blocks
+
+Results are JSON:
+
+    {"python": "3.12.1", "machine": "x86_64",
+     "results": {"bench_alu": {"steps": 154106,
+                               "run": {"seconds": ..., "median": ...,
+                                       "ips": ..., "ns_per_dispatch": ...,
+                                       "bytes_per_cpu": ...},
+                               ...}}}
+
+A run loop is flagged as a regression when its instructions per second drop
+below the baseline by more than the threshold (10% by default). Numbers from
+another Python version or machine aren't comparable, so against a baseline
+recorded on one the comparison is skipped with a warning, unless --force.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from ..cpu import CPU
+from ..output import CaptureOutput, NullOutput
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, "..", "examples")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+WORKLOADS = ["bench_alu", "bench_call", "bench_stack", "bench_branch",
+             "bench_print"]
+METHODS = ["run", "run_translated", "run_reference"]
+
+# CPUs kept alive at once to measure memory per CPU
+MEMORY_CPUS = 5
+
+
+def load_workload(name):
+    """Return the RAM image of a workload, as bytes."""
+    cpu = CPU()
+    cpu.load(os.path.join(EXAMPLES, name + ".ls8"))
+    return bytes(cpu.ram)
+
+
+def fresh_cpu(ram, output):
+    cpu = CPU()
+    cpu.ram[:] = ram
+    cpu.output = output
+    return cpu
+
+
+def count_steps(ram):
+    """Number of instructions the workload executes."""
+    return fresh_cpu(ram, NullOutput()).run().steps
+
+
+def time_workload(ram, method, warmup, repeat):
+    """Return (best, median) seconds for one run of `ram` with `method`."""
+
+    def once():
+        # capture rather than discard, so printing is part of the cost
+        cpu = fresh_cpu(ram, CaptureOutput())
+        start = time.perf_counter()
+        getattr(cpu, method)()
+        return time.perf_counter() - start
+
+    for _ in range(warmup):
+        once()
+
+    times = [once() for _ in range(repeat)]
+
+    return min(times), statistics.median(times)
+
+
+def memory_per_cpu(ram, method):
+    """Bytes still allocated per CPU after running the workload."""
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    cpus = []
+    for _ in range(MEMORY_CPUS):
+        cpu = fresh_cpu(ram, NullOutput())
+        getattr(cpu, method)()
+        cpus.append(cpu)
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return (after - before) // MEMORY_CPUS
+
+
+def measure(workloads, methods, warmup, repeat):
+    """Run the benchmarks and return the results dictionary."""
+
+    results = {}
+
+    for name in workloads:
+        ram = load_workload(name)
+        steps = count_steps(ram)
+        results[name] = {"steps": steps}
+
+        for method in methods:
+            best, median = time_workload(ram, method, warmup, repeat)
+            results[name][method] = {
+                "seconds": best,
+                "median": median,
+                "ips": steps / best,
+                "ns_per_dispatch": best / steps * 1e9,
+                "bytes_per_cpu": memory_per_cpu(ram, method),
+            }
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def mismatch(results, baseline):
+    """
+    Describe how the Python version and machine the results and the
+    baseline came from differ, None if they don't.
+    """
+
+    differences = []
+
+    for key in ("python", "machine"):
+        if results.get(key) != baseline.get(key):
+            differences.append(f"{key} {baseline.get(key)} in the baseline, "
+                               f"{results.get(key)} here")
+
+    return "; ".join(differences) or None
+
+
+def compare(results, baseline, threshold):
+    """
+    Return {(workload, method): ratio} of instructions per second against
+    the baseline, and the list of (workload, method) pairs that regressed.
+    """
+
+    ratios = {}
+    regressions = []
+
+    for name, measured in results["results"].items():
+        base = baseline["results"].get(name, {})
+
+        for method, numbers in measured.items():
+            if method == "steps" or method not in base:
+                continue
+
+            ratio = numbers["ips"] / base[method]["ips"]
+            ratios[name, method] = ratio
+            if ratio < 1 - threshold:
+                regressions.append((name, method))
+
+    return ratios, regressions
+
+
+def report(results, ratios, regressions):
+    print(f"{'workload':<14} {'method':<16} {'steps':>8} {'MIPS':>7} "
+          f"{'ns/dispatch':>12} {'bytes/cpu':>10} {'vs base':>8}")
+
+    for name, measured in results["results"].items():
+        for method, numbers in measured.items():
+            if method == "steps":
+                continue
+
+            ratio = ratios.get((name, method))
+            if ratio is None:
+                versus = ""
+            else:
+                versus = f"{ratio:.2f}x"
+                if (name, method) in regressions:
+                    versus += " REGRESSED"
+
+            print(f"{name:<14} {method:<16} {measured['steps']:>8} "
+                  f"{numbers['ips'] / 1e6:>7.3f} "
+                  f"{numbers['ns_per_dispatch']:>12.1f} "
+                  f"{numbers['bytes_per_cpu']:>10} {versus}")
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m ls8.bench",
+        description="Benchmark the LS-8 emulator's run loops.")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workloads (default all)")
+    parser.add_argument("--methods", default=",".join(METHODS),
+                        help="comma separated CPU run methods (default all)")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed runs first (default 1)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed runs, the best is kept (default 5)")
+    parser.add_argument("--json",
+                        help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="baseline JSON to compare against "
+                             "(default bench/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown flagged as a regression (default 0.10)")
+    parser.add_argument("--force", action="store_true",
+                        help="compare against a baseline from another Python "
+                             "version or machine anyway")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    results = measure(args.workloads.split(","), args.methods.split(","),
+                      args.warmup, args.repeat)
+
+    ratios, regressions = {}, []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        different = mismatch(results, baseline)
+        if different is None or args.force:
+            ratios, regressions = compare(results, baseline, args.threshold)
+        else:
+            print(f"warning: not comparing against {args.baseline}, "
+                  f"{different} (--force to compare anyway)",
+                  file=sys.stderr)
+
+    report(results, ratios, regressions)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+        return 1
+
+    return 0
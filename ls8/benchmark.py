@@ -0,0 +1,88 @@
+"""
+Time the example programs with the reference run loop, the cached one and
+the basic-block translator.
+
+Usage, from the directory above ls8:
+
+    python3 -m ls8.benchmark [program.ls8 ...]
+
+With no arguments every example in examples/ that halts on its own is timed,
+except the long bench_* workloads, which are for the bench package
+(python3 -m ls8.bench).
+"""
+
+import glob
+import os
+import sys
+import timeit
+
+from .cpu import CPU
+from .output import NullOutput
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# These examples never halt (they spin waiting for interrupts, or push
+# until the stack runs over the program), so they can't be timed.
+SKIP = {"interrupts.ls8", "keyboard.ls8", "stackoverflow.ls8"}
+
+
+def time_program(filename, method, repeat=5, number=200):
+    """
+    Return the best time in seconds for one run of `filename` with the
+    given CPU run method ("run", "run_translated" or "run_reference").
+    """
+
+    # Load once, then copy the RAM into each fresh CPU so file parsing
+    # stays out of the timing
+    loaded = CPU()
+    loaded.load(filename)
+
+    def once():
+        cpu = CPU()
+        cpu.ram[:] = loaded.ram
+        # the examples print, keep that out of the terminal and the timing
+        cpu.output = NullOutput()
+        getattr(cpu, method)()
+
+    times = timeit.repeat(once, repeat=repeat, number=number)
+
+    return min(times) / number
+
+
+def main(argv):
+    if len(argv) > 1:
+        programs = argv[1:]
+    else:
+        programs = sorted(
+            p for p in glob.glob(os.path.join(HERE, "examples", "*.ls8"))
+            if os.path.basename(p) not in SKIP
+            and not os.path.basename(p).startswith("bench_")
+        )
+
+    print(f"{'program':<24} {'reference':>12} {'cached':>12} {'speedup':>8}"
+          f" {'translated':>12} {'speedup':>8}")
+
+    for p in programs:
+        cpu = CPU()
+        cpu.load(p)
+        cpu.output = NullOutput()
+        result = cpu.run()
+        if result.status == "fault":
+            # nothing to time, say why it stopped
+            print(f"{os.path.basename(p):<24} fault at {result.pc:02X}: "
+                  f"{result.reason}")
+            continue
+
+        before = time_program(p, "run_reference")
+        after = time_program(p, "run")
+        translated = time_program(p, "run_translated")
+
+        print(f"{os.path.basename(p):<24} {before * 1e6:>10.1f}us "
+              f"{after * 1e6:>10.1f}us {before / after:>7.2f}x "
+              f"{translated * 1e6:>10.1f}us {before / translated:>7.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
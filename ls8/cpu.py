@@ -31,21 +31,111 @@ To run test for sprint:
 '''
 
 
-import sys
-LDI = 0b10000010  # LDI R0,8
-PRN = 0b01000111  # PRN R0
-HLT = 0b00000001  # HLT
-MUL = 0b10100010  # MUL R0,R1
-PUSH = 0b01000101  # PUSH R0
-POP = 0b01000110  # POP R0
-CALL = 0b01010000  # CALL R1
-RET = 0b00010001  # RET
-ADD = 0b10100000  # ADD
-# sprint
-CMP = 0b10100111  # CMP
-JEQ = 0b01010101  # JEQ
-JMP = 0b01010100  # JMP
-JNE = 0b01010110  # JNE
+import collections
+import importlib.util
+import os
+import struct
+import time
+
+from .devices import EXTENDED_SIZE, attach_extended_memory
+from .image import ImageError, read_image
+from .output import StreamOutput
+# The opcode constants (LDI, PRN, HLT, ...) and the table of them shared with
+# the assembler
+from .opcodes import *  # noqa: F401,F403
+from .opcodes import (IMMEDIATE, NAMES, OPCODES, alu_op, instruction_length,
+                      is_alu, operand_count)
+
+# Where the assembler (asm.py) lives, for loading .asm source
+ASM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "asm")
+
+# asm.py once load_assembler() has loaded it
+assembler = None
+
+
+def load_assembler():
+    """
+    Return the assembler module, asm.py from ASM_DIR, loading it the first
+    time. It's loaded from its file rather than imported, so ASM_DIR never
+    goes on sys.path where its modules could shadow others.
+    """
+    global assembler
+
+    if assembler is None:
+        spec = importlib.util.spec_from_file_location(
+            "asm", os.path.join(ASM_DIR, "asm.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        assembler = module
+
+    return assembler
+
+# Number of instructions CPU.run executes between checks of its step budget
+# and polls for interrupts
+RUN_CHUNK = 1024
+
+# Interrupt vector table, I0 at F8 up to I7 at FF
+VECTOR_TABLE = 0xf8
+
+# Where the stack starts, and the highest SP can go: popping past it reads
+# the keyboard byte and the vector table
+STACK_TOP = 0xf4
+
+# Seconds between timer interrupts (I0)
+TIMER_INTERVAL = 1.0
+
+# CPU.snapshot() blob: magic b"LS8S", version, PC, FL, running, interrupts
+# enabled, seconds until the next timer interrupt (NaN before the timer has
+# started), instructions executed, the stack limit, then the 8 registers and
+# 256 bytes of RAM
+SNAPSHOT_MAGIC = b"LS8S"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("<4sBBBBBdQB")
+SNAPSHOT_SIZE = SNAPSHOT_HEADER.size + 8 + 256
+
+
+class LoadError(Exception):
+    """A program couldn't be loaded into memory."""
+
+
+class SnapshotError(ValueError):
+    """A blob passed to CPU.restore() isn't a snapshot."""
+
+
+class CPUFault(Exception):
+    """
+    The program did something the CPU can't carry on from: an unknown
+    instruction, a register operand above R7, or a stack overflow or
+    underflow. `pc` is the address of the instruction at fault, filled in by
+    the run loop when the handler raising it doesn't know it.
+    """
+
+    def __init__(self, reason, pc=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.pc = pc
+
+
+class RunResult:
+    """
+    What a run loop stopped for. `status` is one of:
+
+    * "halted"       the program ran HLT (or divided by zero)
+    * "step_budget"  it ran max_steps instructions without halting
+    * "time_budget"  it ran for max_seconds without halting
+    * "fault"        see `reason`, and `pc` for the instruction at fault
+    """
+
+    def __init__(self, status, steps, pc, reason=None):
+        self.status = status
+        self.steps = steps
+        self.pc = pc
+        self.reason = reason
+
+    def __repr__(self):
+        return (f"RunResult({self.status!r}, steps={self.steps}, "
+                f"pc={self.pc}, reason={self.reason!r})")
 
 
 class CPU:
@@ -55,14 +145,15 @@ class CPU:
         """
         Construct a new CPU.
         """
-        # Add list properties to the CPU class to hold 256 bytes of memory
-        self.ram = [0] * 256
+        # 256 bytes of memory and 8 general-purpose registers. Both are
+        # bytearrays, so they only ever hold 0-255 and every value stored in
+        # them has to be masked with 0xFF first.
+        self.ram = bytearray(256)
 
-        # and 8 general-purpose registers.
         # R5 is reserved as the interrupt mask (IM)
         # R6 is reserved as the interrupt status (IS)
         # R7 is reserved as the stack pointer (SP)
-        self.reg = [0] * 8
+        self.reg = bytearray(8)
         self.reg[7] = 0xf4
 
         # The SP points at the value at the top of the stack (most recently pushed),
@@ -81,41 +172,270 @@ class CPU:
         # is pc on
         self.running = True
 
-        self.branch_table = {
-            LDI: self.ldi_fun,
-            PRN: self.prn_fun,
-            HLT: self.hlt_fun,
-            MUL: self.mul_fun,
-            PUSH: self.push_fun,
-            POP: self.pop_fun,
-            CALL: self.call_fun,
-            RET: self.ret_fun,
-            ADD: self.add_fun,
-            # sprint
-            CMP: self.cmp_fun,
-            JEQ: self.jeq_fun,
-            JMP: self.jmp_fun,
-            JNE: self.jne_fun
-        }
+        # label -> address, from a binary image's symbol table or the
+        # assembler
+        self.symbols = {}
+
+        # address -> (line number, source text), for programs loaded from
+        # assembler source
+        self.lines = {}
+
+        # Interrupts are disabled while one is being serviced, between the
+        # handler being called and its IRET
+        self.interrupts_enabled = True
+
+        # When the next timer interrupt is due, by time.monotonic(). The
+        # timer starts with the first poll.
+        self.next_timer = None
+
+        # Keyboard input source (see keyboard.py), None for no keyboard
+        self.keyboard = None
+
+        # Instructions run() has executed since power on, brought up to
+        # date every time it polls for interrupts and when it returns
+        self.executed = 0
+
+        # A replay.Recorder or Replayer that takes over polling for
+        # interrupts, None to poll the keyboard and timer as usual
+        self.inputs = None
+
+        # Where PRN and PRA print to (see output.py)
+        self.output = StreamOutput()
+
+        # Memory-mapped devices (see devices.py). io_map is the page kind
+        # of every address: 0 for plain RAM, otherwise the index in
+        # `devices` of the device mapped there. LD and ST look it up, so
+        # plain RAM costs them one index and a test.
+        self.io_map = bytearray(256)
+        self.devices = [None]
+
+        # Banked memory beyond the 256 bytes (see devices.py), None until
+        # attach_extended_memory() or a program with banks attaches it
+        self.extended = None
+
+        # Lowest address the stack may grow down to, the end of the loaded
+        # program; pushing below it would overwrite the program
+        self.stack_limit = 0
+
+        # Lowest stack limit any program gets, raised by devices mapped
+        # where the stack would otherwise grow into them (see
+        # devices.attach_extended_memory)
+        self.stack_floor = 0
+
+        # Decoded instruction cache, keyed by the address of the opcode.
+        # Each entry is (bound handler, operand a, operand b, length) so the
+        # run loop only has to fetch and decode an instruction the first
+        # time it executes.
+        self.decoded = {}
+
+        # Translated basic blocks for run_translated(), keyed by entry PC
+        self.blocks = {}
+
+        # One byte per RAM address, non-zero if that address holds an opcode
+        # or operand of a cached instruction. Writes check it so programs
+        # that modify their own code drop the stale decodes.
+        self.code_map = bytearray(256)
+
+        # ALU operations, indexed by the `DDDD` bits of the opcode
+        self.alu_table = [None] * 16
+
+        # opcode -> handler, built from the shared opcode table. ALU
+        # instructions go straight to their ALU operation, everything else
+        # to the <name>_fun method.
+        self.branch_table = {}
+
+        for name, op in OPCODES.items():
+            if is_alu(op):
+                handler = getattr(self, "alu_" + name.lower())
+                self.alu_table[alu_op(op)] = handler
+            else:
+                handler = getattr(self, name.lower() + "_fun")
+
+            self.branch_table[op] = handler
 
     # mar == Memory Address Register, holds the memory address we're reading or writing
     # mdr == Memory Data Register, holds the value to write or the value just read
     # ram_read() should accept the address to read and return the value stored there.
     def ram_read(self, mar):
+        # a device mapped at MAR answers instead of memory
+        kind = self.io_map[mar]
+        if kind:
+            return self.devices[kind].read(mar) & 0xff
         # current index of MAR
         return self.ram[mar]
 
     # ram_write() should accept a value to write, and the address to write it to
     def ram_write(self, mar, mdr):
+        kind = self.io_map[mar]
+        if kind:
+            self.devices[kind].write(mar, mdr & 0xff)
+            return
         # mdr value at MAR
-        self.ram[mar] = mdr
+        self.ram[mar] = mdr & 0xff
+        # writing over cached code has to throw the old decode away
+        if self.code_map[mar]:
+            self.invalidate(mar)
+
+    def attach(self, device, start, end=None):
+        """
+        Map `device` (see devices.Device) at addresses `start` to `end`
+        inclusive, or just `start`. LD and ST at those addresses go to the
+        device instead of RAM; the stack, instruction fetch and the
+        interrupt vectors always use RAM. Raises ValueError if a device is
+        already mapped there.
+        """
+        if end is None:
+            end = start
+
+        if not 0 <= start <= end < len(self.io_map):
+            raise ValueError(f"can't map a device at {start:02X}-{end:02X}")
+
+        if any(self.io_map[start:end + 1]):
+            raise ValueError(f"a device is already mapped in "
+                             f"{start:02X}-{end:02X}")
+
+        if len(self.devices) == 256:
+            raise ValueError("too many devices")
+
+        self.devices.append(device)
+        self.io_map[start:end + 1] = bytes([len(self.devices) - 1]) * \
+            (end - start + 1)
+        device.attached(self, start, end)
+
+        # translated LD and ST only check io_map when there are devices
+        self.invalidate(0)
+
+    def extended_memory(self, size=0):
+        """
+        Return the extended memory (devices.BankedMemory), attaching
+        EXTENDED_SIZE bytes of it, or `size` if that's more, if there isn't
+        any yet. Raises LoadError if it can't be attached, or what's
+        attached is smaller than `size`.
+        """
+        if self.extended is None:
+            try:
+                attach_extended_memory(self, size=max(size, EXTENDED_SIZE))
+            except ValueError as e:
+                raise LoadError(f"can't attach extended memory: {e}") \
+                    from None
+
+        if len(self.extended.memory) < size:
+            raise LoadError(f"program needs {size} bytes of extended memory, "
+                            f"there are {len(self.extended.memory)}")
+
+        return self.extended
+
+    def detach(self, device):
+        """Unmap `device`, its addresses go back to being RAM."""
+        kind = self.devices.index(device)
+
+        for addr, k in enumerate(self.io_map):
+            if k == kind:
+                self.io_map[addr] = 0
+
+        # keep the other devices' indexes in io_map right
+        self.devices[kind] = None
+        self.invalidate(0)
+
+    def detach_all(self):
+        """
+        Unmap every device, extended memory included, so all 256 addresses
+        are RAM again.
+        """
+        self.io_map[:] = bytes(len(self.io_map))
+        del self.devices[1:]
+        self.extended = None
+        self.stack_floor = 0
+        self.invalidate(0)
+
+    def ram_view(self):
+        """
+        Return a read-only memoryview of RAM. It doesn't copy anything, so
+        it always shows the current contents.
+        """
+        return memoryview(self.ram).toreadonly()
+
+    def ram_snapshot(self):
+        """Return a copy of RAM as it is now, as bytes."""
+        return bytes(self.ram)
+
+    def invalidate(self, mar):
+        """
+        Drop the decoded instruction and translated block caches after a
+        write to address `mar` landed on code. Self-modifying programs are
+        rare, so rather than work out which entries overlap `mar` the whole
+        cache is cleared.
+        """
+        self.decoded.clear()
+        self.blocks.clear()
+        # clear in place, the run loop holds a reference to these
+        self.code_map[:] = bytes(len(self.code_map))
+
+    def check_instruction(self, pc, ir, reg_a, reg_b):
+        """
+        Raise CPUFault if `ir` isn't an instruction, or names a register
+        that doesn't exist.
+        """
+        if ir not in self.branch_table:
+            raise CPUFault(f"unknown instruction {ir:08b}", pc)
+
+        # Every operand names a register, except LDI's immediate value
+        operands = operand_count(ir)
+        if (operands > 0 and reg_a > 7) or \
+                (operands > 1 and reg_b > 7 and ir not in IMMEDIATE):
+            raise CPUFault(f"invalid register in {NAMES[ir]} "
+                           f"{reg_a},{reg_b}", pc)
+
+    def decode(self, pc):
+        """
+        Decode the instruction at `pc` and store it in the decoded cache.
+        """
+        ram = self.ram
+        ir = ram[pc]
+        reg_a = ram[(pc + 1) & 0xff]
+        reg_b = ram[(pc + 2) & 0xff]
+
+        self.check_instruction(pc, ir, reg_a, reg_b)
+
+        # The top two bits `AA` of the opcode hold the number of operands,
+        # and the instruction is that many bytes plus one for the opcode.
+        length = instruction_length(ir)
+
+        entry = (self.branch_table[ir], reg_a, reg_b, length)
+        self.decoded[pc] = entry
+
+        # remember which bytes this decode was made from
+        code_map = self.code_map
+        code_map[pc] = 1
+        if length > 1:
+            code_map[(pc + 1) & 0xff] = 1
+            if length > 2:
+                code_map[(pc + 2) & 0xff] = 1
+
+        return entry
 
     def load(self, filename):
-        """Load a program into memory."""
+        """
+        Load a program into memory. Files ending in .ls8b are loaded as
+        binary images, .asm as assembler source, anything else as text
+        .ls8. Raises LoadError if the program can't be loaded.
+        """
+        if filename.endswith(".ls8b"):
+            self.load_image(filename)
+            return
+
+        if filename.endswith(".asm"):
+            try:
+                with open(filename) as f:
+                    self.load_source(f, filename)
+            except OSError as e:
+                raise LoadError(f"{filename}: {e.strerror}") from e
+            return
+
         try:
             with open(filename) as f:
                 address = 0
-                for line in f:
+                for line_num, line in enumerate(f, 1):
                     # get rid of comments in programs
                     line = line.split('#')
                     num_str = line[0].strip()
@@ -127,170 +447,739 @@ class CPU:
                     self.ram[address] = v
                     address += 1
 
-        except FileNotFoundError:
-            sys.exit(2)
+        except OSError as e:
+            raise LoadError(f"{filename}: {e.strerror}") from e
+        except ValueError:
+            # int() failed, or the value doesn't fit in a byte
+            raise LoadError(f"{filename}: line {line_num}: "
+                            f"not an 8-bit binary number: {num_str}") \
+                from None
+        except IndexError:
+            raise LoadError(f"{filename}: program is too big for memory") \
+                from None
 
-    def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
-
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        elif op == "SUB":
-            self.reg[reg_a] -= self.reg[reg_b]
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == "DIV":
-            self.reg[reg_a] /= self.reg[reg_b]
-
-        elif op == "CMP":
-            # If they are equal, set the Equal `E` flag to 1, otherwise set it to 0.
-            if self.reg[reg_a] == self.reg[reg_b]:
-                self.flag = 0b00000001  # HLT
-            # If registerA is less than registerB, set the Less-than `L` flag to 1,
-            # otherwise set it to 0.
-            elif self.reg[reg_a] < self.reg[reg_b]:
-                self.flag = 0b00000100
-            #  If registerA is greater than registerB, set the Greater-than `G` flag
-            # to 1, otherwise set it to 0
-            elif self.reg[reg_a] > self.reg[reg_b]:
-                self.flag = 0b00000010
+        self.stack_limit = max(address, self.stack_floor)
+
+        # anything decoded before is for a different program now
+        self.invalidate(0)
+
+    def load_image(self, filename):
+        """
+        Load a binary .ls8b image (see image.py) into memory, mapping the
+        file and copying its code straight into RAM. The PC is set to the
+        image's entry point and its symbol table kept in self.symbols.
+        Banks go into extended memory, which is attached if need be.
+        Raises LoadError if the image can't be loaded.
+        """
+        try:
+            image = read_image(filename, self.ram, self.extended_memory)
+        except OSError as e:
+            raise LoadError(f"{filename}: {e.strerror}") from e
+        except ImageError as e:
+            raise LoadError(f"{filename}: {e}") from e
+        except LoadError as e:
+            # from extended_memory(), without the file name
+            raise LoadError(f"{filename}: {e}") from None
+
+        self.pc = image.entry
+        self.symbols = image.symbols
+        self.stack_limit = max(image.load_address + len(image.code),
+                               self.stack_floor)
+
+        # anything decoded before is for a different program now
+        self.invalidate(0)
+
+    def load_source(self, source, name="<source>"):
+        """
+        Assemble LS-8 assembler source, an iterable of lines such as an
+        open file, and load it into memory, without going through a .ls8
+        file. The labels are kept in self.symbols and the source line of
+        each address in self.lines. Banks go into extended memory, as for
+        load_image(). Raises LoadError with every error the assembler
+        found, each prefixed with `name`.
+        """
+        asm = load_assembler()
+
+        if isinstance(source, str):
+            source = source.splitlines()
+
+        try:
+            assembly = asm.assemble_lines(source)
+        except asm.AsmError as e:
+            raise LoadError("\n".join(
+                f"{name}: {message}" for message in e.diagnostics)) from None
+
+        self.load_bytes(assembly.image)
+
+        segments = assembly.segments()
+        if segments:
+            memory = self.extended_memory(
+                max(offset + len(data) for offset, data in segments))
+            for offset, data in segments:
+                memory.load(offset, data)
+
+        self.symbols = assembly.symbols
+        self.lines = assembly.lines
+
+    def load_bytes(self, program, address=0):
+        """
+        Load a program given as bytes (or a bytearray, or a list of ints)
+        into memory at `address`, for programs that don't come from a file.
+        Raises LoadError if it doesn't fit.
+        """
+        end = address + len(program)
+
+        if end > len(self.ram):
+            raise LoadError(f"program of {len(program)} bytes at address "
+                            f"{address} is too big for memory")
+
+        try:
+            self.ram[address:end] = program
+        except (TypeError, ValueError) as e:
+            # a list holding something that isn't a byte
+            raise LoadError(f"program isn't a list of bytes: {e}") from None
+
+        self.stack_limit = max(end, self.stack_floor)
+
+        # anything decoded before is for a different program now
+        self.invalidate(0)
+
+    def reset(self):
+        """
+        Put the CPU back in its power on state, ready to load another
+        program, reusing its memory and caches rather than allocating new
+        ones. The attached output device, keyboard and memory-mapped
+        devices are kept.
+        """
+        self.ram[:] = bytes(len(self.ram))
+        self.reg[:] = bytes(len(self.reg))
+        self.reg[self.sp] = STACK_TOP
+        self.pc = 0
+        self.flag = 0
+        self.running = True
+        self.symbols = {}
+        self.lines = {}
+        self.interrupts_enabled = True
+        self.next_timer = None
+        self.executed = 0
+        self.stack_limit = self.stack_floor
+        self.invalidate(0)
+
+    def snapshot(self):
+        """
+        Return the machine state (RAM, registers, PC, flags, running and
+        interrupt state, instructions executed and the stack limit) as a
+        compact bytes blob for restore(). Devices and extended memory
+        aren't part of it.
+        """
+        if self.next_timer is None:
+            timer = float("nan")
+        else:
+            timer = self.next_timer - time.monotonic()
+
+        return b"".join([
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.pc,
+                                 self.flag, self.running,
+                                 self.interrupts_enabled, timer,
+                                 self.executed, self.stack_limit),
+            self.reg,
+            self.ram,
+        ])
 
+    def restore(self, blob):
+        """Put the machine back in the state saved by snapshot()."""
+        if len(blob) != SNAPSHOT_SIZE:
+            raise SnapshotError(f"snapshot is {len(blob)} bytes, "
+                                f"not {SNAPSHOT_SIZE}")
+
+        magic, version, pc, flag, running, enabled, timer, executed, \
+            stack_limit = SNAPSHOT_HEADER.unpack_from(blob)
+
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("not a CPU snapshot (bad magic)")
+
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"unsupported snapshot version {version}")
+
+        offset = SNAPSHOT_HEADER.size
+        self.reg[:] = blob[offset:offset + 8]
+        self.ram[:] = blob[offset + 8:]
+        self.pc = pc
+        self.flag = flag
+        self.running = bool(running)
+        self.interrupts_enabled = bool(enabled)
+        self.executed = executed
+        self.stack_limit = stack_limit
+
+        if timer != timer:
+            # NaN, the timer hadn't started
+            self.next_timer = None
         else:
+            self.next_timer = time.monotonic() + timer
+
+        # the code in RAM may be different now
+        self.invalidate(0)
+
+    def fork(self):
+        """
+        Return a new CPU in the same state as this one, to run on from here
+        without re-running whatever got this one here. The translated blocks
+        take the CPU as an argument, so the fork shares them rather than
+        translating the same code again; the decoded instruction cache is
+        bound to this CPU and is rebuilt as the fork runs. The fork prints
+        to the default output and has no keyboard. It has the same
+        memory-mapped devices at the same addresses, shared with this CPU,
+        except for extended memory, which it gets a copy of.
+        """
+        child = CPU()
+
+        child.ram[:] = self.ram
+        child.reg[:] = self.reg
+        child.pc = self.pc
+        child.flag = self.flag
+        child.running = self.running
+        child.interrupts_enabled = self.interrupts_enabled
+        child.next_timer = self.next_timer
+        child.executed = self.executed
+        child.stack_limit = self.stack_limit
+        child.stack_floor = self.stack_floor
+        child.symbols = self.symbols
+        child.lines = self.lines
+
+        # blocks are only ever replaced, never changed, so a shallow copy is
+        # enough for both CPUs to go their own way after this
+        child.blocks.update(self.blocks)
+        child.code_map[:] = self.code_map
+
+        child.io_map[:] = self.io_map
+        child.devices = list(self.devices)
+
+        if self.extended is not None:
+            extended = self.extended.copy()
+            copies = {id(self.extended): extended,
+                      id(self.extended.register): extended.register}
+
+            for kind, device in enumerate(child.devices):
+                copy = copies.get(id(device))
+                if copy is not None:
+                    child.devices[kind] = copy
+                    copy.attached(child, device.start, device.end)
+
+            child.extended = extended
+
+        return child
+
+    def run_checkpointed(self, every, max_steps=None, keep=None):
+        """
+        Run like run(), taking a snapshot() every `every` instructions.
+        Returns the number of instructions executed and the list of
+        (instructions executed so far, snapshot) checkpoints, only the last
+        `keep` of them if `keep` is given.
+        """
+        checkpoints = collections.deque(maxlen=keep)
+        steps = 0
+
+        while self.running:
+            budget = every
+            if max_steps is not None:
+                budget = min(budget, max_steps - steps)
+                if budget <= 0:
+                    break
+
+            result = self.run(max_steps=budget)
+            steps += result.steps
+            if result.status == "fault":
+                break
+            checkpoints.append((steps, self.snapshot()))
+
+        return steps, list(checkpoints)
+
+    def alu(self, op, reg_a, reg_b):
+        """
+        ALU operations. `op` is the opcode of an ALU instruction (or just its
+        ALU operation number, the low four bits).
+        """
+        handler = self.alu_table[op & 0x0f]
+
+        if handler is None:
             raise Exception("Unsupported ALU operation")
 
+        handler(reg_a, reg_b)
+
+    # The ALU operations. Registers only hold 0-255, so results are masked
+    # with 0xFF.
+
+    def alu_add(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] + self.reg[reg_b]) & 0xff
+
+    def alu_sub(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] - self.reg[reg_b]) & 0xff
+
+    def alu_mul(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] * self.reg[reg_b]) & 0xff
+
+    def alu_div(self, reg_a, reg_b):
+        # If the value in the second register is 0, print an error
+        # message and halt.
+        if self.reg[reg_b] == 0:
+            self.output.write('Division by zero\n')
+            self.running = False
+        else:
+            self.reg[reg_a] = self.reg[reg_a] // self.reg[reg_b]
+
+    def alu_mod(self, reg_a, reg_b):
+        # Same as DIV for a zero divisor
+        if self.reg[reg_b] == 0:
+            self.output.write('Division by zero\n')
+            self.running = False
+        else:
+            self.reg[reg_a] = self.reg[reg_a] % self.reg[reg_b]
+
+    def alu_inc(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] + 1) & 0xff
+
+    def alu_dec(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] - 1) & 0xff
+
+    def alu_cmp(self, reg_a, reg_b):
+        # If they are equal, set the Equal `E` flag to 1, otherwise set it to 0.
+        if self.reg[reg_a] == self.reg[reg_b]:
+            self.flag = 0b00000001
+        # If registerA is less than registerB, set the Less-than `L` flag to 1,
+        # otherwise set it to 0.
+        elif self.reg[reg_a] < self.reg[reg_b]:
+            self.flag = 0b00000100
+        #  If registerA is greater than registerB, set the Greater-than `G` flag
+        # to 1, otherwise set it to 0
+        else:
+            self.flag = 0b00000010
+
+    def alu_and(self, reg_a, reg_b):
+        self.reg[reg_a] &= self.reg[reg_b]
+
+    def alu_not(self, reg_a, reg_b):
+        self.reg[reg_a] = ~self.reg[reg_a] & 0xff
+
+    def alu_or(self, reg_a, reg_b):
+        self.reg[reg_a] |= self.reg[reg_b]
+
+    def alu_xor(self, reg_a, reg_b):
+        self.reg[reg_a] ^= self.reg[reg_b]
+
+    def alu_shl(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] << self.reg[reg_b]) & 0xff
+
+    def alu_shr(self, reg_a, reg_b):
+        self.reg[reg_a] >>= self.reg[reg_b]
+
     def trace(self):
         """
-        Handy function to print out the CPU state. You might want to call this
-        from run() if you need help debugging.
+        Handy function to print out the CPU state. For tracing a whole run,
+        use run_traced() instead, which keeps the last instructions in a
+        ring buffer rather than printing every one.
         """
+        from .tracer import format_record
 
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
-            self.pc,
-            # self.fl,
-            # self.ie,
-            self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
-        ), end='')
-
-        for i in range(8):
-            print(" %02X" % self.reg[i], end='')
+        pc = self.pc
+        print(format_record(
+            bytes([pc, self.ram[pc], self.ram[(pc + 1) & 0xff],
+                   self.ram[(pc + 2) & 0xff]]) + self.reg +
+            bytes([self.flag])))
 
-        print()
+    # The run loop moves the PC past the instruction before calling its
+    # handler, using the length decoded from the opcode. Handlers for
+    # instructions that set the PC simply overwrite it.
 
     def ldi_fun(self, reg_a, reg_b):
         # if LDI This instruction sets a specified register to a specified value.
         self.reg[reg_a] = reg_b
-        # 3 bytes long to move to next
-        self.pc += 3
 
     def prn_fun(self, reg_a, reg_b):
         # if PRN At this point, you should be able to run
         # the program and have it print 8 to the console!
-        print(f'Print this: {self.reg[reg_a]}')
-        # increment to the next command 2 bytes long
-        self.pc += 2
+        self.output.prn(self.reg[reg_a])
 
     def hlt_fun(self, reg_a, reg_b):
         # if HLT We can consider HLT to be similar to Python's exit()
         # in that we stop whatever we are doing, wherever we are.
-        # 1 byte instruction
-        self.pc += 1
         # Set running to false
         self.running = False
 
-    def mul_fun(self, reg_a, reg_b):
-        # Note: MUL is the responsiblity of the ALU, so it would be nice if your
-        # code eventually called the alu() function with appropriate arguments to get the work done.
-        self.alu("MUL", reg_a, reg_b)
-        self.pc += 3
+    def nop_fun(self, reg_a, reg_b):
+        # No operation. Do nothing for this instruction.
+        pass
 
-    def add_fun(self, reg_a, reg_b):
-        self.alu("ADD", reg_a, reg_b)
-        self.pc += 3
+    def ld_fun(self, reg_a, reg_b):
+        # Loads registerA with the value at the memory address stored in registerB.
+        self.reg[reg_a] = self.ram_read(self.reg[reg_b])
+
+    def st_fun(self, reg_a, reg_b):
+        # Store value in registerB in the address stored in registerA.
+        self.ram_write(self.reg[reg_a], self.reg[reg_b])
+
+    def pra_fun(self, reg_a, reg_b):
+        # Print to the console the ASCII character corresponding to the
+        # value in the register.
+        self.output.pra(self.reg[reg_a])
 
     def push_fun(self, reg_a, reg_b):
-        # print("pop", reg_a, reg_b)
         # decrement the SP
-        self.reg[self.sp] -= 1
+        sp = (self.reg[self.sp] - 1) & 0xff
+        if sp < self.stack_limit or sp >= STACK_TOP:
+            raise CPUFault("stack overflow")
+        self.reg[self.sp] = sp
         # copy the value in the given register to the address pointed to by SP
-        self.ram[self.reg[self.sp]] = self.reg[reg_a]
-        self.pc += 2
+        self.ram[sp] = self.reg[reg_a]
+        if self.code_map[sp]:
+            self.invalidate(sp)
 
     def pop_fun(self, reg_a, reg_b):
-        # print("pop", reg_a, reg_b)
+        sp = self.reg[self.sp]
+        if sp >= STACK_TOP:
+            raise CPUFault("stack underflow")
         # copy the value from the address pointed to by SP to the given reg
-        self.reg[reg_a] = self.ram[self.reg[self.sp]]
+        self.reg[reg_a] = self.ram[sp]
         # increment SP
-        self.reg[self.sp] += 1
-        self.pc += 2
+        self.reg[self.sp] = sp + 1
 
-    # these args will not be used but are needed for the loop in run
     def call_fun(self, reg_a, reg_b):
-        return_add = self.pc + 2
+        # The PC already points at the instruction directly after CALL
+        return_add = self.pc
         # decrement the SP
-        self.reg[self.sp] -= 1
+        sp = (self.reg[self.sp] - 1) & 0xff
+        if sp < self.stack_limit or sp >= STACK_TOP:
+            raise CPUFault("stack overflow")
+        self.reg[self.sp] = sp
         # The address of the instruction directly after CALL is pushed onto the stack.
         # This allows us to return to where we left off when the subroutine finishes executing.
-        self.ram[self.reg[self.sp]] = return_add
+        self.ram[sp] = return_add
+        if self.code_map[sp]:
+            self.invalidate(sp)
         # The PC is set to the address stored in the given register.
-        reg_num = self.ram[self.pc + 1]
-        sub_add = self.reg[reg_num]
-        self.pc = sub_add
+        self.pc = self.reg[reg_a]
 
     def ret_fun(self, reg_a, reg_b):
         # Return from subroutine.
-        return_address = self.ram[self.reg[self.sp]]
+        sp = self.reg[self.sp]
+        if sp >= STACK_TOP:
+            raise CPUFault("stack underflow")
+        return_address = self.ram[sp]
         # Pop the value from the top of the stack
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = sp + 1
         # and store it in the PC.
         self.pc = return_address
 
-    def cmp_fun(self, reg_a, reg_b):
-        # Compare the values in two registers
-        # This is handled by ALU with flags
-        self.alu("CMP", reg_a, reg_b)
-        # 3bit instruction
-        self.pc += 3
+    def int_fun(self, reg_a, reg_b):
+        # Issue the interrupt number stored in the given register, by setting
+        # that bit in the IS register (R6)
+        self.reg[6] |= 1 << (self.reg[reg_a] & 0b111)
+        # and service it before the next instruction, without waiting for
+        # the run loop to poll
+        self.check_interrupts()
+
+    def iret_fun(self, reg_a, reg_b):
+        # Return from an interrupt handler.
+        sp = self.reg[self.sp]
+        # R6-R0, FL and PC make 9 bytes
+        if sp > STACK_TOP - 9:
+            raise CPUFault("stack underflow")
+        # Registers R6-R0 are popped off the stack in that order.
+        for r in range(6, -1, -1):
+            self.reg[r] = self.ram[sp]
+            sp = (sp + 1) & 0xff
+        # The `FL` register is popped off the stack.
+        self.flag = self.ram[sp]
+        sp = (sp + 1) & 0xff
+        # The return address is popped off the stack and stored in `PC`.
+        self.pc = self.ram[sp]
+        self.reg[self.sp] = (sp + 1) & 0xff
+        # Interrupts are re-enabled, and anything that came in while this
+        # one was serviced goes next
+        self.interrupts_enabled = True
+        self.check_interrupts()
+
+    def poll_interrupts(self):
+        """
+        Raise the timer interrupt if it's due, take a key press from the
+        keyboard if there is one, and service any pending interrupt. The run
+        loops call this between chunks of instructions rather than before
+        every one, so the clock is only read once per chunk.
+        """
+        if self.inputs is not None:
+            # recording or replaying, see replay.py
+            self.inputs.poll(self)
+            return
+
+        self.poll_inputs()
+        self.check_interrupts()
+
+    def poll_inputs(self):
+        """
+        Take a key press from the keyboard, and raise the timer interrupt if
+        it's due, without servicing them.
+        """
+        if self.keyboard is not None:
+            self.keyboard.poll(self)
+
+        now = time.monotonic()
+
+        if self.next_timer is None:
+            self.next_timer = now + TIMER_INTERVAL
+        elif now >= self.next_timer:
+            # Timer interrupt, I0
+            self.reg[6] |= 0b00000001
+            self.next_timer = now + TIMER_INTERVAL
+
+    def check_interrupts(self):
+        """Service the lowest numbered pending interrupt, if any."""
+        i = self.pending_interrupt()
+        if i is not None:
+            self.interrupt(i)
+
+    def pending_interrupt(self):
+        """
+        The interrupt check_interrupts() would service now, or None.
+        """
+        if not self.interrupts_enabled:
+            return None
+
+        # The IM register is bitwise AND-ed with the IS register
+        masked_interrupts = self.reg[5] & self.reg[6]
+
+        if masked_interrupts == 0:
+            return None
+
+        # Each bit is checked, starting from 0 and going up to the 7th bit
+        for i in range(8):
+            if masked_interrupts & (1 << i):
+                return i
+
+    def interrupt(self, i):
+        """Call the handler for interrupt `i`."""
+        # Disable further interrupts.
+        self.interrupts_enabled = False
+        # Clear the bit in the IS register.
+        self.reg[6] &= ~(1 << i) & 0xff
+
+        # The `PC` register is pushed on the stack, then the `FL` register,
+        # then registers R0-R6 in that order.
+        sp = self.reg[self.sp]
+        if sp - 9 < self.stack_limit or sp > STACK_TOP:
+            raise CPUFault("stack overflow")
+        for value in [self.pc, self.flag] + list(self.reg[:7]):
+            sp = (sp - 1) & 0xff
+            self.ram[sp] = value
+            if self.code_map[sp]:
+                self.invalidate(sp)
+        self.reg[self.sp] = sp
+
+        # The PC is set to the handler address from the vector table.
+        self.pc = self.ram[VECTOR_TABLE + i]
 
     def jeq_fun(self, reg_a, reg_b):
-        # get the reg_num
-        reg_num = self.ram_read(self.pc + 1)
         # If `equal` flag is set (true),
         if self.flag & 0b00000001 == 1:
             # jump to the address stored in the given register
-            self.pc = self.reg[reg_num]
-        else:
-            self.pc += 2
+            self.pc = self.reg[reg_a]
 
-    def jmp_fun(self, reg_a, reg_b):  # these args will not be used but are needed for the loop in run
-        # Jump to the address stored in the given register.
-        reg_num = self.ram_read(self.pc + 1)
+    def jmp_fun(self, reg_a, reg_b):
         # Set the `PC` to the address stored in the given register
-        self.pc = self.reg[reg_num]
+        self.pc = self.reg[reg_a]
 
     def jne_fun(self, reg_a, reg_b):
-        # get the reg_num
-        reg_num = self.ram_read(self.pc + 1)
         # If `E` flag is clear (false, 0),
         if self.flag & 0b00000001 == 0:
             # jump to the address stored in the given register
-            self.pc = self.reg[reg_num]
-        else:
-            self.pc += 2
+            self.pc = self.reg[reg_a]
 
-    def run(self):
-        """Run the CPU."""
-        while self.running:
-            # Instruction Register, contains a copy of the currently executing instruction
-            ir = self.ram[self.pc]
+    def jgt_fun(self, reg_a, reg_b):
+        # If `greater-than` flag is set (true), jump
+        if self.flag & 0b00000010:
+            self.pc = self.reg[reg_a]
+
+    def jge_fun(self, reg_a, reg_b):
+        # If `greater-than` flag or `equal` flag is set (true), jump
+        if self.flag & 0b00000011:
+            self.pc = self.reg[reg_a]
+
+    def jlt_fun(self, reg_a, reg_b):
+        # If `less-than` flag is set (true), jump
+        if self.flag & 0b00000100:
+            self.pc = self.reg[reg_a]
+
+    def jle_fun(self, reg_a, reg_b):
+        # If `less-than` flag or `equal` flag is set (true), jump
+        if self.flag & 0b00000101:
+            self.pc = self.reg[reg_a]
+
+    def run(self, max_steps=None, max_seconds=None):
+        """
+        Run the CPU until it halts or faults, or has executed `max_steps`
+        instructions or run for `max_seconds`, if given. Returns a
+        RunResult. Both budgets are checked once per RUN_CHUNK instructions,
+        so the time budget can be overrun by one chunk.
+        """
+        decoded = self.decoded
+        decode = self.decode
+        steps = 0
+        status = "halted"
+        pc = self.pc
+        i = 0
+        executed = self.executed
+
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+
+        try:
+            while self.running:
+                # Execute in chunks so counting steps against the budget and
+                # polling for interrupts happen once per chunk instead of
+                # once per instruction
+                chunk = RUN_CHUNK
+                if max_steps is not None:
+                    chunk = min(chunk, max_steps - steps)
+                    if chunk <= 0:
+                        status = "step_budget"
+                        break
+
+                if max_seconds is not None and time.monotonic() >= deadline:
+                    status = "time_budget"
+                    break
+
+                pc = self.pc
+                i = 0
+                self.executed = executed + steps
+                self.poll_interrupts()
+
+                for i in range(chunk):
+                    pc = self.pc
+                    # Use the cached decode of this address if we have one
+                    entry = decoded.get(pc)
+                    if entry is None:
+                        entry = decode(pc)
+
+                    handler, reg_a, reg_b, length = entry
+                    # advance past the instruction, then execute it
+                    self.pc = (pc + length) & 0xff
+                    handler(reg_a, reg_b)
+
+                    if not self.running:
+                        steps += i + 1
+                        break
+                else:
+                    steps += chunk
+
+        except CPUFault as e:
+            # everything before the faulting instruction ran
+            steps += i
+            if e.pc is None:
+                e.pc = pc
+            # leave the PC on the instruction at fault
+            self.pc = e.pc
+            self.executed = executed + steps
+            self.output.flush()
+            return RunResult("fault", steps, e.pc, e.reason)
 
-            reg_a = self.ram_read(self.pc + 1)
-            reg_b = self.ram_read(self.pc + 2)
-            # print("ir", ir, reg_a, reg_b)
-            if ir in self.branch_table:
+        self.executed = executed + steps
+
+        # Write out whatever the output device is still holding
+        self.output.flush()
+
+        return RunResult(status, steps, self.pc)
+
+    def run_translated(self):
+        """
+        Run the CPU by translating basic blocks into Python functions, see
+        translator.py. Returns a RunResult like run(), without the number of
+        instructions executed (its steps is None).
+        """
+        from .translator import run_translated
+
+        try:
+            run_translated(self)
+        except CPUFault as e:
+            if e.pc is None:
+                e.pc = self.pc
+            self.pc = e.pc
+            self.output.flush()
+            return RunResult("fault", None, e.pc, e.reason)
+
+        self.output.flush()
+
+        return RunResult("halted", None, self.pc)
+
+    def run_traced(self, tracer, max_steps=None):
+        """
+        Run the CPU like run(), recording every instruction in the ring
+        buffer of a tracer.Tracer, see tracer.py. Returns a RunResult.
+        """
+        from .tracer import run_traced
+        return run_traced(self, tracer, max_steps)
+
+    def run_profiled(self, max_steps=None):
+        """
+        Run the CPU like run(), counting executions per opcode, address and
+        CALL target and the outcome of every conditional jump. Returns the
+        counts as a profiler.Profile, see profiler.py.
+        """
+        from .profiler import run_profiled
+        return run_profiled(self, max_steps)
+
+    def run_timed(self, model, max_steps=None):
+        """
+        Run the CPU like run(), charging cycles for every instruction by a
+        timing.Model of instruction costs, a cache and a branch predictor.
+        Returns the counts as a timing.Timing, see timing.py.
+        """
+        from .timing import run_timed
+        return run_timed(self, model, max_steps)
+
+    def run_reference(self):
+        """
+        Run the CPU without the decoded instruction cache, fetching and
+        decoding every instruction each time it executes. Kept as the
+        reference to check and benchmark the faster run loops against, so
+        it costs no more per instruction than the loop it replaced: the
+        timer and keyboard are polled once per RUN_CHUNK instructions as in
+        run(), and in between only an interrupt the program raised itself,
+        in IS and unmasked by IM, is serviced before the next instruction.
+        Returns a RunResult like run().
+        """
+        reg = self.reg
+        steps = 0
+        pc = self.pc
+
+        try:
+            while self.running:
+                pc = self.pc
+                if steps % RUN_CHUNK == 0:
+                    self.poll_interrupts()
+                elif reg[5] & reg[6]:
+                    self.check_interrupts()
+                pc = self.pc
+
+                # Instruction Register, contains a copy of the currently executing instruction
+                ir = self.ram[pc]
+
+                # operands come from RAM like the opcode, as decode() takes
+                # them: going through ram_read() would read a device mapped
+                # there, and a read can have side effects
+                reg_a = self.ram[(pc + 1) & 0xff]
+                reg_b = self.ram[(pc + 2) & 0xff]
+
+                self.check_instruction(pc, ir, reg_a, reg_b)
+
+                self.pc = (pc + instruction_length(ir)) & 0xff
                 self.branch_table[ir](reg_a, reg_b)
+                steps += 1
 
-            else:
-                print(f'Unknown instruction {ir} at address {self.pc}')
-                sys.exit(1)
+        except CPUFault as e:
+            if e.pc is None:
+                e.pc = pc
+            self.pc = e.pc
+            self.output.flush()
+            return RunResult("fault", steps, e.pc, e.reason)
+
+        self.output.flush()
+
+        return RunResult("halted", steps, self.pc)
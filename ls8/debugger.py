@@ -0,0 +1,396 @@
+"""
+Debug server: control an LS-8 program from another process over a
+localhost socket, with a small subset of the GDB remote protocol.
+
+Usage: ls8.py debug [--port N] program.ls8
+
+Every packet is $data#cc, cc being the sum of the data bytes mod 256 in
+hex, and is acknowledged with +. Numbers and bytes are hex, and wherever an
+address goes a label from the program's symbol table can go instead.
+
+    ?               why the program last stopped
+    g               registers R0-R7, PC and FL, two hex digits each
+    G XX...         write them all
+    p n / P n=XX    read / write register n (8 is PC, 9 is FL)
+    m addr,len      read memory
+    M addr,len:XX   write memory
+    c               continue
+    s               step one instruction
+    Z0,addr,1       set a breakpoint, stop before the instruction there
+    z0,addr,1       clear it
+    Z2,addr,1       set a watchpoint, stop after a change to the byte there
+    z2,addr,1       clear it
+    qSymbols        the labels, as LABEL=addr;...
+    k / D           end the session
+
+Stop replies are S05 for a step or breakpoint, T05watch:addr; for a
+watchpoint, S0b for a fault, and W00 once the program has halted. A
+continue can be interrupted by sending a 0x03 byte.
+
+With no breakpoints or watchpoints set, continue runs the program with
+CPU.run, at full speed; only while some are set does it switch to
+run_checked(), a copy of the run loop that checks each instruction.
+"""
+
+import argparse
+import select
+import socket
+import sys
+
+from .cpu import CPU, RUN_CHUNK, CPUFault, LoadError, RunResult
+
+# Instructions a continue runs between checks for an interrupt from the
+# client
+SLICE = 65536
+
+# Registers in g and G packets, after R0-R7
+PC_REGISTER = 8
+FL_REGISTER = 9
+
+INTERRUPT = b"\x03"
+
+
+def run_checked(cpu, breakpoints, watchpoints, max_steps, skip_first=False):
+    """
+    Run the CPU like CPU.run for up to `max_steps` instructions, but stop
+    before executing an instruction at an address whose byte is set in the
+    `breakpoints` bitmap, or after one that changes a byte of RAM in
+    `watchpoints`, a dict of address -> value. With `skip_first` the
+    instruction the PC is on when it starts is run, breakpoint or not, so
+    continuing from a breakpoint gets past it; without, a breakpoint there
+    stops it straight away, as it should when a previous call only ran out
+    of steps on it. Returns (RunResult, watchpoint address hit or
+    None); the RunResult's status is "breakpoint" or "watchpoint" when one
+    of them stopped it.
+    """
+
+    ram = cpu.ram
+    decoded = cpu.decoded
+    decode = cpu.decode
+    executed = cpu.executed
+    steps = 0
+    status = "step_budget"
+    hit = None
+    resume = cpu.pc if skip_first else None
+    pc = cpu.pc
+    i = 0
+
+    try:
+        while cpu.running and steps < max_steps:
+            chunk = min(RUN_CHUNK, max_steps - steps)
+
+            pc = cpu.pc
+            i = 0
+            # as CPU.run, so a poll sees the instructions run so far
+            cpu.executed = executed + steps
+            cpu.poll_interrupts()
+
+            for i in range(chunk):
+                pc = cpu.pc
+
+                if breakpoints[pc] and pc != resume:
+                    status = "breakpoint"
+                    break
+                resume = None
+
+                entry = decoded.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                handler, reg_a, reg_b, length = entry
+                cpu.pc = (pc + length) & 0xff
+                handler(reg_a, reg_b)
+
+                for addr, value in watchpoints.items():
+                    if ram[addr] != value:
+                        watchpoints[addr] = ram[addr]
+                        hit = addr
+                        status = "watchpoint"
+                        break
+
+                if hit is not None or not cpu.running:
+                    i += 1
+                    break
+            else:
+                steps += chunk
+                continue
+
+            steps += i
+            break
+
+    except CPUFault as e:
+        steps += i
+        cpu.pc = pc if e.pc is None else e.pc
+        cpu.executed = executed + steps
+        cpu.output.flush()
+        return RunResult("fault", steps, cpu.pc, e.reason), None
+
+    if not cpu.running:
+        status = "halted"
+
+    cpu.executed = executed + steps
+    cpu.output.flush()
+
+    return RunResult(status, steps, cpu.pc), hit
+
+
+def checksum(data):
+    return f"{sum(data) & 0xff:02x}".encode("ascii")
+
+
+class DebugServer:
+    """
+    Serves one client at a time on `host`:`port` (port 0 for any free
+    one), debugging `cpu`, which has its program loaded.
+    """
+
+    def __init__(self, cpu, host="127.0.0.1", port=0):
+        self.cpu = cpu
+        self.listener = socket.create_server((host, port))
+        self.address = self.listener.getsockname()
+        self.conn = None
+        self.buffer = b""
+        self.acks = True
+
+        self.breakpoints = bytearray(256)
+        # address -> value when last checked
+        self.watchpoints = {}
+        self.last_stop = "S05"
+
+    def serve(self):
+        """Accept a client and answer it until it goes away."""
+        conn, _ = self.listener.accept()
+        self.conn = conn
+        self.buffer = b""
+        self.acks = True
+
+        with conn:
+            while True:
+                packet = self.read_packet()
+                if packet is None:
+                    return
+
+                reply = self.handle(packet)
+                if reply is None:
+                    return
+                self.send(reply)
+
+    def close(self):
+        self.listener.close()
+
+    # --- packets -----------------------------------------------------
+
+    def read_packet(self):
+        """The data of the next packet, None when the client has gone."""
+        while True:
+            start = self.buffer.find(b"$")
+            end = self.buffer.find(b"#", start)
+
+            if start != -1 and end != -1 and len(self.buffer) >= end + 3:
+                data = self.buffer[start + 1:end]
+                sent = self.buffer[end + 1:end + 3]
+                self.buffer = self.buffer[end + 3:]
+
+                if self.acks:
+                    ok = sent.lower() == checksum(data)
+                    self.conn.sendall(b"+" if ok else b"-")
+                    if not ok:
+                        continue
+
+                return data.decode("latin-1")
+
+            more = self.conn.recv(4096)
+            if not more:
+                return None
+            # acks, and interrupts that came too late to matter
+            self.buffer += more.lstrip(b"+-" + INTERRUPT)
+
+    def send(self, reply):
+        if isinstance(reply, str):
+            reply = reply.encode("latin-1")
+        self.conn.sendall(b"$" + reply + b"#" + checksum(reply))
+
+    def interrupted(self):
+        """True if the client has sent 0x03 to stop a continue."""
+        readable, _, _ = select.select([self.conn], [], [], 0)
+        if not readable:
+            return False
+
+        data = self.conn.recv(4096)
+        if INTERRUPT in data:
+            self.buffer += data.replace(INTERRUPT, b"")
+            return True
+
+        self.buffer += data
+        # the client went away, stop and let read_packet() notice
+        return not data
+
+    # --- commands ----------------------------------------------------
+
+    def parse_address(self, text):
+        """An address, in hex or as a label."""
+        text = text.strip()
+        label = self.cpu.symbols.get(text.upper())
+        if label is not None:
+            return label
+
+        addr = int(text, 16)
+        if not 0 <= addr <= 0xff:
+            raise ValueError(f"address {text} out of range")
+        return addr
+
+    def handle(self, packet):
+        """The reply to `packet`, None to end the session."""
+        command, args = packet[:1], packet[1:]
+
+        try:
+            if packet == "QStartNoAckMode":
+                # this packet has been acknowledged, no more after it
+                self.acks = False
+                return "OK"
+            if packet == "qSymbols":
+                return ";".join(f"{name}={addr:02x}" for name, addr
+                                in sorted(self.cpu.symbols.items()))
+            if command == "?":
+                return self.last_stop
+            if command == "g":
+                return self.read_registers()
+            if command == "G":
+                return self.write_registers(bytes.fromhex(args))
+            if command == "p":
+                return f"{self.registers()[int(args, 16)]:02x}"
+            if command == "P":
+                n, value = args.split("=")
+                values = bytearray(self.registers())
+                values[int(n, 16)] = int(value, 16)
+                return self.write_registers(values)
+            if command == "m":
+                addr, length = args.split(",")
+                return self.read_memory(self.parse_address(addr),
+                                        int(length, 16))
+            if command == "M":
+                where, data = args.split(":")
+                addr, length = where.split(",")
+                data = bytes.fromhex(data)[:int(length, 16)]
+                return self.write_memory(self.parse_address(addr), data)
+            if command in ("Z", "z") and args[:1] in ("0", "2"):
+                kind, addr, _ = args.split(",")
+                return self.set_point(kind, self.parse_address(addr),
+                                      command == "Z")
+            if command == "s":
+                return self.stop(self.cpu.run(max_steps=1), None)
+            if command == "c":
+                return self.resume()
+            if command in ("k", "D"):
+                if command == "D":
+                    self.send("OK")
+                return None
+
+        except (ValueError, IndexError, KeyError):
+            return "E01"
+
+        # not supported
+        return ""
+
+    def registers(self):
+        cpu = self.cpu
+        return bytes(cpu.reg) + bytes((cpu.pc, cpu.flag))
+
+    def read_registers(self):
+        return self.registers().hex()
+
+    def write_registers(self, values):
+        if len(values) != 10:
+            return "E01"
+
+        cpu = self.cpu
+        cpu.reg[:] = values[:8]
+        cpu.pc = values[PC_REGISTER]
+        cpu.flag = values[FL_REGISTER]
+        return "OK"
+
+    def read_memory(self, addr, length):
+        ram = self.cpu.ram
+        return bytes(ram[(addr + i) & 0xff] for i in range(length)).hex()
+
+    def write_memory(self, addr, data):
+        cpu = self.cpu
+        for i, value in enumerate(data):
+            cpu.ram[(addr + i) & 0xff] = value
+            if (addr + i) & 0xff in self.watchpoints:
+                self.watchpoints[(addr + i) & 0xff] = value
+
+        # the bytes may have been code
+        cpu.invalidate(0)
+        return "OK"
+
+    def set_point(self, kind, addr, on):
+        if kind == "0":
+            self.breakpoints[addr] = on
+        elif on:
+            self.watchpoints[addr] = self.cpu.ram[addr]
+        else:
+            self.watchpoints.pop(addr, None)
+        return "OK"
+
+    def resume(self):
+        """Continue until a breakpoint, watchpoint, halt or interrupt."""
+        cpu = self.cpu
+        checking = any(self.breakpoints) or self.watchpoints
+        # only the breakpoint the client continued from is stepped over, a
+        # slice can end on another one
+        first = True
+
+        while True:
+            if checking:
+                result, hit = run_checked(cpu, self.breakpoints,
+                                          self.watchpoints, SLICE, first)
+            else:
+                result, hit = cpu.run(max_steps=SLICE), None
+            first = False
+
+            if result.status != "step_budget" or self.interrupted():
+                return self.stop(result, hit)
+
+    def stop(self, result, hit):
+        """The stop reply for how a run ended, also kept for ?."""
+        if result.status == "fault":
+            self.last_stop = "S0b"
+        elif not self.cpu.running:
+            self.last_stop = "W00"
+        elif hit is not None:
+            self.last_stop = f"T05watch:{hit:02x};"
+        else:
+            self.last_stop = "S05"
+        return self.last_stop
+
+
+def main(argv):
+    """ls8.py debug: load a program and serve it to a debugger."""
+
+    parser = argparse.ArgumentParser(
+        prog="ls8.py debug",
+        description="Load an LS-8 program and wait for a debugger to "
+                    "connect on a localhost socket.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file")
+    parser.add_argument("--port", type=int, default=0,
+                        help="port to listen on (default any free one)")
+    args = parser.parse_args(argv)
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    server = DebugServer(cpu, port=args.port)
+    host, port = server.address
+    print(f"listening on {host}:{port}", file=sys.stderr)
+
+    try:
+        server.serve()
+    finally:
+        server.close()
+
+    return 0
@@ -0,0 +1,279 @@
+"""
+Memory-mapped devices for the LS-8.
+
+A device is attached to a range of addresses with CPU.attach(). LD and ST at
+those addresses call its read() and write() instead of touching RAM:
+
+    cpu.attach(Framebuffer(16, 4), 0xa0, 0xdf)
+
+The CPU finds devices through its io_map, a 256 byte page kind table with 0
+for plain RAM and a device's index otherwise, so loads and stores to RAM
+only pay for one lookup however many devices there are. The stack,
+instruction fetch and the interrupt vectors always use RAM.
+
+attach_standard_devices() maps the devices the LS-8 spec describes, in the
+free addresses between the stack and the interrupt vectors:
+
+    F4   KeyboardPort   the last key pressed (see keyboard.py)
+    F5   Timer          seconds since it was attached or last written
+    F6   Console        writing a character prints it, like PRA
+
+attach_extended_memory() adds memory beyond the 256 bytes the LS-8 can
+address, seen a bank at a time through a window of RAM addresses:
+
+    7E-7F  BankSelect     bank number, low byte then high byte
+    80-BF  BankedMemory   64 bytes of the selected bank
+
+so a program can reach up to 65536 banks, 4 MB, by storing the bank number
+and then using LD and ST in the window. The program itself has to fit below
+7E, and the stack grows down from F3 to C0 as usual. The memory is a single
+preallocated bytearray, or any buffer, such as the mmap map_file() returns
+to use a large file as guest memory without reading it in.
+"""
+
+import mmap
+import time
+
+from .keyboard import KEY_ADDRESS
+
+TIMER_ADDRESS = 0xf5
+CONSOLE_ADDRESS = 0xf6
+
+# Extended memory: the bank select register, the window onto the selected
+# bank, and the memory allocated when none is given
+BANK_SELECT = 0x7e
+WINDOW_START = 0x80
+BANK_SIZE = 64
+EXTENDED_SIZE = 65536
+# as much as 65536 banks can reach
+MAX_EXTENDED_SIZE = 65536 * BANK_SIZE
+
+
+class Device:
+    """
+    Base class of memory-mapped devices. Subclasses override read() and
+    write(), which get the address accessed and, for writes, the byte.
+    """
+
+    def attached(self, cpu, start, end):
+        """Called by CPU.attach() with the addresses the device is at."""
+        self.cpu = cpu
+        self.start = start
+        self.end = end
+
+    def read(self, addr):
+        return 0
+
+    def write(self, addr, value):
+        pass
+
+
+class KeyboardPort(Device):
+    """
+    The key pressed register. A keyboard (see keyboard.py) delivers a key
+    by writing it here through CPU.ram_write; programs LD it.
+    """
+
+    def __init__(self):
+        self.key = 0
+
+    def read(self, addr):
+        return self.key
+
+    def write(self, addr, value):
+        self.key = value
+
+
+class Timer(Device):
+    """
+    Whole seconds since the timer was attached, or since a program last
+    wrote to it, wrapping at 256.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start_time = clock()
+
+    def read(self, addr):
+        return int(self.clock() - self.start_time) & 0xff
+
+    def write(self, addr, value):
+        self.start_time = self.clock()
+
+
+class Console(Device):
+    """Writing a byte prints it as a character on the CPU's output."""
+
+    def write(self, addr, value):
+        self.cpu.output.pra(value)
+
+
+class Framebuffer(Device):
+    """
+    A stand-in for a display: width * height bytes of pixels, one per
+    address from where it's attached, which render() shows as text.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(width * height)
+
+    def attached(self, cpu, start, end):
+        if end - start + 1 != len(self.pixels):
+            raise ValueError(f"a {self.width}x{self.height} framebuffer "
+                             f"needs {len(self.pixels)} addresses")
+        super().attached(cpu, start, end)
+
+    def read(self, addr):
+        return self.pixels[addr - self.start]
+
+    def write(self, addr, value):
+        self.pixels[addr - self.start] = value
+
+    def render(self, chars=" .:-=+*#%@"):
+        """The pixels as lines of text, brighter values as denser chars."""
+        scale = len(chars) - 1
+        return "\n".join(
+            "".join(chars[p * scale // 255] for p in
+                    self.pixels[y * self.width:(y + 1) * self.width])
+            for y in range(self.height))
+
+
+class BankedMemory(Device):
+    """
+    Extended memory, a bank of it at a time. `memory` is a bytearray, or
+    any buffer of bytes; it's read and written in place, never copied. The
+    selected bank shows at the addresses the device is attached at, so the
+    size of a bank is the size of the window. Reads past the end of the
+    memory give 0, and writes there, or to a read-only buffer, are lost.
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.writable = not memoryview(memory).readonly
+        # start of the selected bank in `memory`
+        self.base = 0
+        self.bank = 0
+        # the bank select register that goes with it
+        self.register = BankSelect(self)
+
+    def attached(self, cpu, start, end):
+        super().attached(cpu, start, end)
+        self.bank_size = end - start + 1
+        self.select(self.bank)
+
+    def select(self, bank):
+        self.bank = bank
+        self.base = bank * self.bank_size
+
+    def read(self, addr):
+        i = self.base + addr - self.start
+        if i < len(self.memory):
+            return self.memory[i]
+        return 0
+
+    def write(self, addr, value):
+        i = self.base + addr - self.start
+        if i < len(self.memory) and self.writable:
+            self.memory[i] = value
+
+    def copy(self):
+        """
+        A new BankedMemory over a copy of the memory, on the same bank, to
+        attach to a forked CPU.
+        """
+        copy = BankedMemory(bytearray(self.memory))
+        copy.writable = self.writable
+        copy.bank = self.bank
+        return copy
+
+    def load(self, offset, data):
+        """Copy `data` into the memory at byte `offset`."""
+        if offset + len(data) > len(self.memory):
+            raise ValueError(f"{len(data)} bytes at {offset} don't fit in "
+                             f"{len(self.memory)} bytes of extended memory")
+        self.memory[offset:offset + len(data)] = data
+
+
+class BankSelect(Device):
+    """
+    The bank number of a BankedMemory, low byte at the first address and
+    high byte at the second.
+    """
+
+    def __init__(self, banked):
+        self.banked = banked
+
+    def read(self, addr):
+        return self.banked.bank >> 8 * (addr - self.start)
+
+    def write(self, addr, value):
+        if addr == self.start:
+            self.banked.select(self.banked.bank & 0xff00 | value)
+        else:
+            self.banked.select(self.banked.bank & 0xff | value << 8)
+
+
+def map_file(filename, writable=False):
+    """
+    Map a file to use as extended memory. Pages are only read when the
+    program touches them. Writes, if `writable`, go to a private copy of
+    the page and never reach the file.
+    """
+    with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY
+                         if writable else mmap.ACCESS_READ)
+
+
+def attach_extended_memory(cpu, memory=None, size=EXTENDED_SIZE):
+    """
+    Attach extended memory, `memory` or a new bytearray of `size` bytes,
+    with its bank select register at 7E-7F and window at 80-BF. Returns the
+    BankedMemory, which is also kept in cpu.extended. Snapshots only hold
+    the 256 bytes of RAM, not extended memory.
+
+    The stack isn't allowed below the window from then on, so it can't
+    grow into it; raises ValueError if it's already there, or if `size` is
+    more than the banks can reach.
+    """
+    window_end = WINDOW_START + BANK_SIZE
+
+    if cpu.reg[7] < window_end:
+        raise ValueError(f"the stack is already below {window_end:02X}, "
+                         "in the bank window")
+
+    if memory is None and size > MAX_EXTENDED_SIZE:
+        raise ValueError(f"{size} bytes of extended memory is more than the "
+                         f"{MAX_EXTENDED_SIZE} the banks can reach")
+
+    if memory is None:
+        memory = bytearray(size)
+
+    banked = BankedMemory(memory)
+    cpu.attach(banked.register, BANK_SELECT, BANK_SELECT + 1)
+    cpu.attach(banked, WINDOW_START, WINDOW_START + BANK_SIZE - 1)
+    cpu.extended = banked
+
+    cpu.stack_floor = max(cpu.stack_floor, window_end)
+    cpu.stack_limit = max(cpu.stack_limit, cpu.stack_floor)
+
+    return banked
+
+
+def attach_standard_devices(cpu):
+    """
+    Attach the keyboard port, timer and console at F4-F6, and return them
+    as a dict by name.
+    """
+    devices = {
+        "keyboard": KeyboardPort(),
+        "timer": Timer(),
+        "console": Console(),
+    }
+
+    cpu.attach(devices["keyboard"], KEY_ADDRESS)
+    cpu.attach(devices["timer"], TIMER_ADDRESS)
+    cpu.attach(devices["console"], CONSOLE_ADDRESS)
+
+    return devices
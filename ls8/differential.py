@@ -0,0 +1,327 @@
+"""
+Differential check of the CPU run loops against the reference interpreter.
+
+Usage, from the directory above ls8:
+
+    python3 -m ls8.differential [count] [seed]
+
+Every program is run with CPU.run_reference() and with each faster run loop,
+and the final RAM, registers, PC, flags, running state, printed output and
+any fault are compared. The programs are the examples in examples/ that
+halt, a couple of self-modifying programs, a few that fault, and `count`
+(default 500) randomly generated programs.
+
+If NumPy is installed, BatchCPU is checked the same way: each program runs
+on a batch of lanes with random starting registers, and every lane has to
+end up where a scalar CPU started from the same registers does.
+"""
+
+import glob
+import os
+import random
+import sys
+
+from .cpu import (CPU, ADD, AND, CALL, CMP, DEC, DIV, HLT, INC,
+                  JEQ, JGE, JGT, JLE, JLT, JMP, JNE, LD, LDI, MOD, MUL, NOP,
+                  NOT, OR, POP, PRA, PRN, PUSH, RET, SHL, SHR, ST, SUB, XOR)
+from .opcodes import instruction_length
+from .output import CaptureOutput
+
+# random programs use these
+ALU_OPS = [ADD, SUB, MUL, DIV, MOD, CMP, AND, OR, XOR, SHL, SHR]
+ALU_OPS_1 = [INC, DEC, NOT]
+JUMPS = [JMP, JEQ, JNE, JGT, JGE, JLT, JLE]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# run loops checked against run_reference
+MODES = ["run", "run_translated", "run_profiled"]
+
+# examples that never halt
+SKIP = {"interrupts.ls8", "keyboard.ls8", "stackoverflow.ls8"}
+
+SELF_MODIFYING = {
+    # PRN R0 at 0x0C runs once, then a PUSH rewrites its operand so it runs
+    # again as PRN R1. Expected output: 7, 1
+    "patch-loop": [
+        LDI, 0, 7,
+        LDI, 1, 1,
+        LDI, 4, 0,
+        LDI, 5, 0x0C,
+        PRN, 0,             # 0x0C Target
+        CMP, 4, 1,
+        LDI, 6, 0x20,
+        JEQ, 6,
+        ADD, 4, 1,
+        LDI, 7, 0x0E,
+        PUSH, 1,            # ram[0x0D] = 1
+        JMP, 5,
+        HLT,                # 0x20 End
+    ],
+    # A PUSH rewrites the next instruction of its own basic block.
+    # Expected output: 1
+    "patch-ahead": [
+        LDI, 1, 1,
+        LDI, 7, 0x0A,
+        PUSH, 1,            # ram[0x09] = 1
+        PRN, 0,             # becomes PRN R1
+        HLT,
+    ],
+}
+
+# Programs every run loop has to stop with the same fault
+FAULTING = {
+    "unknown-instruction": [LDI, 0, 5, PRN, 0, 0b11111111],
+    "bad-register": [LDI, 0, 5, PRN, 9, HLT],
+    "stack-underflow": [LDI, 0, 5, PUSH, 0, POP, 1, RET],
+    # calls itself until the stack wraps past 0, overwriting the program on
+    # the way down
+    "runaway-call": [LDI, 0, 3, CALL, 0],
+}
+
+
+def random_program(rng, length=40):
+    """
+    Return a random program as a list of bytes. Jumps only go forward and
+    stores only go to the data area at C0-EF, so every program halts.
+    """
+
+    # pick the instructions first, as (opcode, a, b) with jump targets as
+    # an index into the list, then lay them out
+    instructions = []
+
+    while len(instructions) < length:
+        kind = rng.random()
+        # R0-R4 only: R5 and R6 are the interrupt mask and status, and
+        # writing them would raise interrupts
+        a = rng.randrange(5)
+        b = rng.randrange(5)
+
+        if kind < 0.25:
+            instructions.append((LDI, a, rng.randrange(256)))
+        elif kind < 0.45:
+            instructions.append((rng.choice(ALU_OPS), a, b))
+        elif kind < 0.5:
+            instructions.append((rng.choice(ALU_OPS_1), a, None))
+        elif kind < 0.55:
+            instructions.append((rng.choice([PRN, PRA]), a, None))
+        elif kind < 0.6:
+            instructions.append((rng.choice([LD, NOP]), a, b))
+        elif kind < 0.65:
+            # LDI an address in the data area and store to it
+            instructions.append((LDI, a, rng.randrange(0xc0, 0xf0)))
+            instructions.append((ST, a, b))
+        elif kind < 0.75:
+            instructions.append((PUSH, a, None))
+            instructions.append((POP, b, None))
+        else:
+            # LDI the target into a register and jump to it
+            target = rng.randrange(len(instructions) + 2, length + 2)
+            instructions.append((LDI, a, ("target", target)))
+            instructions.append((rng.choice(JUMPS), a, None))
+
+    instructions.append((HLT, None, None))
+
+    # instruction index -> address
+    addresses = []
+    addr = 0
+    for op, a, b in instructions:
+        addresses.append(addr)
+        addr += instruction_length(op)
+
+    program = []
+    for op, a, b in instructions:
+        program.append(op)
+        if op == NOP:
+            continue
+        if a is not None:
+            program.append(a)
+        if isinstance(b, tuple):
+            target = min(b[1], len(instructions) - 1)
+            # land on the LDI of a jump or store, not the instruction itself,
+            # so it can't use a stale address, and on the PUSH of a POP so
+            # the stack can't underflow
+            if instructions[target][0] in JUMPS + [ST, POP]:
+                target -= 1
+            program.append(addresses[target])
+        elif b is not None:
+            program.append(b)
+
+    return program
+
+
+def quiet_timer(cpu):
+    """
+    Keep the timer from ever raising I0. It goes by the wall clock, so the
+    slow run_reference would see more timer interrupts than the fast loops
+    on a long program like bench_stack, and end somewhere else.
+    """
+    cpu.next_timer = float("inf")
+
+
+def run_program(program, mode):
+    """
+    Run `program` (a list of bytes) with the named run method and return
+    the machine state it ends in.
+    """
+
+    cpu = CPU()
+    cpu.ram[:len(program)] = program
+    quiet_timer(cpu)
+
+    out = cpu.output = CaptureOutput()
+    # a RunResult, or a Profile from run_profiled, which says how the run
+    # ended the same way
+    result = getattr(cpu, mode)()
+    fault = result.reason if result.status == "fault" else None
+
+    return {
+        "ram": list(cpu.ram),
+        "reg": list(cpu.reg),
+        "pc": cpu.pc,
+        "flag": cpu.flag,
+        "running": cpu.running,
+        "output": out.getvalue(),
+        "fault": fault,
+    }
+
+
+def check(name, program):
+    """
+    Compare every mode against run_reference for one program. Returns a
+    list of mismatch descriptions.
+    """
+
+    expected = run_program(program, "run_reference")
+    problems = []
+
+    for mode in MODES:
+        got = run_program(program, mode)
+
+        for key in expected:
+            if got[key] != expected[key]:
+                problems.append(f"{name}: {mode} differs in {key}")
+
+    return problems
+
+
+def check_batch(name, program, rng, lanes=16):
+    """
+    Run `program` on a BatchCPU with random starting registers and compare
+    every lane with a scalar CPU started the same way. Returns a list of
+    mismatch descriptions.
+    """
+
+    from .batch_cpu import BatchCPU
+
+    batch = BatchCPU(lanes)
+    # straight into RAM with no stack limit, as run_program does
+    batch.ram[:, :len(program)] = program
+    # leave IM and IS (R5 and R6) clear, BatchCPU has no interrupts
+    starts = [[rng.randrange(256) for _ in range(5)] for _ in range(lanes)]
+    batch.reg[:, :5] = starts
+    # the scalar CPU always halts or faults on these programs, a lane that
+    # doesn't is a mismatch rather than a hang
+    batch.run(max_steps=100000)
+
+    problems = []
+
+    for lane, start in enumerate(starts):
+        cpu = CPU()
+        cpu.ram[:len(program)] = program
+        cpu.reg[:5] = start
+        quiet_timer(cpu)
+
+        out = cpu.output = CaptureOutput()
+        result = cpu.run_reference()
+
+        expected = {
+            "ram": list(cpu.ram),
+            "reg": list(cpu.reg),
+            "pc": cpu.pc,
+            "flag": cpu.flag,
+            "running": cpu.running,
+            "output": out.getvalue(),
+            "fault": result.reason if result.status == "fault" else None,
+        }
+        got = {
+            "ram": batch.ram[lane].tolist(),
+            "reg": batch.reg[lane].tolist(),
+            "pc": int(batch.pc[lane]),
+            "flag": int(batch.flag[lane]),
+            # a faulted lane stops, the scalar CPU faults still running
+            "running": bool(batch.running[lane]) or lane in batch.faults,
+            "output": "".join(batch.output[lane]),
+            "fault": batch.faults[lane][1] if lane in batch.faults else None,
+        }
+
+        for key in expected:
+            if got[key] != expected[key]:
+                problems.append(f"{name}: BatchCPU lane {lane} differs in {key}")
+
+    return problems
+
+
+def load_examples():
+    programs = {}
+
+    for p in sorted(glob.glob(os.path.join(HERE, "examples", "*.ls8"))):
+        if os.path.basename(p) in SKIP:
+            continue
+
+        cpu = CPU()
+        cpu.load(p)
+        programs[os.path.basename(p)] = list(cpu.ram)
+
+    return programs
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 500
+    seed = int(argv[2]) if len(argv) > 2 else 0
+
+    rng = random.Random(seed)
+
+    programs = load_examples()
+    programs.update(SELF_MODIFYING)
+    programs.update(FAULTING)
+
+    for i in range(count):
+        programs[f"random-{seed}-{i}"] = random_program(rng)
+
+    total = len(programs)
+    problems = []
+    for name, program in programs.items():
+        problems.extend(check(name, program))
+
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print("NumPy is not installed, skipping BatchCPU")
+    else:
+        # the long bench_* workloads would take minutes stepping every
+        # lane through NumPy, the scalar modes cover them
+        batch_programs = {
+            name: program for name, program in load_examples().items()
+            if not name.startswith("bench_")
+        }
+        batch_programs.update(SELF_MODIFYING)
+        batch_programs.update(FAULTING)
+
+        for i in range(count // 10):
+            batch_programs[f"random-batch-{seed}-{i}"] = random_program(rng)
+
+        total += len(batch_programs)
+        for name, program in batch_programs.items():
+            problems.extend(check_batch(name, program, rng))
+
+    for p in problems:
+        print(p)
+
+    print(f"{total} programs, {len(problems)} mismatches")
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
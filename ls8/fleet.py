@@ -0,0 +1,186 @@
+"""
+Fleet runner: run many .ls8 programs across a pool of worker processes.
+
+Usage: ls8.py batch [options] <directory|manifest>
+
+The programs are either every .ls8 file in a directory, or the files listed
+in a manifest (one path per line, relative to the manifest, `#` comments).
+Each program is run once per input set. An input set is one JSON object per
+line of the --inputs file, giving the starting registers and RAM, and
+optionally a string of key presses to replay (see keyboard.ScriptedKeyboard):
+
+    {"name": "small", "reg": {"0": 3, "1": 4}, "ram": {"240": 17}}
+    {"name": "typed", "keys": "hello\n"}
+
+Every run writes one JSON line to the report with the program, input set,
+status (halted, step_budget, time_budget or fault), the PC it stopped at,
+the printed output, the number of instructions executed and the wall time.
+A fault also records its reason (see cpu.RunResult), or the error a program
+that couldn't be loaded stopped with.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from .cpu import CPU
+from .keyboard import ScriptedKeyboard
+from .output import CaptureOutput
+
+
+def find_programs(path):
+    """
+    Return the list of .ls8 files in a directory or named by a manifest.
+    """
+
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(".ls8")
+        )
+
+    programs = []
+    base = os.path.dirname(path)
+
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line == "":
+                continue
+            programs.append(os.path.join(base, line))
+
+    return programs
+
+
+def load_inputs(filename):
+    """
+    Return the list of input sets in a JSON lines file. Without a file there
+    is a single empty input set, so every program runs once.
+    """
+
+    if filename is None:
+        return [{"name": None}]
+
+    inputs = []
+
+    with open(filename) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "":
+                continue
+            inputs.append(json.loads(line))
+            inputs[-1].setdefault("name", str(line_num))
+
+    return inputs
+
+
+def run_job(job):
+    """
+    Run one program with one input set and return its report record. This
+    runs in a worker process.
+    """
+
+    program, inputs, max_steps, max_seconds = job
+
+    record = {
+        "program": program,
+        "input": inputs["name"],
+    }
+
+    start = time.monotonic()
+
+    cpu = CPU()
+    out = cpu.output = CaptureOutput()
+    steps = 0
+    status = None
+
+    try:
+        cpu.load(program)
+
+        for r, v in inputs.get("reg", {}).items():
+            cpu.reg[int(r)] = v
+        for addr, v in inputs.get("ram", {}).items():
+            cpu.ram_write(int(addr), v)
+        if "keys" in inputs:
+            cpu.keyboard = ScriptedKeyboard(inputs["keys"])
+
+        # CPU.run checks both budgets itself, once per chunk of instructions
+        if max_seconds is not None:
+            max_seconds = max(0, max_seconds - (time.monotonic() - start))
+        result = cpu.run(max_steps=max_steps, max_seconds=max_seconds)
+
+        status = result.status
+        steps = result.steps
+        if status == "fault":
+            record["reason"] = result.reason
+
+    except Exception as e:
+        # a program that won't load, or a bug in the emulator; report it
+        # rather than lose the whole batch
+        status = "fault"
+        record["error"] = f"{type(e).__name__}: {e}"
+
+    record.update({
+        "status": status,
+        "pc": cpu.pc,
+        "steps": steps,
+        "wall_time": time.monotonic() - start,
+        "stdout": out.getvalue(),
+    })
+
+    return record
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py batch",
+        description="Run many .ls8 programs in parallel.")
+    parser.add_argument("programs",
+                        help="directory of .ls8 files, or a manifest file")
+    parser.add_argument("--inputs",
+                        help="JSON lines file of input sets")
+    parser.add_argument("--report", default="-",
+                        help="JSON lines report file (default stdout)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes (default one per CPU)")
+    parser.add_argument("--max-steps", type=int, default=1000000,
+                        help="instruction budget per run (default 1000000)")
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="time budget per run (default 10)")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    programs = find_programs(args.programs)
+    inputs = load_inputs(args.inputs)
+
+    jobs = [
+        (program, input_set, args.max_steps, args.max_seconds)
+        for program in programs
+        for input_set in inputs
+    ]
+
+    if args.report == "-":
+        report = sys.stdout
+    else:
+        report = open(args.report, "w")
+
+    # Hand the jobs out in batches so short programs don't pay for a round
+    # trip to the pool each
+    workers = args.jobs or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for record in pool.map(run_job, jobs, chunksize=chunksize):
+            report.write(json.dumps(record) + "\n")
+
+    if report is not sys.stdout:
+        report.close()
+
+    return 0
@@ -0,0 +1,246 @@
+"""
+Binary LS-8 program images (.ls8b).
+
+A compact alternative to the text .ls8 format, loaded straight into RAM with
+no per-line parsing. Layout, all integers little endian:
+
+    header   4s  magic b"LS8B"
+             B   format version (1, or 2 with banks)
+             B   load address
+             B   entry point (initial PC)
+             B   number of symbols
+             H   code length in bytes
+    symbols  for each symbol:
+             B   address
+             B   length of name
+             ... name, ASCII
+    code     the program bytes, copied to RAM at the load address
+    banks    version 2 only, data for extended memory (see devices.py):
+             H   number of segments
+             for each segment:
+             I   offset in extended memory
+             I   length in bytes
+             ... the data
+
+Images without banks are written as version 1, so they still load in older
+emulators.
+"""
+
+import mmap
+import struct
+
+MAGIC = b"LS8B"
+VERSION = 1
+BANKED_VERSION = 2
+
+HEADER = struct.Struct("<4sBBBBH")
+SYMBOL = struct.Struct("<BB")
+
+# The symbol count and each name's length are a byte each
+MAX_SYMBOLS = 255
+MAX_NAME = 255
+SEGMENT = struct.Struct("<II")
+
+
+class ImageError(ValueError):
+    """The file isn't a valid .ls8b image."""
+
+
+class Image:
+    """A parsed program image."""
+
+    def __init__(self, code, load_address=0, entry=0, symbols=None,
+                 segments=None):
+        # code is any bytes-like object, a memoryview into the mapped file
+        # when read by read_image()
+        self.code = code
+        self.load_address = load_address
+        self.entry = entry
+        # label -> address
+        self.symbols = symbols or {}
+        # (offset, data) for extended memory, data as for code
+        self.segments = segments or []
+
+    def extended_size(self):
+        """Bytes of extended memory the segments need."""
+        return max((offset + len(data) for offset, data in self.segments),
+                   default=0)
+
+
+def pack_image(code, load_address=0, entry=0, symbols=None, segments=None):
+    """
+    Return the bytes of an image holding `code`, and `segments`, a list of
+    (offset, data) to load into extended memory.
+    """
+
+    symbols = symbols or {}
+    segments = segments or []
+
+    if load_address + len(code) > 256:
+        raise ImageError(f"{len(code)} bytes at address {load_address} "
+                         "don't fit in 256 bytes of RAM")
+
+    if len(symbols) > MAX_SYMBOLS:
+        raise ImageError(f"{len(symbols)} symbols, an image holds at most "
+                         f"{MAX_SYMBOLS}")
+
+    version = BANKED_VERSION if segments else VERSION
+    parts = [HEADER.pack(MAGIC, version, load_address, entry, len(symbols),
+                         len(code))]
+
+    for name, addr in symbols.items():
+        try:
+            encoded = name.encode("ascii")
+        except UnicodeEncodeError:
+            raise ImageError(f"symbol {name!r} isn't ASCII") from None
+        if len(encoded) > MAX_NAME:
+            raise ImageError(f"symbol {name[:16]}... is {len(encoded)} "
+                             f"bytes, names are at most {MAX_NAME}")
+        if not 0 <= addr <= 0xff:
+            raise ImageError(f"symbol {name} is at address {addr}, "
+                             "outside the 256 bytes of RAM")
+        parts.append(SYMBOL.pack(addr, len(encoded)))
+        parts.append(encoded)
+
+    parts.append(bytes(code))
+
+    if segments:
+        parts.append(struct.pack("<H", len(segments)))
+        for offset, data in segments:
+            parts.append(SEGMENT.pack(offset, len(data)))
+            parts.append(bytes(data))
+
+    return b"".join(parts)
+
+
+def parse_image(data):
+    """Parse an image from a bytes-like object and return an Image."""
+
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise ImageError("file too short for an image header")
+
+    magic, version, load_address, entry, nsyms, length = \
+        HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ImageError("not an LS-8 image (bad magic)")
+
+    if version not in (VERSION, BANKED_VERSION):
+        raise ImageError(f"unsupported image version {version}")
+
+    offset = HEADER.size
+    symbols = {}
+
+    try:
+        for _ in range(nsyms):
+            addr, name_len = SYMBOL.unpack_from(data, offset)
+            offset += SYMBOL.size
+            name = bytes(data[offset:offset + name_len])
+            if len(name) < name_len:
+                raise struct.error
+            symbols[name.decode("ascii")] = addr
+            offset += name_len
+
+    except struct.error:
+        raise ImageError("symbol table runs past the end of the file") \
+            from None
+    except UnicodeDecodeError:
+        raise ImageError(f"symbol name at offset {offset} isn't ASCII") \
+            from None
+
+    if offset + length > len(data):
+        raise ImageError("code runs past the end of the file")
+
+    if load_address + length > 256:
+        raise ImageError("code doesn't fit in 256 bytes of RAM")
+
+    code_offset = offset
+    offset += length
+    # (offset in extended memory, offset in the file, length) of each bank,
+    # all checked before any views are taken, so a bad file doesn't leave
+    # views into the caller's buffer behind
+    banks = []
+
+    if version == BANKED_VERSION:
+        try:
+            count, = struct.unpack_from("<H", data, offset)
+            offset += 2
+            for _ in range(count):
+                start, size = SEGMENT.unpack_from(data, offset)
+                offset += SEGMENT.size
+                if offset + size > len(data):
+                    raise struct.error
+                banks.append((start, offset, size))
+                offset += size
+
+        except struct.error:
+            raise ImageError("banks run past the end of the file") from None
+
+    code = data[code_offset:code_offset + length]
+    segments = [(start, data[at:at + size]) for start, at, size in banks]
+
+    return Image(code, load_address, entry, symbols, segments)
+
+
+def read_image(filename, into, extended=None):
+    """
+    Map the image file `filename`, copy its code into the mutable buffer
+    `into` at the load address, and return the Image. The mapping is closed
+    before returning, so the returned Image.code is a bytes copy.
+
+    If the image has banks, extended(size) is called with the bytes of
+    extended memory they need and returns an object to load() each
+    segment's (offset, data) into; the segments are copied there straight
+    from the mapping and left out of the returned Image.
+    """
+
+    with open(filename, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            raise ImageError("file too short for an image header")
+
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            image = parse_image(view)
+            code = image.code
+            start = image.load_address
+            into[start:start + len(code)] = code
+            image.code = bytes(code)
+            code.release()
+
+            segments = image.segments
+            needed = image.extended_size()
+            image.segments = []
+            try:
+                if segments:
+                    if extended is None:
+                        raise ImageError("image has banks but there's no "
+                                         "extended memory to load them into")
+                    memory = extended(needed)
+                    for offset, data in segments:
+                        try:
+                            memory.load(offset, data)
+                        except ValueError as e:
+                            raise ImageError(str(e)) from None
+            finally:
+                for offset, data in segments:
+                    data.release()
+        finally:
+            # every view has to go before the mapping can close
+            view.release()
+
+    return image
+
+
+def write_image(filename, code, load_address=0, entry=0, symbols=None,
+                segments=None):
+    """Write `code` out as an image file."""
+
+    with open(filename, "wb") as f:
+        f.write(pack_image(code, load_address, entry, symbols, segments))
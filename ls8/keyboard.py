@@ -0,0 +1,113 @@
+"""
+Keyboard input for the LS-8.
+
+A key press is delivered by writing its character code to RAM address F4 and
+setting bit 1 of the IS register (R6), raising interrupt I1. keyboard.asm
+installs a handler for I1 that reads F4 and prints it.
+
+Keys are handed to the CPU through a deque: the input source appends to it
+whenever it likes, and the CPU pops at most one key each time it polls for
+interrupts (see CPU.poll_interrupts). deque.append() and deque.popleft() are
+atomic, so the reader thread never takes a lock and the instruction loop
+never waits on input.
+
+    cpu.keyboard = TerminalKeyboard(sys.stdin)     # interactive
+    cpu.keyboard = ScriptedKeyboard("hello")       # replayable, for tests
+"""
+
+import collections
+import os
+import threading
+
+# Address the key press is written to
+KEY_ADDRESS = 0xf4
+
+# Interrupt raised for a key press, I1
+KEY_INTERRUPT = 0b00000010
+
+
+class Keyboard:
+    """Base class of keyboard input sources. Keys go in `pending`."""
+
+    def __init__(self):
+        self.pending = collections.deque()
+
+    def poll(self, cpu):
+        """
+        Deliver the next pending key to `cpu`, if there is one and the CPU
+        has taken the last one (its interrupt isn't still pending).
+        """
+        if not self.pending or cpu.reg[6] & KEY_INTERRUPT:
+            return
+
+        cpu.ram_write(KEY_ADDRESS, self.pending.popleft())
+        cpu.reg[6] |= KEY_INTERRUPT
+
+
+class ScriptedKeyboard(Keyboard):
+    """
+    A fixed list of key presses, delivered one every `interval` polls. The
+    run loop polls once per RUN_CHUNK instructions, so a given script is
+    replayed at the same points in the program on every run.
+    """
+
+    def __init__(self, keys, interval=1):
+        super().__init__()
+        self.script = collections.deque(
+            ord(k) if isinstance(k, str) else k for k in keys)
+        self.interval = interval
+        self.polls = 0
+
+    def poll(self, cpu):
+        self.polls += 1
+        if self.script and self.polls % self.interval == 0:
+            self.pending.append(self.script.popleft())
+
+        super().poll(cpu)
+
+    @property
+    def done(self):
+        """True once every key has been delivered."""
+        return not self.script and not self.pending
+
+
+class TerminalKeyboard(Keyboard):
+    """
+    Key presses read from a file (normally sys.stdin) by a background
+    thread. A terminal is put in cbreak mode while the thread runs, so keys
+    arrive as they're pressed instead of a line at a time; call close() to
+    put it back.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.fd = stream.fileno()
+        self.saved_mode = None
+
+        if os.isatty(self.fd):
+            import termios
+            import tty
+            self.saved_mode = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+
+        # a daemon thread, so a blocked read doesn't stop the program
+        # exiting when the CPU halts
+        self.thread = threading.Thread(target=self.reader, daemon=True)
+        self.thread.start()
+
+    def reader(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64)
+            except OSError:
+                return
+            if not data:
+                # end of file
+                return
+            self.pending.extend(data)
+
+    def close(self):
+        if self.saved_mode is not None:
+            import termios
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
@@ -1,11 +1,154 @@
 #!/usr/bin/env python3
 
-"""Main."""
+"""
+Main.
 
+Usage:
+
+    ls8.py program           run a .ls8, .ls8b or .asm program
+    ls8.py run program       the same; a program of "-" is assembler source
+                             read from stdin
+    ls8.py run --data file program
+                             the same, with `file` mapped in as extended
+                             memory (see devices.py)
+    ls8.py run --record log program
+                             the same, logging key presses and interrupts
+                             to replay the run exactly (see replay.py)
+    ls8.py batch|trace|profile|timing|replay|debug ...
+"""
+
+import importlib.util
+import os
 import sys
-from cpu import *
 
-cpu = CPU()
+if __name__ == "__main__" and not __package__:
+    # Run as a script: load this directory as the ls8 package, without
+    # putting anything on sys.path, and run main() from it
+    HERE = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(
+        "ls8", os.path.join(HERE, "__init__.py"),
+        submodule_search_locations=[HERE])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["ls8"] = package
+    spec.loader.exec_module(package)
+
+    from ls8.ls8 import main
+    sys.exit(main(sys.argv))
+
+from .cpu import CPU, LoadError  # noqa: E402
+from .devices import (attach_extended_memory,  # noqa: E402
+                      attach_standard_devices, map_file)
+from .keyboard import TerminalKeyboard  # noqa: E402
+from .output import ALWAYS, StreamOutput  # noqa: E402
+
+
+def main(argv):
+    """Run the program named on the command line, or a subcommand."""
+
+    # ls8.py batch ... runs many programs, see fleet.py
+    if len(argv) > 1 and argv[1] == "batch":
+        from .fleet import main as batch_main
+        return batch_main(argv[2:])
+
+    # ls8.py trace ... keeps the last instructions run, see tracer.py
+    if len(argv) > 1 and argv[1] == "trace":
+        from .tracer import run_main
+        return run_main(argv[2:])
+
+    # ls8.py profile ... counts where the instructions go, see profiler.py
+    if len(argv) > 1 and argv[1] == "profile":
+        from .profiler import main as profile_main
+        return profile_main(argv[2:])
+
+    # ls8.py timing ... counts cycles with a cache and branch predictor,
+    # see timing.py
+    if len(argv) > 1 and argv[1] == "timing":
+        from .timing import main as timing_main
+        return timing_main(argv[2:])
+
+    # ls8.py replay ... runs a program again from a log, see replay.py
+    if len(argv) > 1 and argv[1] == "replay":
+        from .replay import main as replay_main
+        return replay_main(argv[2:])
+
+    # ls8.py debug ... serves a program to a debugger, see debugger.py
+    if len(argv) > 1 and argv[1] == "debug":
+        from .debugger import main as debug_main
+        return debug_main(argv[2:])
+
+    # ls8.py run ... is the same as running the program directly
+    if len(argv) > 1 and argv[1] == "run":
+        argv = argv[:1] + argv[2:]
+
+    data = None
+    record = None
+    while len(argv) > 2 and argv[1] in ("--data", "--record"):
+        if argv[1] == "--data":
+            data = argv[2]
+        else:
+            record = argv[2]
+        argv = argv[:1] + argv[3:]
+
+    if len(argv) != 2:
+        print("usage: ls8.py [run] [--data file] [--record log] "
+              "program.ls8|program.ls8b|program.asm|-", file=sys.stderr)
+        return 2
+
+    cpu = CPU()
+
+    if data is not None:
+        # the file is the memory, pages are read as the program uses them
+        # and what it writes stays in this process
+        try:
+            attach_extended_memory(cpu, map_file(data, writable=True))
+        except (OSError, ValueError) as e:
+            print(f"{data}: {e}", file=sys.stderr)
+            return 2
+
+    try:
+        if argv[1] == "-":
+            # assembler source piped in, assembled in this process
+            cpu.load_source(sys.stdin, "<stdin>")
+        else:
+            cpu.load(argv[1])
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    # Print every PRN and PRA straight away, as they happen
+    cpu.output = StreamOutput(sys.stdout, flush=ALWAYS)
+
+    # The keyboard port, timer and console at F4-F6
+    attach_standard_devices(cpu)
+
+    # Key presses on stdin go to address F4 and raise I1, unless stdin was
+    # the program
+    if argv[1] != "-":
+        cpu.keyboard = TerminalKeyboard(sys.stdin)
+
+    if record is not None:
+        from .replay import Recorder
+        try:
+            cpu.inputs = Recorder(record)
+        except OSError as e:
+            print(f"{record}: {e.strerror}", file=sys.stderr)
+            return 2
+
+    try:
+        result = cpu.run()
+    finally:
+        if cpu.keyboard is not None:
+            cpu.keyboard.close()
+        if cpu.inputs is not None:
+            cpu.inputs.close()
+
+    if result.status == "fault":
+        print(f"Fault at address {result.pc}: {result.reason}",
+              file=sys.stderr)
+        return 1
+
+    return 0
+
 
-cpu.load(sys.argv[1])
-cpu.run()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
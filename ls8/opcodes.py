@@ -0,0 +1,117 @@
+"""
+LS-8 opcodes, shared by the emulator (cpu.py) and the assembler
+(../asm/asm.py).
+
+Everything else about an instruction comes from the bits of its opcode,
+`AABCDDDD`:
+
+* `AA` Number of operands for this opcode, 0-2
+* `B` 1 if this is an ALU operation
+* `C` 1 if this instruction sets the PC
+* `DDDD` Instruction identifier (for ALU operations, the ALU operation)
+"""
+
+ADD = 0b10100000
+AND = 0b10101000
+CALL = 0b01010000
+CMP = 0b10100111
+DEC = 0b01100110
+DIV = 0b10100011
+HLT = 0b00000001
+INC = 0b01100101
+INT = 0b01010010
+IRET = 0b00010011
+JEQ = 0b01010101
+JGE = 0b01011010
+JGT = 0b01010111
+JLE = 0b01011001
+JLT = 0b01011000
+JMP = 0b01010100
+JNE = 0b01010110
+LD = 0b10000011
+LDI = 0b10000010
+MOD = 0b10100100
+MUL = 0b10100010
+NOP = 0b00000000
+NOT = 0b01101001
+OR = 0b10101010
+POP = 0b01000110
+PRA = 0b01001000
+PRN = 0b01000111
+PUSH = 0b01000101
+RET = 0b00010001
+SHL = 0b10101100
+SHR = 0b10101101
+ST = 0b10000100
+SUB = 0b10100001
+XOR = 0b10101011
+
+# mnemonic -> opcode
+OPCODES = {
+    "ADD": ADD,
+    "AND": AND,
+    "CALL": CALL,
+    "CMP": CMP,
+    "DEC": DEC,
+    "DIV": DIV,
+    "HLT": HLT,
+    "INC": INC,
+    "INT": INT,
+    "IRET": IRET,
+    "JEQ": JEQ,
+    "JGE": JGE,
+    "JGT": JGT,
+    "JLE": JLE,
+    "JLT": JLT,
+    "JMP": JMP,
+    "JNE": JNE,
+    "LD": LD,
+    "LDI": LDI,
+    "MOD": MOD,
+    "MUL": MUL,
+    "NOP": NOP,
+    "NOT": NOT,
+    "OR": OR,
+    "POP": POP,
+    "PRA": PRA,
+    "PRN": PRN,
+    "PUSH": PUSH,
+    "RET": RET,
+    "SHL": SHL,
+    "SHR": SHR,
+    "ST": ST,
+    "SUB": SUB,
+    "XOR": XOR,
+}
+
+# opcode -> mnemonic
+NAMES = {code: name for name, code in OPCODES.items()}
+
+# Instructions whose second operand is an immediate value rather than a
+# register number
+IMMEDIATE = {LDI}
+
+
+def operand_count(op):
+    """Number of operands, from the `AA` bits."""
+    return op >> 6
+
+
+def instruction_length(op):
+    """Length of the instruction in bytes, the opcode plus its operands."""
+    return (op >> 6) + 1
+
+
+def is_alu(op):
+    """True for ALU operations, from the `B` bit."""
+    return (op >> 5) & 1 == 1
+
+
+def sets_pc(op):
+    """True for instructions that set the PC themselves, from the `C` bit."""
+    return (op >> 4) & 1 == 1
+
+
+def alu_op(op):
+    """The ALU operation number of an ALU instruction, its `DDDD` bits."""
+    return op & 0x0f
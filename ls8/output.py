@@ -0,0 +1,128 @@
+"""
+Output devices for PRN and PRA.
+
+The CPU hands every printed value to its `output` device instead of calling
+print() itself:
+
+    prn(value)   PRN, a decimal number on its own line ("Print this: 8")
+    pra(value)   PRA, a single character
+
+StreamOutput buffers the text and writes it to a stream (stdout by default)
+according to its flush policy:
+
+    ALWAYS   after every PRN or PRA, like the original print() calls
+    LINE     when a newline is printed
+    FULL     when BUFFER_SIZE pieces of text have built up
+
+Whatever policy is used, the run loops flush when they return.
+
+CaptureOutput keeps everything in memory, for batch runs and tests, and
+NullOutput throws it away, for benchmarks.
+"""
+
+import sys
+
+ALWAYS = "always"
+LINE = "line"
+FULL = "full"
+
+# Pieces of text a FULL buffer holds before it's written out
+BUFFER_SIZE = 4096
+
+
+class Output:
+    """
+    Base class of output devices. Subclasses provide write(), the one way
+    text goes out: prn() and pra() format their value and write() it, and
+    so do the CPU's own messages, like DIV's "Division by zero".
+    """
+
+    def prn(self, value):
+        self.write(f'Print this: {value}\n')
+
+    def pra(self, value):
+        self.write(chr(value))
+
+    def write(self, text):
+        raise NotImplementedError(
+            f"{type(self).__name__} doesn't say where its text goes, "
+            "subclasses of Output have to provide write()")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class StreamOutput(Output):
+    """
+    Buffered output to a text stream. With no stream given it writes to
+    whatever sys.stdout is at the time of the flush, so
+    contextlib.redirect_stdout() still captures it.
+    """
+
+    def __init__(self, stream=None, flush=LINE):
+        if flush not in (ALWAYS, LINE, FULL):
+            raise ValueError(f"unknown flush policy {flush!r}")
+
+        self.stream = stream
+        self.policy = flush
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+
+        if self.policy == ALWAYS or \
+                (self.policy == LINE and text.endswith('\n')) or \
+                len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        stream = self.stream or sys.stdout
+        stream.write(''.join(self.buffer))
+        stream.flush()
+        self.buffer.clear()
+
+
+class FileOutput(StreamOutput):
+    """Buffered output to a file, written out when full or closed."""
+
+    def __init__(self, filename, flush=FULL):
+        super().__init__(open(filename, 'w'), flush)
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+
+class CaptureOutput(Output):
+    """Output kept in memory. getvalue() returns it as one string."""
+
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+
+    def getvalue(self):
+        return ''.join(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+
+
+class NullOutput(Output):
+    """Output thrown away, without even formatting it."""
+
+    def prn(self, value):
+        pass
+
+    def pra(self, value):
+        pass
+
+    def write(self, text):
+        pass
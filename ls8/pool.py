@@ -0,0 +1,105 @@
+"""
+A pool of reusable CPUs, for running many short programs in one process.
+
+Making a CPU builds its handler tables, which costs more than running most
+small programs, so a service that runs a guest program per request should
+keep CPUs around and reset() them between programs instead:
+
+    import ls8
+
+    pool = ls8.CPUPool(4)
+    result = pool.run(program_bytes, max_steps=100000)
+    result.status, result.output, result.reg
+
+CPUPool.run() takes the program as bytes (or a list of ints, as
+CPU.load_bytes does) and returns the cpu.RunResult with what the program
+printed and the final machine state added:
+
+    output   everything printed by PRN and PRA, as a string
+    reg      the registers R0-R7 at the end, as bytes
+    ram      memory at the end, as bytes
+    flag     the flags register
+
+The pool is safe to share between threads. A thread that needs a CPU for
+longer, to load a file or poke at memory before running, can take one with
+
+    with pool.cpu() as cpu:
+        ...
+
+which resets it and hands it back afterwards.
+"""
+
+import contextlib
+import threading
+
+from .cpu import CPU
+from .output import CaptureOutput
+
+
+class CPUPool:
+    """
+    Up to `size` idle CPUs, each with its own CaptureOutput. When every CPU
+    is in use, acquire() makes a new one rather than waiting, and release()
+    drops it if the pool is already full.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = [self.new_cpu() for _ in range(size)]
+
+    def new_cpu(self):
+        cpu = CPU()
+        cpu.output = CaptureOutput()
+        return cpu
+
+    def acquire(self):
+        """Take an idle CPU, in its power on state."""
+        with self.lock:
+            if self.idle:
+                # the most recently used one, its memory is likely still
+                # in the processor's caches
+                return self.idle.pop()
+
+        return self.new_cpu()
+
+    def release(self, cpu):
+        """Reset `cpu`, detach its devices and return it to the pool."""
+        cpu.reset()
+        # the next user mustn't see this one's devices or extended memory
+        cpu.detach_all()
+        cpu.keyboard = None
+        cpu.inputs = None
+        cpu.output.clear()
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(cpu)
+
+    @contextlib.contextmanager
+    def cpu(self):
+        """acquire() a CPU for a with block, and release() it after."""
+        cpu = self.acquire()
+        try:
+            yield cpu
+        finally:
+            self.release(cpu)
+
+    def run(self, program, max_steps=None, max_seconds=None, keyboard=None):
+        """
+        Load `program` into a CPU from the pool and run it, with the
+        budgets of CPU.run. Returns the RunResult with output, reg, ram and
+        flag added. Raises cpu.LoadError if the program doesn't fit.
+        """
+        with self.cpu() as cpu:
+            cpu.load_bytes(program)
+            cpu.keyboard = keyboard
+
+            result = cpu.run(max_steps, max_seconds)
+
+            result.output = cpu.output.getvalue()
+            result.reg = bytes(cpu.reg)
+            result.ram = bytes(cpu.ram)
+            result.flag = cpu.flag
+
+        return result
@@ -0,0 +1,252 @@
+"""
+Execution profiler: where does an LS-8 program spend its instructions?
+
+Usage: ls8.py profile [--map program.map] [--top N] program.ls8
+
+The program can also be assembler source (program.asm), which brings its
+labels and source lines without a map file.
+
+run_profiled() is a copy of CPU.run's loop with counters added, so
+profiling costs nothing unless it's used. It counts:
+
+* executions of every opcode
+* executions of the instruction at every address
+* calls to every CALL target
+* taken and not taken for every conditional jump (JEQ, JNE, JGT, ...)
+
+The report names addresses after the nearest label at or below them, from
+the assembler's map file (asm.py --map) or a binary image's symbol table,
+and with a map file shows the source line each hot address came from.
+"""
+
+import argparse
+import json
+import sys
+
+from .cpu import (CPU, CALL, JEQ, JGE, JGT, JLE, JLT, JNE, NAMES, RUN_CHUNK,
+                  CPUFault, LoadError)
+
+CONDITIONAL_JUMPS = {JEQ, JNE, JGT, JGE, JLT, JLE}
+
+
+class Profile:
+    """
+    Counters collected by run_profiled(), and how the run ended: `status`,
+    `pc` and `reason` as in cpu.RunResult.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.status = "halted"
+        self.pc = 0
+        self.reason = None
+        # opcode -> executions
+        self.opcodes = [0] * 256
+        # address -> executions of the instruction there
+        self.addresses = [0] * 256
+        # CALL target -> calls
+        self.calls = [0] * 256
+        # address of a conditional jump -> times taken, not taken
+        self.taken = [0] * 256
+        self.not_taken = [0] * 256
+
+
+def run_profiled(cpu, max_steps=None):
+    """
+    Run the CPU like CPU.run, counting as it goes, and return the Profile.
+    """
+
+    profile = Profile()
+    opcodes = profile.opcodes
+    addresses = profile.addresses
+    calls = profile.calls
+    taken = profile.taken
+    not_taken = profile.not_taken
+
+    ram = cpu.ram
+    decoded = cpu.decoded
+    decode = cpu.decode
+    steps = 0
+    pc = cpu.pc
+    i = 0
+
+    try:
+        while cpu.running:
+            chunk = RUN_CHUNK
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - steps)
+                if chunk <= 0:
+                    profile.status = "step_budget"
+                    break
+
+            pc = cpu.pc
+            i = 0
+            cpu.poll_interrupts()
+
+            for i in range(chunk):
+                pc = cpu.pc
+                entry = decoded.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                handler, reg_a, reg_b, length = entry
+
+                ir = ram[pc]
+                opcodes[ir] += 1
+                addresses[pc] += 1
+
+                next_pc = (pc + length) & 0xff
+                cpu.pc = next_pc
+                handler(reg_a, reg_b)
+
+                if ir in CONDITIONAL_JUMPS:
+                    if cpu.pc != next_pc:
+                        taken[pc] += 1
+                    else:
+                        not_taken[pc] += 1
+                elif ir == CALL:
+                    calls[cpu.pc] += 1
+
+                if not cpu.running:
+                    steps += i + 1
+                    break
+            else:
+                steps += chunk
+
+    except CPUFault as e:
+        # as CPU.run does, stop on the instruction at fault
+        steps += i
+        cpu.pc = pc if e.pc is None else e.pc
+        profile.status = "fault"
+        profile.reason = e.reason
+
+    cpu.output.flush()
+
+    profile.steps = steps
+    profile.pc = cpu.pc
+    return profile
+
+
+def load_map(filename):
+    """
+    Read an assembler map file and return (symbols, lines), where lines maps
+    an address to its (line number, source text).
+    """
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    lines = {int(addr): tuple(info) for addr, info in data["lines"].items()}
+
+    return data["symbols"], lines
+
+
+def symbolize(addr, symbols):
+    """Name `addr` as LABEL or LABEL+offset, or just the address."""
+
+    best = None
+    for name, value in symbols.items():
+        if value <= addr and (best is None or value > symbols[best]):
+            best = name
+
+    if best is None:
+        return f"{addr:02X}"
+    if symbols[best] == addr:
+        return best
+    return f"{best}+{addr - symbols[best]}"
+
+
+def report(profile, symbols=None, lines=None, top=20, file=sys.stdout):
+    """Print the profile, hottest first."""
+
+    symbols = symbols or {}
+    lines = lines or {}
+    total = profile.steps or 1
+
+    def out(*args):
+        print(*args, file=file)
+
+    out(f"{profile.steps} instructions")
+    if profile.status == "fault":
+        out(f"fault at {profile.pc:02X}: {profile.reason}")
+
+    out()
+    out(f"{'opcode':<8} {'count':>10} {'%':>6}")
+    by_opcode = sorted(
+        (count, op) for op, count in enumerate(profile.opcodes) if count)
+    for count, op in reversed(by_opcode):
+        out(f"{NAMES.get(op, f'{op:08b}'):<8} {count:>10} "
+            f"{count * 100 / total:>6.1f}")
+
+    out()
+    out(f"{'address':<8} {'count':>10} {'%':>6}  {'where':<16} source")
+    by_address = sorted(
+        (count, addr) for addr, count in enumerate(profile.addresses)
+        if count)
+    for count, addr in reversed(by_address[-top:]):
+        line_num, text = lines.get(addr, ("", ""))
+        out(f"{addr:02X}{'':<6} {count:>10} {count * 100 / total:>6.1f}  "
+            f"{symbolize(addr, symbols):<16} {line_num:>4} {text}")
+
+    if any(profile.calls):
+        out()
+        out(f"{'call to':<8} {'count':>10}  where")
+        by_target = sorted(
+            (count, addr) for addr, count in enumerate(profile.calls)
+            if count)
+        for count, addr in reversed(by_target):
+            out(f"{addr:02X}{'':<6} {count:>10}  {symbolize(addr, symbols)}")
+
+    branches = [addr for addr in range(256)
+                if profile.taken[addr] or profile.not_taken[addr]]
+    if branches:
+        out()
+        out(f"{'branch':<8} {'taken':>10} {'not taken':>10} {'taken %':>8}"
+            f"  where")
+        for addr in branches:
+            taken = profile.taken[addr]
+            not_taken = profile.not_taken[addr]
+            out(f"{addr:02X}{'':<6} {taken:>10} {not_taken:>10} "
+                f"{taken * 100 / (taken + not_taken):>8.1f}  "
+                f"{symbolize(addr, symbols)}")
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py profile",
+        description="Run an LS-8 program and report where its "
+                    "instructions go.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file")
+    parser.add_argument("--map",
+                        help="map file from asm.py --map, for labels and "
+                             "source lines")
+    parser.add_argument("--top", type=int, default=20,
+                        help="hot addresses to list (default 20)")
+    parser.add_argument("--max-steps", type=int, default=None,
+                        help="stop after this many instructions")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    # a binary image or assembler source bring their own labels, and
+    # source their lines
+    symbols, lines = cpu.symbols, cpu.lines
+    if args.map is not None:
+        symbols, lines = load_map(args.map)
+
+    profile = run_profiled(cpu, args.max_steps)
+
+    # keep the report apart from anything the program printed
+    report(profile, symbols, lines, args.top, file=sys.stderr)
+
+    return 0
@@ -0,0 +1,263 @@
+"""
+Deterministic record and replay of a run.
+
+An LS-8 program only sees the outside world when CPU.run polls for
+interrupts: a key press is written to F4 and raises I1, the timer raises
+I0, and a pending interrupt is serviced at whatever instruction the poll
+happens to land on. Everything else follows from the program. A Recorder
+takes over those polls and logs what they did, each event stamped with
+cpu.executed, the instructions run so far; a Replayer feeds the same events
+back at the same instruction counts, with no keyboard or clock, so the run
+repeats exactly.
+
+    ls8.py run --record run.log program.ls8     record
+    ls8.py replay run.log program.ls8           replay it
+
+A log file is a header followed by 6 byte events, all little endian:
+
+    header   4s  magic b"LS8R"
+             B   format version (1)
+    event    I   instructions since the previous event
+             B   kind: RAISE, KEY or DELIVER
+             B   IS bits raised, key value or interrupt number
+
+With checkpoints from CPU.run_checkpointed() taken while recording, a
+replay can start from the last checkpoint before a fault instead of from
+the beginning (run_replay's `checkpoint`). Only run() counts instructions,
+so record and replay with run(), not the other run loops. Reads of the
+Timer device (devices.py) aren't recorded.
+"""
+
+import argparse
+import struct
+import sys
+
+from .cpu import CPU, LoadError, RunResult
+from .devices import attach_standard_devices
+from .keyboard import KEY_ADDRESS
+from .output import ALWAYS, StreamOutput
+
+MAGIC = b"LS8R"
+VERSION = 1
+
+HEADER = struct.Struct("<4sB")
+EVENT = struct.Struct("<IBB")
+
+# Event kinds
+RAISE = 0
+KEY = 1
+DELIVER = 2
+# no event, just MAX_GAP instructions passing, for gaps an I can't hold
+GAP = 3
+
+MAX_GAP = 0xffffffff
+
+# Bytes of events a Recorder holds before writing them out
+BUFFER_SIZE = 65536
+
+
+class ReplayError(ValueError):
+    """A log file isn't a valid replay log."""
+
+
+class Recorder:
+    """
+    Polls the keyboard and timer for a CPU as CPU.poll_interrupts does,
+    logging what they raised and which interrupts were serviced to the file
+    `path`. Install it with cpu.inputs = recorder, and close() it after.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.buffer = bytearray()
+        # instruction count of the last event
+        self.last = 0
+        self.events = 0
+
+    def log(self, count, kind, value):
+        gap = count - self.last
+        while gap > MAX_GAP:
+            self.buffer += EVENT.pack(MAX_GAP, GAP, 0)
+            gap -= MAX_GAP
+
+        self.buffer += EVENT.pack(gap, kind, value)
+        self.last = count
+        self.events += 1
+
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def poll(self, cpu):
+        count = cpu.executed
+        before = cpu.reg[6]
+
+        cpu.poll_inputs()
+
+        raised = cpu.reg[6] & ~before
+        if raised:
+            if raised & 0b00000010:
+                # the key press, already written to F4
+                self.log(count, KEY, cpu.ram_read(KEY_ADDRESS))
+            self.log(count, RAISE, raised)
+
+        i = cpu.pending_interrupt()
+        if i is not None:
+            self.log(count, DELIVER, i)
+            cpu.interrupt(i)
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Replayer:
+    """
+    Feeds the events of a log back to a CPU in place of its keyboard,
+    timer and interrupt polling. Events before `start`, the instruction
+    count replaying starts from, are skipped.
+    """
+
+    def __init__(self, events, start=0):
+        self.events = [event for event in events if event[0] >= start]
+        self.next = 0
+
+    def due(self):
+        """Instruction count of the next event, None when there are none."""
+        if self.next < len(self.events):
+            return self.events[self.next][0]
+        return None
+
+    def poll(self, cpu):
+        events = self.events
+        count = cpu.executed
+
+        while self.next < len(events) and events[self.next][0] <= count:
+            _, kind, value = events[self.next]
+            self.next += 1
+
+            if kind == KEY:
+                cpu.ram_write(KEY_ADDRESS, value)
+            elif kind == RAISE:
+                cpu.reg[6] |= value
+            elif kind == DELIVER:
+                cpu.interrupt(value)
+
+
+def read_log(filename):
+    """Return the events of a log file as (instruction count, kind, value)."""
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise ReplayError("file too short for a replay log header")
+
+    magic, version = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ReplayError("not an LS-8 replay log (bad magic)")
+
+    if version != VERSION:
+        raise ReplayError(f"unsupported replay log version {version}")
+
+    if (len(data) - HEADER.size) % EVENT.size:
+        raise ReplayError("replay log ends part way through an event")
+
+    events = []
+    count = 0
+
+    for gap, kind, value in EVENT.iter_unpack(data[HEADER.size:]):
+        count += gap
+        if kind != GAP:
+            events.append((count, kind, value))
+
+    return events
+
+
+def run_replay(cpu, events, checkpoint=None, max_steps=None):
+    """
+    Run the CPU with the recorded `events` in place of its inputs, from
+    the snapshot `checkpoint` if given. Each run() stops on the next
+    event's instruction count so it can be delivered exactly there.
+    Returns a cpu.RunResult.
+    """
+
+    if checkpoint is not None:
+        cpu.restore(checkpoint)
+
+    replayer = Replayer(events, cpu.executed)
+    saved, cpu.inputs = cpu.inputs, replayer
+    steps = 0
+    result = RunResult("halted", 0, cpu.pc)
+
+    try:
+        while cpu.running:
+            due = replayer.due()
+
+            if due is not None and due <= cpu.executed:
+                # run() only polls once it has a step to run
+                cpu.poll_interrupts()
+                continue
+
+            budget = None if due is None else due - cpu.executed
+            if max_steps is not None:
+                if steps >= max_steps:
+                    result = RunResult("step_budget", steps, cpu.pc)
+                    break
+                budget = min(budget or max_steps, max_steps - steps)
+
+            result = cpu.run(max_steps=budget)
+            steps += result.steps
+            if result.status == "fault":
+                break
+
+    finally:
+        cpu.inputs = saved
+
+    result.steps = steps
+    return result
+
+
+def main(argv):
+    """ls8.py replay: run a program again from a log."""
+
+    parser = argparse.ArgumentParser(
+        prog="ls8.py replay",
+        description="Run an LS-8 program again with the key presses and "
+                    "interrupts recorded by ls8.py run --record.")
+    parser.add_argument("log", help="replay log")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file")
+    parser.add_argument("--max-steps", type=int, default=None,
+                        help="stop after this many instructions")
+    args = parser.parse_args(argv)
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+        events = read_log(args.log)
+    except (LoadError, ReplayError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    except OSError as e:
+        print(f"{args.log}: {e.strerror}", file=sys.stderr)
+        return 2
+
+    # the same machine ls8.py run records on
+    cpu.output = StreamOutput(sys.stdout, flush=ALWAYS)
+    attach_standard_devices(cpu)
+
+    result = run_replay(cpu, events, max_steps=args.max_steps)
+
+    if result.status == "fault":
+        print(f"Fault at address {result.pc} after {cpu.executed} "
+              f"instructions: {result.reason}", file=sys.stderr)
+        return 1
+
+    return 0
@@ -0,0 +1,49 @@
+"""
+The assembler, ../asm/asm.py: the example sources have to assemble to the
+.ls8 files checked in next to the emulator, byte for byte.
+"""
+
+import glob
+import os
+
+import pytest
+
+from ..cpu import load_assembler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ASM_DIR = os.path.join(HERE, "..", "..", "asm")
+EXAMPLES = os.path.join(HERE, "..", "examples")
+
+SOURCES = sorted(
+    p for p in glob.glob(os.path.join(ASM_DIR, "*.asm"))
+    if os.path.exists(os.path.join(
+        EXAMPLES, os.path.basename(p)[:-len(".asm")] + ".ls8")))
+
+# checked in with comments written by hand, only the bytes are the
+# assembler's
+HANDWRITTEN = {"print8"}
+
+
+def name_of(path):
+    return os.path.basename(path)[:-len(".asm")]
+
+
+def program_bytes(text):
+    """The bytes of a .ls8 file, without its comments and blank lines."""
+    values = (line.split("#")[0].strip() for line in text.splitlines())
+    return [int(v, 2) for v in values if v]
+
+
+@pytest.mark.parametrize("source", SOURCES, ids=name_of)
+def test_examples_assemble_to_checked_in_output(source):
+    asm = load_assembler()
+
+    with open(source) as f:
+        text = asm.assemble(f.read())
+    with open(os.path.join(EXAMPLES, name_of(source) + ".ls8")) as f:
+        expected = f.read()
+
+    if name_of(source) in HANDWRITTEN:
+        assert program_bytes(text) == program_bytes(expected)
+    else:
+        assert text == expected
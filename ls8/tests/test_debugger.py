@@ -0,0 +1,62 @@
+"""
+Breakpoints in the debug server's continue, which runs the program in
+slices of SLICE instructions.
+"""
+
+from .. import debugger
+from ..cpu import CPU
+from ..debugger import DebugServer, run_checked
+from ..output import CaptureOutput
+
+PROGRAM = [
+    0b10000010, 0, 5,       # LDI R0,5
+    0b10000010, 1, 6,       # LDI R1,6
+    0b01000111, 0,          # PRN R0        <- breakpoint at 6
+    0b00000001,             # HLT
+]
+
+
+def new_cpu():
+    cpu = CPU()
+    cpu.load_bytes(PROGRAM)
+    cpu.output = CaptureOutput()
+    return cpu
+
+
+def test_run_checked_stops_on_breakpoint_it_started_on():
+    cpu = new_cpu()
+    breakpoints = bytearray(256)
+    breakpoints[6] = 1
+
+    # runs out of steps right on the breakpoint
+    result, _ = run_checked(cpu, breakpoints, {}, 2)
+    assert (result.status, result.pc) == ("step_budget", 6)
+
+    result, _ = run_checked(cpu, breakpoints, {}, 2)
+    assert (result.status, result.pc) == ("breakpoint", 6)
+    assert cpu.output.getvalue() == ""
+
+    # continuing from it gets past it
+    result, _ = run_checked(cpu, breakpoints, {}, 10, skip_first=True)
+    assert result.status == "halted"
+    assert cpu.output.getvalue() == "Print this: 5\n"
+
+
+def test_continue_stops_on_breakpoint_at_slice_boundary(monkeypatch):
+    monkeypatch.setattr(debugger, "SLICE", 2)
+
+    server = DebugServer(new_cpu())
+    # no client, nothing to interrupt the continue
+    server.interrupted = lambda: False
+
+    try:
+        server.set_point("0", 6, True)
+
+        assert server.resume() == "S05"
+        assert server.cpu.pc == 6
+        assert server.cpu.output.getvalue() == ""
+
+        assert server.resume() == "W00"
+        assert server.cpu.output.getvalue() == "Print this: 5\n"
+    finally:
+        server.close()
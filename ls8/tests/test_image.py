@@ -0,0 +1,56 @@
+"""
+Symbol tables pack_image() can't write are ImageError, and AsmError from
+the assembler, rather than struct.error or UnicodeError; banked images
+whose extended memory can't be attached are LoadError.
+"""
+
+import pytest
+
+from ..cpu import CPU, LoadError, load_assembler
+from ..image import ImageError, pack_image, parse_image, write_image
+
+
+def test_symbol_round_trip():
+    image = parse_image(pack_image(b"\x01", symbols={"END": 0}))
+    assert image.symbols == {"END": 0}
+
+
+@pytest.mark.parametrize("symbols", [
+    {"END": 256},
+    {"BEFORE": -1},
+    {"CAFÉ": 0},
+    {"A" * 256: 0},
+    {f"L{i}": 0 for i in range(256)},
+])
+def test_bad_symbols(symbols):
+    with pytest.raises(ImageError):
+        pack_image(b"\x01", symbols=symbols)
+
+
+def test_label_past_memory_is_asm_error():
+    asm = load_assembler()
+    # a full 256 bytes, then a label on the address after them
+    source = "DS " + "x" * 255 + "\nHLT\nEnd:\n"
+
+    with pytest.raises(asm.AsmError) as e:
+        asm.assemble(source, binary=True)
+
+    assert "END" in str(e.value.diagnostics)
+
+
+@pytest.mark.parametrize("offset, stack", [
+    # more extended memory than the banks can reach
+    (5000000, 0xf4),
+    # the stack is already in the bank window
+    (0, 0x90),
+])
+def test_extended_memory_that_cant_attach_is_load_error(tmp_path, offset,
+                                                        stack):
+    filename = str(tmp_path / "banked.ls8b")
+    write_image(filename, b"\x01", segments=[(offset, b"ab")])
+
+    cpu = CPU()
+    cpu.reg[7] = stack
+
+    with pytest.raises(LoadError, match="extended memory"):
+        cpu.load(filename)
@@ -0,0 +1,55 @@
+"""
+Key presses replayed against examples/keyboard.ls8, which echoes every key
+it's sent.
+
+data/keyboard-hello.log was recorded with
+
+    printf 'hello\n' | ls8.py run --record keyboard-hello.log \
+        examples/keyboard.ls8
+
+and stopped with ^C, the program never halts.
+"""
+
+import os
+
+from ..cpu import CPU, RUN_CHUNK
+from ..devices import attach_standard_devices
+from ..keyboard import ScriptedKeyboard
+from ..output import CaptureOutput
+from ..replay import DELIVER, read_log, run_replay
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, "..", "examples")
+
+
+def keyboard_cpu():
+    cpu = CPU()
+    cpu.load(os.path.join(EXAMPLES, "keyboard.ls8"))
+    cpu.output = CaptureOutput()
+    return cpu
+
+
+def test_replay_recorded_keys():
+    events = read_log(os.path.join(HERE, "data", "keyboard-hello.log"))
+
+    cpu = keyboard_cpu()
+    # the machine ls8.py run recorded on
+    attach_standard_devices(cpu)
+    # on past the last key's interrupt, the program spins after it; the
+    # log goes on with timer interrupts it has masked
+    last = max(count for count, kind, _ in events if kind == DELIVER)
+    result = run_replay(cpu, events, max_steps=last + RUN_CHUNK)
+
+    assert result.status == "step_budget"
+    assert cpu.output.getvalue() == "hello\n"
+
+
+def test_scripted_keys():
+    cpu = keyboard_cpu()
+    cpu.keyboard = ScriptedKeyboard("hello\n")
+
+    result = cpu.run(max_steps=10 * RUN_CHUNK)
+
+    assert result.status == "step_budget"
+    assert cpu.keyboard.done
+    assert cpu.output.getvalue() == "hello\n"
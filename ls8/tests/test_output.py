@@ -0,0 +1,40 @@
+"""
+Output.write() is what every output device has to provide.
+"""
+
+import pytest
+
+from ..cpu import CPU, DIV, HLT, LDI, PRA, PRN
+from ..output import Output
+
+
+class Collect(Output):
+    """An output device with nothing but write()."""
+
+    def __init__(self):
+        self.text = []
+
+    def write(self, text):
+        self.text.append(text)
+
+
+def test_base_class_has_no_write():
+    output = Output()
+
+    with pytest.raises(NotImplementedError):
+        output.prn(8)
+    with pytest.raises(NotImplementedError):
+        output.pra(65)
+
+
+@pytest.mark.parametrize("mode", ["run", "run_translated", "run_reference"])
+def test_everything_goes_through_write(mode):
+    cpu = CPU()
+    cpu.load_bytes([LDI, 0, 8, LDI, 1, 65, PRN, 0, PRA, 1,
+                    LDI, 1, 0, DIV, 0, 1, HLT])
+    cpu.output = Collect()
+
+    result = getattr(cpu, mode)()
+
+    assert result.status == "halted"
+    assert "".join(cpu.output.text) == "Print this: 8\nADivision by zero\n"
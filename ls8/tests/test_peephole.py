@@ -0,0 +1,130 @@
+"""
+The peephole optimizer (asm.py --optimize) mustn't change what a program
+does: each program is assembled with and without it and run on the CPU.
+"""
+
+import pytest
+
+from ..cpu import CPU, load_assembler
+from ..output import CaptureOutput
+from .test_asm import SOURCES, name_of
+
+# examples that never halt
+ENDLESS = {"interrupts", "keyboard"}
+
+
+def run(lines, optimize, addresses=range(8)):
+    """
+    Assemble and run a program, returning its size and how it ended. Only
+    the registers not in `addresses` are kept: a register holding a label
+    holds a different address once the optimizer has shortened the code.
+    """
+    assembly = load_assembler().assemble_lines(lines, optimize)
+
+    cpu = CPU()
+    cpu.load_bytes(assembly.image)
+    cpu.output = CaptureOutput()
+    result = cpu.run(max_steps=1000000)
+
+    return len(assembly.image), {
+        "status": result.status,
+        "reason": result.reason,
+        "output": cpu.output.getvalue(),
+        "reg": [v for r, v in enumerate(cpu.reg) if r not in addresses],
+        "flag": cpu.flag,
+        "running": cpu.running,
+    }
+
+
+# a program for each peephole rule, with the registers it loads labels
+# into, and one with a loop, where what's known about the registers has to
+# be forgotten at the label
+RULES = {
+    "push-pop": """
+        LDI R0,5
+        PUSH R0
+        POP R0
+        PRN R0
+        HLT
+    """,
+    "dead-ldi": """
+        LDI R1,3
+        LDI R1,4
+        PRN R1
+        HLT
+    """,
+    "known-value": """
+        LDI R0,7
+        PRN R0
+        LDI R0,7
+        PRN R0
+        HLT
+    """,
+    "jump-to-next": """
+        LDI R0,9
+        LDI R2,Next
+        JMP R2
+    Next:
+        PRN R0
+        HLT
+    """,
+}
+
+LABEL_REGISTERS = {"jump-to-next": (2,)}
+
+LOOP = """
+        LDI R0,3
+        LDI R1,0
+        LDI R3,End
+    Loop:
+        PRN R0
+        DEC R0
+        CMP R0,R1
+        JEQ R3
+        LDI R2,Loop
+        LDI R2,Loop
+        JMP R2
+    End:
+        HLT
+"""
+
+
+@pytest.mark.parametrize("name", sorted(RULES))
+def test_peephole_rule_keeps_behaviour(name):
+    lines = RULES[name].splitlines()
+    addresses = LABEL_REGISTERS.get(name, ())
+
+    size, expected = run(lines, False, addresses)
+    optimized_size, got = run(lines, True, addresses)
+
+    # the rule fired
+    assert optimized_size < size
+    assert got == expected
+    assert got["status"] == "halted"
+
+
+def test_peephole_loop_keeps_behaviour():
+    lines = LOOP.splitlines()
+
+    _, expected = run(lines, False, (2, 3))
+    _, got = run(lines, True, (2, 3))
+
+    assert got == expected
+    assert got["output"] == "Print this: 3\nPrint this: 2\nPrint this: 1\n"
+
+
+@pytest.mark.parametrize(
+    "source", [s for s in SOURCES
+               if name_of(s) not in ENDLESS
+               and not name_of(s).startswith("bench_")],
+    ids=name_of)
+def test_optimized_examples_keep_behaviour(source):
+    with open(source) as f:
+        lines = f.read().splitlines()
+
+    # which registers the examples keep labels in isn't worth listing,
+    # what they print and how they end is what has to stay the same
+    _, expected = run(lines, False)
+    _, got = run(lines, True)
+
+    assert got == expected
@@ -0,0 +1,419 @@
+"""
+Timing model: how many cycles would an LS-8 program take on a pipelined
+machine with a cache and a branch predictor?
+
+Usage: ls8.py timing [--cache SIZE,LINE,WAYS] [--policy lru|fifo]
+                     [--predictor static|1bit|2bit|gshare] program.ls8
+
+run_timed() is a copy of CPU.run's loop that charges every instruction
+
+* its cost in CYCLES, 1 for most instructions
+* MISS_PENALTY for every memory access that misses the cache, if there is
+  one: each line the instruction's bytes are in, what LD and ST load and
+  store, and the stack slots PUSH, POP, CALL and RET use
+* MISPREDICT_PENALTY for every conditional jump the predictor got wrong,
+  if there is one
+
+so, like the profiler, the model costs nothing unless it's used. Entering
+an interrupt handler isn't charged for, and neither is an instruction that
+faults: it's charged, and goes through the cache, once it has run.
+
+    model = Model(cache=Cache(64, 4, 2, "lru"), predictor=TwoBitPredictor())
+    timing = run_timed(cpu, model)
+    timing.cycles, timing.cpi()
+"""
+
+import argparse
+import sys
+
+from .cpu import (CPU, CALL, DIV, INT, IRET, JEQ, JGE, JGT, JLE, JLT, JNE, LD,
+                  MOD, MUL, POP, PUSH, RET, RUN_CHUNK, ST, CPUFault, LoadError)
+
+CONDITIONAL_JUMPS = {JEQ, JNE, JGT, JGE, JLT, JLE}
+
+# Cycles each instruction takes when every access hits the cache and every
+# branch is predicted right
+CYCLES = [1] * 256
+CYCLES[MUL] = 4
+CYCLES[DIV] = 12
+CYCLES[MOD] = 12
+CYCLES[CALL] = 2
+CYCLES[RET] = 2
+CYCLES[INT] = 4
+CYCLES[IRET] = 4
+
+# Extra cycles for a cache miss, and for a mispredicted branch
+MISS_PENALTY = 10
+MISPREDICT_PENALTY = 3
+
+LRU = "lru"
+FIFO = "fifo"
+
+
+class Cache:
+    """
+    A set associative cache of `size` bytes in lines of `line_size` bytes,
+    `ways` lines per set. On a miss in a full set the line that was used
+    least recently (LRU), or brought in first (FIFO), is evicted.
+    """
+
+    def __init__(self, size=64, line_size=4, ways=2, policy=LRU):
+        if policy not in (LRU, FIFO):
+            raise ValueError(f"unknown replacement policy {policy!r}")
+
+        if size <= 0 or line_size <= 0 or ways <= 0 or \
+                size % (line_size * ways):
+            raise ValueError(f"a {size} byte cache can't have {ways} ways of "
+                             f"{line_size} byte lines")
+
+        self.size = size
+        self.line_size = line_size
+        self.ways = ways
+        self.policy = policy
+        self.set_count = size // (line_size * ways)
+        # the line numbers in each set, the next to evict first
+        self.sets = [[] for _ in range(self.set_count)]
+        self.hits = 0
+        self.misses = 0
+
+    def access(self, addr):
+        """Read or write `addr`. Returns True for a hit."""
+        line = addr // self.line_size
+        lines = self.sets[line % self.set_count]
+
+        if line in lines:
+            self.hits += 1
+            if self.policy == LRU:
+                lines.remove(line)
+                lines.append(line)
+            return True
+
+        self.misses += 1
+        if len(lines) == self.ways:
+            del lines[0]
+        lines.append(line)
+        return False
+
+    def hit_rate(self):
+        accesses = self.hits + self.misses
+        return self.hits / accesses if accesses else 0.0
+
+
+class StaticPredictor:
+    """
+    Backward taken, forward not taken: jumps back are loops, which mostly
+    go round again.
+    """
+
+    def predict(self, pc, target):
+        return target <= pc
+
+    def update(self, pc, taken):
+        pass
+
+
+class OneBitPredictor:
+    """Predicts each jump goes the way it went last time."""
+
+    def __init__(self, entries=16):
+        self.entries = entries
+        self.table = [False] * entries
+
+    def predict(self, pc, target):
+        return self.table[pc % self.entries]
+
+    def update(self, pc, taken):
+        self.table[pc % self.entries] = taken
+
+
+class TwoBitPredictor:
+    """
+    A saturating counter per jump, 0-1 predicting not taken and 2-3 taken,
+    so a loop's one exit doesn't flip the prediction.
+    """
+
+    def __init__(self, entries=16):
+        self.entries = entries
+        self.counters = [1] * entries
+
+    def index(self, pc):
+        return pc % self.entries
+
+    def predict(self, pc, target):
+        return self.counters[self.index(pc)] >= 2
+
+    def update(self, pc, taken):
+        i = self.index(pc)
+        if taken:
+            self.counters[i] = min(self.counters[i] + 1, 3)
+        else:
+            self.counters[i] = max(self.counters[i] - 1, 0)
+
+
+class GsharePredictor(TwoBitPredictor):
+    """
+    Two bit counters indexed by the jump's address XORed with the outcomes
+    of the last `history_bits` jumps, so jumps that depend on each other
+    get counters of their own.
+    """
+
+    def __init__(self, entries=16, history_bits=4):
+        super().__init__(entries)
+        self.mask = (1 << history_bits) - 1
+        self.history = 0
+
+    def index(self, pc):
+        return (pc ^ self.history) % self.entries
+
+    def update(self, pc, taken):
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.mask
+
+
+PREDICTORS = {
+    "static": StaticPredictor,
+    "1bit": OneBitPredictor,
+    "2bit": TwoBitPredictor,
+    "gshare": GsharePredictor,
+}
+
+
+class Model:
+    """
+    The machine being modelled: instruction costs, and the cache and
+    branch predictor, None for none.
+    """
+
+    def __init__(self, cycles=None, cache=None, predictor=None,
+                 miss_penalty=MISS_PENALTY,
+                 mispredict_penalty=MISPREDICT_PENALTY):
+        self.cycles = cycles or CYCLES
+        self.cache = cache
+        self.predictor = predictor
+        self.miss_penalty = miss_penalty
+        self.mispredict_penalty = mispredict_penalty
+
+
+class Timing:
+    """
+    What run_timed() counted, and how the run ended: `status`, `pc` and
+    `reason` as in cpu.RunResult.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.steps = 0
+        self.cycles = 0
+        self.status = "halted"
+        self.pc = 0
+        self.reason = None
+        self.branches = 0
+        self.mispredicts = 0
+
+    def cpi(self):
+        """Cycles per instruction."""
+        return self.cycles / self.steps if self.steps else 0.0
+
+
+def run_timed(cpu, model, max_steps=None):
+    """
+    Run the CPU like CPU.run, charging cycles as it goes, and return the
+    Timing.
+    """
+
+    timing = Timing(model)
+    costs = model.cycles
+    cache = model.cache
+    predictor = model.predictor
+    miss_penalty = model.miss_penalty
+    mispredict_penalty = model.mispredict_penalty
+    line_size = cache.line_size if cache is not None else 1
+
+    ram = cpu.ram
+    reg = cpu.reg
+    decoded = cpu.decoded
+    decode = cpu.decode
+    steps = 0
+    cycles = 0
+    branches = 0
+    mispredicts = 0
+    pc = cpu.pc
+    i = 0
+
+    try:
+        while cpu.running:
+            chunk = RUN_CHUNK
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - steps)
+                if chunk <= 0:
+                    timing.status = "step_budget"
+                    break
+
+            pc = cpu.pc
+            i = 0
+            cpu.poll_interrupts()
+
+            for i in range(chunk):
+                pc = cpu.pc
+                entry = decoded.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                handler, reg_a, reg_b, length = entry
+
+                ir = ram[pc]
+
+                # the memory it uses, worked out before it runs
+                if cache is None:
+                    addr = None
+                elif ir == LD:
+                    addr = reg[reg_b]
+                elif ir == ST:
+                    addr = reg[reg_a]
+                elif ir == PUSH or ir == CALL:
+                    addr = (reg[7] - 1) & 0xff
+                elif ir == POP or ir == RET:
+                    addr = reg[7]
+                else:
+                    addr = None
+
+                if predictor is not None and ir in CONDITIONAL_JUMPS:
+                    guess = predictor.predict(pc, reg[reg_a])
+
+                next_pc = (pc + length) & 0xff
+                cpu.pc = next_pc
+                handler(reg_a, reg_b)
+
+                # it ran without a fault, charge for it
+                cycles += costs[ir]
+
+                if cache is not None:
+                    # the instruction's bytes, one access per line they're
+                    # in, wrapping past FF
+                    line = None
+                    for k in range(length):
+                        byte = (pc + k) & 0xff
+                        if byte // line_size != line:
+                            line = byte // line_size
+                            if not cache.access(byte):
+                                cycles += miss_penalty
+
+                    if addr is not None and not cache.access(addr):
+                        cycles += miss_penalty
+
+                if predictor is not None and ir in CONDITIONAL_JUMPS:
+                    taken = cpu.pc != next_pc
+                    branches += 1
+                    if guess != taken:
+                        mispredicts += 1
+                        cycles += mispredict_penalty
+                    predictor.update(pc, taken)
+
+                if not cpu.running:
+                    steps += i + 1
+                    break
+            else:
+                steps += chunk
+
+    except CPUFault as e:
+        # as CPU.run does, stop on the instruction at fault
+        steps += i
+        cpu.pc = pc if e.pc is None else e.pc
+        timing.status = "fault"
+        timing.reason = e.reason
+
+    cpu.output.flush()
+
+    timing.steps = steps
+    timing.cycles = cycles
+    timing.branches = branches
+    timing.mispredicts = mispredicts
+    timing.pc = cpu.pc
+    return timing
+
+
+def report(timing, file=sys.stdout):
+    """Print the cycles, CPI, hit rate and mispredicts."""
+
+    def out(*args):
+        print(*args, file=file)
+
+    model = timing.model
+
+    out(f"{timing.steps} instructions, {timing.cycles} cycles, "
+        f"CPI {timing.cpi():.2f}")
+    if timing.status == "fault":
+        out(f"fault at {timing.pc:02X}: {timing.reason}")
+
+    cache = model.cache
+    if cache is not None:
+        out(f"cache: {cache.size} bytes, {cache.line_size} byte lines, "
+            f"{cache.ways} way, {cache.policy.upper()}: "
+            f"{cache.hits} hits, {cache.misses} misses, "
+            f"hit rate {cache.hit_rate() * 100:.1f}%")
+
+    if model.predictor is not None:
+        rate = timing.mispredicts * 100 / (timing.branches or 1)
+        out(f"branches: {timing.branches} conditional, "
+            f"{timing.mispredicts} mispredicted ({rate:.1f}%)")
+
+
+def parse_cache(text):
+    """SIZE,LINE,WAYS from the command line, as ints."""
+    try:
+        size, line_size, ways = (int(n) for n in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected SIZE,LINE,WAYS, got {text!r}") from None
+    return size, line_size, ways
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py timing",
+        description="Run an LS-8 program and count the cycles it would "
+                    "take with a cache and a branch predictor.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file")
+    parser.add_argument("--cache", type=parse_cache, default=None,
+                        metavar="SIZE,LINE,WAYS",
+                        help="simulate a cache, e.g. 64,4,2 (default none)")
+    parser.add_argument("--policy", choices=(LRU, FIFO), default=LRU,
+                        help="cache replacement policy (default lru)")
+    parser.add_argument("--predictor", choices=sorted(PREDICTORS),
+                        default=None,
+                        help="branch predictor (default none)")
+    parser.add_argument("--max-steps", type=int, default=None,
+                        help="stop after this many instructions")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    cache = None
+    if args.cache is not None:
+        try:
+            cache = Cache(*args.cache, args.policy)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+
+    predictor = None
+    if args.predictor is not None:
+        predictor = PREDICTORS[args.predictor]()
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    timing = run_timed(cpu, Model(cache=cache, predictor=predictor),
+                       args.max_steps)
+
+    # keep the report apart from anything the program printed
+    report(timing, file=sys.stderr)
+
+    return 0
@@ -0,0 +1,320 @@
+"""
+Ring-buffer execution tracer.
+
+run_traced() is a copy of CPU.run's loop that records the machine state
+before every instruction into a fixed size ring buffer, so a traced run
+keeps the last N instructions without printing anything. The buffer is one
+preallocated bytearray of RECORD_SIZE byte records:
+
+    pc, ir, operand a, operand b, R0-R7, FL
+
+The buffer is written out to a trace file on demand (Tracer.dump), when the
+CPU halts, when it faults and when the run is interrupted with ^C, if the
+Tracer was given a path. Tracer.request() asks a run in progress for a dump
+at its next chunk boundary; ls8.py trace calls it on SIGUSR1, so
+
+    kill -USR1 <pid>
+
+writes the trace of a program that's still running. A trace file is a
+header followed by the records, oldest first:
+
+    header   4s  magic b"LS8T"
+             B   format version (1)
+             B   why it was written: 0 halt, 1 fault, 2 on demand,
+                 3 interrupted
+             I   number of records in the file
+             Q   instructions traced in total
+
+Usage:
+
+    ls8.py trace [--size N] [--out file] program.ls8
+    python3 -m ls8.tracer [--last N] file.trace
+                                        print the records in a trace file
+"""
+
+import argparse
+import signal
+import struct
+import sys
+
+from .cpu import CPU, NAMES, RUN_CHUNK, CPUFault, LoadError, RunResult
+
+MAGIC = b"LS8T"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBBIQ")
+
+RECORD_SIZE = 13
+
+# Why a trace file was written
+HALT = 0
+FAULT = 1
+DEMAND = 2
+INTERRUPTED = 3
+
+REASONS = {HALT: "halt", FAULT: "fault", DEMAND: "on demand",
+           INTERRUPTED: "interrupt"}
+
+
+class Tracer:
+    """The last `capacity` instructions executed."""
+
+    def __init__(self, capacity=1024, path=None):
+        if capacity < 1:
+            raise ValueError(f"a tracer has to keep at least 1 record, "
+                             f"not {capacity}")
+
+        self.capacity = capacity
+        # where to dump on halt or fault, None to not
+        self.path = path
+        self.buffer = bytearray(capacity * RECORD_SIZE)
+        # index of the next record to write
+        self.next = 0
+        # records written in total, including those overwritten
+        self.count = 0
+        # set by request(), run_traced() dumps at its next chunk boundary
+        self.requested = False
+
+    def records(self):
+        """Return the recorded bytes, oldest record first."""
+        if self.count < self.capacity:
+            return bytes(self.buffer[:self.next * RECORD_SIZE])
+
+        split = self.next * RECORD_SIZE
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def request(self):
+        """
+        Ask run_traced() to dump at its next chunk boundary, where next and
+        count are up to date. Safe to call from a signal handler.
+        """
+        self.requested = True
+
+    def dump(self, path=None, reason=DEMAND):
+        """Write the trace file."""
+        data = self.records()
+
+        with open(path or self.path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, reason,
+                                len(data) // RECORD_SIZE, self.count))
+            f.write(data)
+
+
+def run_traced(cpu, tracer, max_steps=None):
+    """
+    Run the CPU like CPU.run, recording every instruction in `tracer`.
+    tracer.next and tracer.count are brought up to date at every chunk
+    boundary, so a dump between chunks has the records so far. Returns a
+    cpu.RunResult.
+    """
+
+    ram = cpu.ram
+    reg = cpu.reg
+    decoded = cpu.decoded
+    decode = cpu.decode
+
+    buf = tracer.buffer
+    capacity = tracer.capacity
+    pos = tracer.next
+    # records before this run
+    base = tracer.count
+    steps = 0
+    status = "halted"
+    pc = cpu.pc
+    i = 0
+
+    try:
+        while cpu.running:
+            chunk = RUN_CHUNK
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - steps)
+                if chunk <= 0:
+                    status = "step_budget"
+                    break
+
+            pc = cpu.pc
+            i = 0
+            tracer.next = pos
+            tracer.count = base + steps
+            if tracer.requested:
+                tracer.requested = False
+                if tracer.path is not None:
+                    tracer.dump(reason=DEMAND)
+            cpu.poll_interrupts()
+
+            for i in range(chunk):
+                pc = cpu.pc
+
+                # record the state before the instruction, from RAM rather
+                # than the decoded cache so an unknown opcode is recorded
+                o = pos * RECORD_SIZE
+                buf[o] = pc
+                buf[o + 1] = ram[pc]
+                buf[o + 2] = ram[(pc + 1) & 0xff]
+                buf[o + 3] = ram[(pc + 2) & 0xff]
+                buf[o + 4:o + 12] = reg
+                buf[o + 12] = cpu.flag
+                pos += 1
+                if pos == capacity:
+                    pos = 0
+
+                entry = decoded.get(pc)
+                if entry is None:
+                    entry = decode(pc)
+                handler, reg_a, reg_b, length = entry
+                cpu.pc = (pc + length) & 0xff
+                handler(reg_a, reg_b)
+
+                if not cpu.running:
+                    steps += i + 1
+                    break
+            else:
+                steps += chunk
+
+    except CPUFault as e:
+        # keep the instructions that led up to it, the one at fault is the
+        # last record
+        steps += i
+        tracer.next = pos
+        tracer.count = base + steps + 1
+        cpu.pc = pc if e.pc is None else e.pc
+        cpu.output.flush()
+        if tracer.path is not None:
+            tracer.dump(reason=FAULT)
+        return RunResult("fault", steps, cpu.pc, e.reason)
+
+    except BaseException as e:
+        # ^C, or a bug in the emulator
+        tracer.next = pos
+        tracer.count = base + steps + i + 1
+        if tracer.path is not None:
+            interrupted = isinstance(e, KeyboardInterrupt)
+            tracer.dump(reason=INTERRUPTED if interrupted else FAULT)
+        raise
+
+    tracer.next = pos
+    tracer.count = base + steps
+
+    cpu.output.flush()
+
+    if not cpu.running and tracer.path is not None:
+        tracer.dump(reason=HALT)
+
+    return RunResult(status, steps, cpu.pc)
+
+
+def read_trace(filename):
+    """Return (reason, total, records) from a trace file."""
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise ValueError("file too short for a trace header")
+
+    magic, version, reason, count, total = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ValueError("not an LS-8 trace (bad magic)")
+
+    if version != VERSION:
+        raise ValueError(f"unsupported trace version {version}")
+
+    body = data[HEADER.size:HEADER.size + count * RECORD_SIZE]
+    records = [body[o:o + RECORD_SIZE]
+               for o in range(0, len(body), RECORD_SIZE)]
+
+    return reason, total, records
+
+
+def format_record(record):
+    """One record as a line, in the format of the original CPU.trace."""
+    pc, ir, a, b = record[:4]
+    regs = " ".join(f"{r:02X}" for r in record[4:12])
+    name = NAMES.get(ir, "???")
+    return (f"TRACE: {pc:02X} | {ir:02X} {a:02X} {b:02X} | {regs} | "
+            f"FL {record[12]:02X}  {name}")
+
+
+def positive(text):
+    """A --size from the command line, as an int of at least 1."""
+    try:
+        n = int(text)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected a positive number of instructions, got {text!r}")
+    return n
+
+
+def run_main(argv):
+    """ls8.py trace: run a program with the tracer on."""
+
+    parser = argparse.ArgumentParser(
+        prog="ls8.py trace",
+        description="Run an LS-8 program, keeping its last instructions in "
+                    "a trace file.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file")
+    parser.add_argument("--size", type=positive, default=1024,
+                        help="instructions to keep (default 1024)")
+    parser.add_argument("--out",
+                        help="trace file (default program name + .trace)")
+    args = parser.parse_args(argv)
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    tracer = Tracer(args.size, args.out or args.program + ".trace")
+
+    # kill -USR1 writes the trace without stopping the program, where
+    # there are signals to send
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.request())
+
+    result = run_traced(cpu, tracer)
+
+    if result.status == "fault":
+        print(f"Fault at address {result.pc}: {result.reason}",
+              file=sys.stderr)
+        return 1
+
+    return 0
+
+
+def main(argv):
+    """Print the records in a trace file."""
+
+    parser = argparse.ArgumentParser(
+        prog="python3 -m ls8.tracer",
+        description="Print the records in an LS-8 trace file.")
+    parser.add_argument("file", help="trace file")
+    parser.add_argument("--last", type=int, default=None,
+                        help="only the last N records")
+    args = parser.parse_args(argv)
+
+    try:
+        reason, total, records = read_trace(args.file)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.last is not None:
+        records = records[-args.last:]
+
+    print(f"# {total} instructions traced, last {len(records)} kept, "
+          f"written on {REASONS.get(reason, reason)}")
+
+    for record in records:
+        print(format_record(record))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,335 @@
+"""
+Basic-block translator for the LS-8.
+
+A basic block is a run of instructions that starts at some address and ends
+at the first instruction that sets the PC (the jumps, CALL, RET, INT and
+IRET) or halts. Each block is turned into Python source for a single function,
+compiled with compile()/exec, and cached in `cpu.blocks` by its entry PC.
+Running a loop then costs one Python call per block instead of one handler
+call per instruction.
+
+Every block function has the signature
+
+    block(cpu, reg, ram, code_map) -> next pc
+
+Bytes a block was built from are marked in `cpu.code_map`, and any write that
+lands on one calls `cpu.invalidate()`, which drops every cached block. Writes
+made by a block check this too and return to the run loop straight away, so
+the rest of a block that just got overwritten never runs.
+
+LD and ST are translated as plain RAM accesses unless the CPU has memory-
+mapped devices attached (see devices.py), when they check cpu.io_map first.
+Attaching a device drops the cached blocks.
+
+Faults are raised as cpu.CPUFault with the address of the instruction at
+fault, the same as the decoder and handlers do for CPU.run.
+"""
+
+from .cpu import STACK_TOP, CPUFault
+from .opcodes import (ADD, AND, CALL, CMP, DEC, DIV, HLT, INC, JEQ, JGE, JGT,
+                      JLE, JLT, JMP, JNE, LD, LDI, MOD, MUL, NOP, NOT, OR, POP,
+                      PRA, PRN, PUSH, RET, SHL, SHR, ST, SUB, XOR, OPCODES,
+                      instruction_length, sets_pc)
+
+
+def gen_ldi(a, b, next_pc):
+    return [f"reg[{a}] = {b}"]
+
+
+def gen_nop(a, b, next_pc):
+    return []
+
+
+def gen_ld(a, b, next_pc):
+    return [f"reg[{a}] = ram[reg[{b}]]"]
+
+
+def gen_st(a, b, next_pc):
+    return [f"addr = reg[{a}]",
+            f"ram[addr] = reg[{b}]",
+            # leave the block if that write changed translated code
+            "if code_map[addr]:",
+            "    cpu.invalidate(addr)",
+            f"    return {next_pc}"]
+
+
+def gen_bus_ld(a, b, next_pc):
+    return [f"addr = reg[{b}]",
+            "kind = cpu.io_map[addr]",
+            f"reg[{a}] = cpu.devices[kind].read(addr) & 0xff if kind "
+            "else ram[addr]"]
+
+
+def gen_bus_st(a, b, next_pc):
+    return [f"addr = reg[{a}]",
+            "kind = cpu.io_map[addr]",
+            "if kind:",
+            f"    cpu.devices[kind].write(addr, reg[{b}])",
+            "else:",
+            f"    ram[addr] = reg[{b}]",
+            "    if code_map[addr]:",
+            "        cpu.invalidate(addr)",
+            f"        return {next_pc}"]
+
+
+def gen_prn(a, b, next_pc):
+    return [f"cpu.output.prn(reg[{a}])"]
+
+
+def gen_pra(a, b, next_pc):
+    return [f"cpu.output.pra(reg[{a}])"]
+
+
+def gen_hlt(a, b, next_pc):
+    return ["cpu.running = False",
+            f"return {next_pc}"]
+
+
+def gen_alu(expr):
+    """
+    Return a generator for an ALU operation that stores `expr` in register
+    a, where `expr` is a format string in terms of {x} (register a) and {y}
+    (register b).
+    """
+
+    def gen(a, b, next_pc):
+        e = expr.format(x=f"reg[{a}]", y=f"reg[{b}]")
+        return [f"reg[{a}] = {e}"]
+
+    return gen
+
+
+def gen_divide(operator):
+    """Return a generator for DIV or MOD, which halt on a zero divisor."""
+
+    def gen(a, b, next_pc):
+        return [f"if reg[{b}] == 0:",
+                "    cpu.output.write('Division by zero\\n')",
+                "    cpu.running = False",
+                f"    return {next_pc}",
+                f"reg[{a}] = reg[{a}] {operator} reg[{b}]"]
+
+    return gen
+
+
+def gen_cmp(a, b, next_pc):
+    # same flag values as CPU.alu_cmp
+    return [f"if reg[{a}] == reg[{b}]:",
+            "    cpu.flag = 0b00000001",
+            f"elif reg[{a}] < reg[{b}]:",
+            "    cpu.flag = 0b00000100",
+            "else:",
+            "    cpu.flag = 0b00000010"]
+
+
+def gen_push(a, b, next_pc):
+    return ["sp = (reg[7] - 1) & 0xff",
+            f"if sp < cpu.stack_limit or sp >= {STACK_TOP}:",
+            f"    raise CPUFault('stack overflow', {(next_pc - 2) & 0xff})",
+            "reg[7] = sp",
+            f"ram[sp] = reg[{a}]",
+            "if code_map[sp]:",
+            "    cpu.invalidate(sp)",
+            f"    return {next_pc}"]
+
+
+def gen_pop(a, b, next_pc):
+    return [f"if reg[7] >= {STACK_TOP}:",
+            f"    raise CPUFault('stack underflow', {(next_pc - 2) & 0xff})",
+            f"reg[{a}] = ram[reg[7]]",
+            "reg[7] += 1"]
+
+
+def gen_call(a, b, next_pc):
+    return ["sp = (reg[7] - 1) & 0xff",
+            f"if sp < cpu.stack_limit or sp >= {STACK_TOP}:",
+            f"    raise CPUFault('stack overflow', {(next_pc - 2) & 0xff})",
+            "reg[7] = sp",
+            f"ram[sp] = {next_pc}",
+            "if code_map[sp]:",
+            "    cpu.invalidate(sp)",
+            f"return reg[{a}]"]
+
+
+def gen_ret(a, b, next_pc):
+    return ["sp = reg[7]",
+            f"if sp >= {STACK_TOP}:",
+            f"    raise CPUFault('stack underflow', {(next_pc - 1) & 0xff})",
+            "reg[7] = sp + 1",
+            "return ram[sp]"]
+
+
+def gen_jmp(a, b, next_pc):
+    return [f"return reg[{a}]"]
+
+
+def gen_jump_if(test):
+    """
+    Return a generator for a conditional jump taken when `test`, an
+    expression on the flags in `flag`, is true.
+    """
+
+    def gen(a, b, next_pc):
+        return [f"if {test.replace('flag', 'cpu.flag')}:",
+                f"    return reg[{a}]",
+                f"return {next_pc}"]
+
+    return gen
+
+
+def gen_handler(op):
+    """
+    Return a generator for an instruction without its own translation, which
+    calls the CPU's handler for it. Its PC is set first, as the run loop
+    would, and the block ends after it in case it changed the PC, halted, or
+    wrote over code.
+    """
+
+    def gen(a, b, next_pc):
+        return [f"cpu.pc = {next_pc}",
+                "try:",
+                f"    cpu.branch_table[{op}]({a}, {b})",
+                "except CPUFault as e:",
+                "    if e.pc is None:",
+                f"        e.pc = {(next_pc - instruction_length(op)) & 0xff}",
+                "    raise",
+                "return cpu.pc"]
+
+    return gen
+
+
+# opcode -> source generator, each takes (operand a, operand b, next pc)
+# and returns the lines for that instruction. Opcodes missing from here are
+# translated with gen_handler().
+GENERATORS = {
+    LDI: gen_ldi,
+    NOP: gen_nop,
+    LD: gen_ld,
+    ST: gen_st,
+    PRN: gen_prn,
+    PRA: gen_pra,
+    HLT: gen_hlt,
+    ADD: gen_alu("({x} + {y}) & 0xff"),
+    SUB: gen_alu("({x} - {y}) & 0xff"),
+    MUL: gen_alu("({x} * {y}) & 0xff"),
+    DIV: gen_divide("//"),
+    MOD: gen_divide("%"),
+    INC: gen_alu("({x} + 1) & 0xff"),
+    DEC: gen_alu("({x} - 1) & 0xff"),
+    CMP: gen_cmp,
+    AND: gen_alu("{x} & {y}"),
+    NOT: gen_alu("~{x} & 0xff"),
+    OR: gen_alu("{x} | {y}"),
+    XOR: gen_alu("{x} ^ {y}"),
+    SHL: gen_alu("({x} << {y}) & 0xff"),
+    SHR: gen_alu("{x} >> {y}"),
+    PUSH: gen_push,
+    POP: gen_pop,
+    CALL: gen_call,
+    RET: gen_ret,
+    JMP: gen_jmp,
+    JEQ: gen_jump_if("flag & 0b00000001"),
+    JNE: gen_jump_if("not flag & 0b00000001"),
+    JGT: gen_jump_if("flag & 0b00000010"),
+    JGE: gen_jump_if("flag & 0b00000011"),
+    JLT: gen_jump_if("flag & 0b00000100"),
+    JLE: gen_jump_if("flag & 0b00000101"),
+}
+
+for op in OPCODES.values():
+    GENERATORS.setdefault(op, gen_handler(op))
+
+# LD and ST for a CPU with memory-mapped devices, which check its io_map.
+# Without any they're translated as plain RAM accesses.
+BUS_GENERATORS = {
+    LD: gen_bus_ld,
+    ST: gen_bus_st,
+}
+
+# instructions that end a basic block: everything that sets the PC, and HLT
+BLOCK_END = {op for op in OPCODES.values() if sets_pc(op)} | {HLT}
+
+
+def translate(cpu, pc):
+    """
+    Translate the basic block starting at `pc`, cache it in `cpu.blocks`
+    and return the compiled function.
+    """
+
+    ram = cpu.ram
+    code_map = cpu.code_map
+
+    generators = GENERATORS
+    if len(cpu.devices) > 1:
+        generators = {**GENERATORS, **BUS_GENERATORS}
+
+    # a bad instruction at the start of a block is reported by the decoder
+    cpu.decode(pc)
+
+    lines = [f"def block_{pc:02x}(cpu, reg, ram, code_map):"]
+    addr = pc
+
+    while True:
+        ir = ram[addr]
+
+        try:
+            cpu.decode(addr)
+        except CPUFault:
+            # stop before anything we can't translate, the next block starts
+            # there and the decoder reports it
+            lines.append(f"    return {addr}")
+            break
+
+        length = instruction_length(ir)
+        next_pc = (addr + length) & 0xff
+        a = ram[(addr + 1) & 0xff]
+        b = ram[(addr + 2) & 0xff]
+
+        for i in range(length):
+            code_map[(addr + i) & 0xff] = 1
+
+        lines.append(f"    # {addr:02x}: {ir:08b} {a} {b}")
+        for line in generators[ir](a, b, next_pc):
+            lines.append("    " + line)
+
+        if ir in BLOCK_END:
+            break
+
+        if next_pc < addr:
+            # wrapped around the top of memory, start a new block at 0
+            lines.append(f"    return {next_pc}")
+            break
+
+        addr = next_pc
+
+    namespace = {"CPUFault": CPUFault}
+    exec(compile("\n".join(lines), f"<block {pc:02x}>", "exec"), namespace)
+    block = namespace[f"block_{pc:02x}"]
+
+    cpu.blocks[pc] = block
+
+    return block
+
+
+# Number of blocks run between polls for interrupts
+POLL_BLOCKS = 256
+
+
+def run_translated(cpu):
+    """Run the CPU one translated basic block at a time."""
+
+    blocks = cpu.blocks
+
+    while cpu.running:
+        cpu.poll_interrupts()
+
+        for _ in range(POLL_BLOCKS):
+            pc = cpu.pc
+            block = blocks.get(pc)
+            if block is None:
+                block = translate(cpu, pc)
+
+            cpu.pc = block(cpu, cpu.reg, cpu.ram, cpu.code_map)
+
+            if not cpu.running:
+                break